@@ -4,31 +4,69 @@ API de Catálogos - Versión de Producción
 Maneja la subida y servicio de archivos estáticos, con CRUD completo.
 """
 import os
+import posixpath
+import asyncio
 import logging
 import json
+import base64
+import gzip
+import hashlib
+import mimetypes
+import multiprocessing
+import re
 import secrets
-import shutil
-from datetime import datetime
-from typing import List, Optional
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 
 import jwt
 from dotenv import load_dotenv
-from fastapi import (FastAPI, Depends, HTTPException, status, Request,
-                     BackgroundTasks, UploadFile, File, Form)
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Response, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import URL
 from passlib.context import CryptContext
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field, ValidationError
 from sqlalchemy import (create_engine, Column, Integer, String, Text,
-                        DateTime, ForeignKey)
-from sqlalchemy.orm import sessionmaker, Session, relationship, joinedload, declarative_base
+                        BigInteger, DateTime, Float, ForeignKey, LargeBinary, Index, delete, event, insert, inspect, literal, or_, select,
+                        text, tuple_, update)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import AddConstraint, CreateTable
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from sqlalchemy.orm import sessionmaker, Session, relationship, declarative_base
 from sqlalchemy.sql import func
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
+from .metrics import (COUNT_BUCKETS, QUERY_BUCKETS, THROUGHPUT_BUCKETS, Counter, Gauge, Histogram,
+                      render_metrics)
+
+try:
+    import brotli
+except ImportError:  # La variante br es opcional
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: el candado de construcción sólo cubre el propio proceso
+    fcntl = None
+
 # --- Configuración Inicial ---
 load_dotenv()
 
@@ -40,23 +78,383 @@ logger = logging.getLogger(__name__)
 SECRET_KEY = os.getenv("SECRET_KEY", "a_very_secret_key_that_should_be_in_env")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-# Configuración de la base de datos
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "1024"))
+# Otros procesos sólo ven un cambio de contraseña o un borrado al vencer la entrada: este plazo es esa ventana
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "5"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__default_rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS)
+
+# Pool dedicado al hash de contraseñas (bcrypt), separado del threadpool de Starlette
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "32"))
+PASSWORD_HASH_TIMEOUT_SECONDS = float(os.getenv("PASSWORD_HASH_TIMEOUT_SECONDS", "10"))
+
+# Configuración de la base de datos. Con un driver asíncrono en la URL
+# (sqlite+aiosqlite://, postgresql+asyncpg://) los handlers del CRUD usan un
+# AsyncSession; el resto (hilos de fondo, importación masiva, subidas) sigue
+# usando el engine síncrono sobre la misma base.
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./catalog_prod.db")
-engine = create_engine(DATABASE_URL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "-1"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0") not in ("0", "false", "False")
+
+# Driver síncrono equivalente a cada driver asíncrono soportado
+SYNC_DRIVERS = {"aiosqlite": "pysqlite", "asyncpg": "psycopg2"}
+
+
+def sync_database_url(database_url: str):
+    url = make_url(database_url)
+    driver = SYNC_DRIVERS.get(url.get_driver_name())
+    if driver is None:
+        return url
+    return url.set(drivername=f"{url.get_backend_name()}+{driver}")
+
+
+def timed_pool_class(database_url):
+    """
+    Pool por defecto del dialecto, midiendo cuánto se espera para obtener una
+    conexión (DB_POOL_WAIT, en la sección de métricas).
+    """
+    url = make_url(database_url)
+    base = url.get_dialect().get_pool_class(url)
+    if base is NullPool and url.get_driver_name() == "aiosqlite":
+        # aiosqlite abre un hilo por conexión: mejor reutilizarlas que abrir una por petición
+        base = AsyncAdaptedQueuePool
+
+    class TimedPool(base):
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                DB_POOL_WAIT.observe(time.perf_counter() - started)
+
+    TimedPool.__name__ = f"Timed{base.__name__}"
+    return TimedPool
+
+
+def engine_options(database_url) -> dict:
+    poolclass = timed_pool_class(database_url)
+    options = {"poolclass": poolclass, "pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE_SECONDS}
+    if issubclass(poolclass, QueuePool):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT_SECONDS)
+    return options
+
+
+SYNC_DATABASE_URL = sync_database_url(DATABASE_URL)
+engine = create_engine(SYNC_DATABASE_URL, **engine_options(SYNC_DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if make_url(DATABASE_URL).get_driver_name() in SYNC_DRIVERS:
+    async_engine = create_async_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+    # Sin expirar al confirmar: tras un commit, leer un atributo no puede lanzar IO implícita
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+else:
+    async_engine = None
+    AsyncSessionLocal = None
 Base = declarative_base()
 
+
+# Contador de count_queries activo en el contexto que abrió el bloque
+_query_counter: ContextVar[Optional[dict]] = ContextVar("query_counter", default=None)
+
+
+@contextmanager
+def count_queries(bind=engine):
+    """
+    Cuenta las sentencias SQL ejecutadas sobre `bind` dentro del bloque por el
+    propio llamador o por las peticiones HTTP que atiende la app; las de los
+    hilos en segundo plano (cola de trabajos, limpieza, índices) no cuentan.
+    """
+    counter = {"count": 0}
+
+    def _count(*args):
+        if _query_counter.get() is counter or _request_db_usage.get() is not None:
+            counter["count"] += 1
+
+    token = _query_counter.set(counter)
+    event.listen(bind, "after_cursor_execute", _count)
+    try:
+        yield counter
+    finally:
+        event.remove(bind, "after_cursor_execute", _count)
+        _query_counter.reset(token)
+
 # Configuración del limitador de velocidad
 limiter = Limiter(key_func=get_remote_address)
 
 # Paths para archivos
 JSON_OUTPUT_PATH = "sync/catalog.json"
+
+# Ventana (en segundos) en la que se agrupan las regeneraciones de catalog.json
+CATALOG_SYNC_DEBOUNCE_SECONDS = float(os.getenv("CATALOG_SYNC_DEBOUNCE_SECONDS", "2"))
+
+# Con 1, cada versión de catalog.json se guarda en la base (tabla catalog_snapshots)
+# y todas las instancias sirven la última, en vez de depender de su disco local
+CATALOG_SNAPSHOT_DB = os.getenv("CATALOG_SNAPSHOT_DB", "0") == "1"
+CATALOG_SNAPSHOT_KEEP = int(os.getenv("CATALOG_SNAPSHOT_KEEP", "3"))
+CATALOG_SNAPSHOT_POLL_SECONDS = float(os.getenv("CATALOG_SNAPSHOT_POLL_SECONDS", "2"))
+
+# Versiones de catalog.json cuyas copias inmutables (sync/catalog.json.<sha256>[.gz|.br]) se conservan en disco
+PUBLISHED_CATALOG_KEEP = 3
+# Espera máxima de una petición a que otro proceso termine la primera generación
+CATALOG_BUILD_WAIT_SECONDS = float(os.getenv("CATALOG_BUILD_WAIT_SECONDS", "30"))
+CATALOG_BUILD_LOCK_PATH = "sync/.catalog.lock"
+BLOB_LOCK_PATH = "sync/.blobs.lock"
+
+# Cola persistente de reconstrucciones completas (tabla sync_jobs)
+SYNC_JOB_MAX_ATTEMPTS = int(os.getenv("SYNC_JOB_MAX_ATTEMPTS", "5"))
+SYNC_JOB_BACKOFF_SECONDS = float(os.getenv("SYNC_JOB_BACKOFF_SECONDS", "5"))
+SYNC_JOB_BACKOFF_MAX_SECONDS = 600
+# Un trabajo en curso cuyo worker no lo termina en este plazo vuelve a poder reclamarse
+SYNC_JOB_LEASE_SECONDS = float(os.getenv("SYNC_JOB_LEASE_SECONDS", "600"))
+SYNC_WORKER_POLL_SECONDS = float(os.getenv("SYNC_WORKER_POLL_SECONDS", "5"))
+# Por defecto la API sólo encola y los trabajos los ejecuta run_worker.py, fuera
+# del proceso web; con 1 los ejecuta un hilo de la propia API (despliegues de un
+# solo proceso, como Vercel, donde no puede correr un worker aparte)
+SYNC_WORKER_EMBEDDED = os.getenv("SYNC_WORKER_EMBEDDED", "0") == "1"
+
+# Diario de cambios (tabla catalog_changes) para la sincronización incremental:
+# se conservan las últimas N versiones; un cliente más atrasado debe resincronizar
+CHANGE_JOURNAL_RETENTION = int(os.getenv("CHANGE_JOURNAL_RETENTION", "10000"))
+CHANGES_PAGE_LIMIT = 1000
+CHANGES_MAX_PAGE_LIMIT = 5000
+# Cada cuánto, como mucho, una búsqueda aplica al índice los cambios de otros procesos
+SEARCH_INDEX_REFRESH_SECONDS = float(os.getenv("SEARCH_INDEX_REFRESH_SECONDS", "2"))
+
+CATALOG_BROTLI_QUALITY = int(os.getenv("CATALOG_BROTLI_QUALITY", "9"))
 STATIC_DIR = "static"
 CATALOGS_DIR = os.path.join(STATIC_DIR, "catalogs")
+# Archivos que la limpieza en segundo plano borra por lote tras un borrado en cascada
+FILE_CLEANUP_BATCH_SIZE = int(os.getenv("FILE_CLEANUP_BATCH_SIZE", "500"))
+
+# Subida de catálogos
+CATALOG_UPLOAD_MAX_BYTES = int(os.getenv("CATALOG_UPLOAD_MAX_BYTES", str(256 * 1024 * 1024)))
+UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# La importación masiva valida todo el cuerpo antes de escribir, así que se lee entero en memoria
+BULK_IMPORT_MAX_BYTES = int(os.getenv("BULK_IMPORT_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Subidas reanudables por partes (fuera de static: no se sirven públicamente)
+UPLOAD_SESSIONS_DIR = "uploads"
+DEFAULT_UPLOAD_SESSION_CHUNK_BYTES = 8 * 1024 * 1024
+MIN_UPLOAD_SESSION_CHUNK_BYTES = 256 * 1024
+MAX_UPLOAD_SESSION_CHUNK_BYTES = 64 * 1024 * 1024
+UPLOAD_SESSION_TTL_HOURS = float(os.getenv("UPLOAD_SESSION_TTL_HOURS", "24"))
+
+# Filas por lote al exportar con cursor del servidor
+EXPORT_BATCH_ROWS = 1000
+
+# Paginación de los listados de administración
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 500
+
+# Si se define, /metrics exige "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Registro de consultas lentas (desactivado con 0): umbral, capacidad y si se captura el EXPLAIN
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "0"))
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "100"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "1") not in ("0", "false", "False")
+
+# --- Métricas (formato de texto de Prometheus) ---
+def _pool_state() -> dict:
+    state = {}
+    for label, bind in (("sync", engine), ("async", async_engine and async_engine.sync_engine)):
+        if bind is None:
+            continue
+        pool = bind.pool
+        for name, method in (("size", "size"), ("checked_out", "checkedout"), ("idle", "checkedin"), ("overflow", "overflow")):
+            if hasattr(pool, method):
+                state[(label, name)] = getattr(pool, method)()
+        if (label, "overflow") in state:  # QueuePool cuenta el desbordamiento desde -pool_size
+            state[(label, "overflow")] = max(0, state[(label, "overflow")])
+    return state
+
+
+def _catalog_age() -> dict:
+    if published_catalog is None:
+        return {}
+    return {(): (datetime.now(timezone.utc) - published_catalog.modified_at).total_seconds()}
+
+
+HTTP_REQUESTS = Counter("http_requests_total", "Peticiones HTTP atendidas.", ("method", "route", "status"))
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP.", ("method", "route"))
+HTTP_IN_PROGRESS = Gauge("http_requests_in_progress", "Peticiones HTTP en curso.", ("method",))
+HTTP_DB_QUERIES = Histogram("http_request_db_queries", "Consultas SQL por petición.", ("route",), COUNT_BUCKETS)
+HTTP_DB_SECONDS = Histogram("http_request_db_seconds", "Tiempo en consultas SQL por petición.", ("route",), QUERY_BUCKETS)
+DB_QUERIES = Counter("db_queries_total", "Sentencias SQL ejecutadas.", ("operation",))
+DB_QUERY_LATENCY = Histogram("db_query_duration_seconds", "Duración de las sentencias SQL.", ("operation",), QUERY_BUCKETS)
+DB_POOL_WAIT = Histogram("db_pool_checkout_wait_seconds", "Espera para obtener una conexión del pool.", (), QUERY_BUCKETS)
+DB_POOL = Gauge("db_pool_connections", "Conexiones del pool por estado.", ("engine", "state"), collect=_pool_state)
+CATALOG_BUILD_SECONDS = Histogram("catalog_json_build_duration_seconds", "Duración de la generación de catalog.json.", ("mode",))
+CATALOG_BUILD_ERRORS = Counter("catalog_json_build_errors_total", "Generaciones de catalog.json fallidas.", ("mode",))
+CATALOG_BUILD_LOCK_WAIT = Histogram("catalog_json_build_lock_wait_seconds", "Espera para obtener el candado de construcción de catalog.json.")
+CATALOG_AGE = Gauge("catalog_json_age_seconds", "Segundos desde que se publicó la versión servida de catalog.json.", collect=_catalog_age)
+UPLOAD_BYTES = Counter("upload_received_bytes_total", "Bytes recibidos en subidas de catálogos.", ("route",))
+DB_SLOW_QUERIES = Counter("db_slow_queries_total", "Sentencias SQL por encima de SLOW_QUERY_THRESHOLD_MS.", ("operation",))
+SYNC_JOBS = Counter("sync_jobs_total", "Trabajos de sincronización ejecutados por resultado.", ("result",))
+UPLOAD_THROUGHPUT = Histogram("upload_throughput_bytes_per_second", "Velocidad de recepción de cada subida.", ("route",), THROUGHPUT_BUCKETS)
+FILE_CLEANUP = Counter("catalog_file_cleanup_total", "Archivos procesados por la limpieza en segundo plano.", ("result",))
+
+# Consultas y tiempo SQL de la petición en curso ([consultas, segundos]); el
+# threadpool copia el contexto, así que los handlers síncronos también suman
+_request_db_usage: ContextVar[Optional[list]] = ContextVar("request_db_usage", default=None)
+# Scope ASGI de la petición en curso, para saber desde qué ruta se lanzó una consulta
+_request_scope: ContextVar[Optional[dict]] = ContextVar("request_scope", default=None)
+_SQL_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_started
+    operation = statement.lstrip()[:6].upper()
+    operation = (operation if operation in _SQL_OPERATIONS else "OTHER",)
+    DB_QUERIES.inc(labels=operation)
+    DB_QUERY_LATENCY.observe(elapsed, operation)
+    usage = _request_db_usage.get()
+    if usage is not None:
+        usage[0] += 1
+        usage[1] += elapsed
+    if SLOW_QUERY_THRESHOLD_MS and elapsed * 1000 >= SLOW_QUERY_THRESHOLD_MS:
+        DB_SLOW_QUERIES.inc(labels=operation)
+        slow_query_log.record(conn, statement, parameters, executemany, elapsed)
+
+
+def instrument_engine(bind):
+    event.listen(bind, "before_cursor_execute", _query_started)
+    event.listen(bind, "after_cursor_execute", _query_finished)
+    if bind.dialect.name == "sqlite":
+        event.listen(bind, "connect", _enable_sqlite_foreign_keys)
+
+
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite sólo aplica las claves foráneas (y ON DELETE CASCADE) si se activan por conexión."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+instrument_engine(engine)
+if async_engine is not None:
+    instrument_engine(async_engine.sync_engine)
+
+
+# --- Registro de consultas lentas ---
+EXPLAIN_PREFIXES = {"sqlite": "EXPLAIN QUERY PLAN ", "postgresql": "EXPLAIN ", "mysql": "EXPLAIN "}
+
+
+def parameters_shape(parameters):
+    """Forma de los parámetros (nombres y tipos, nunca los valores: pueden ser contraseñas)."""
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+def _plan_lines(rows, dialect: str) -> List[str]:
+    if dialect != "sqlite":
+        return [str(row[-1]) for row in rows]
+    # EXPLAIN QUERY PLAN de SQLite devuelve (id, parent, notused, detail): se indenta por nivel
+    depth, lines = {0: -1}, []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return lines
+
+
+class SlowQueryLog:
+    """
+    Últimas sentencias SQL que superaron el umbral, en un buffer circular.
+
+    Con `explain`, el plan se obtiene con un cursor DBAPI propio sobre la misma
+    conexión (no dispara los eventos del engine) y se guarda por sentencia:
+    una consulta lenta que se repite no vuelve a pagar el EXPLAIN.
+    """
+
+    def __init__(self, capacity: int, explain: bool = True):
+        self.capacity = capacity
+        self.explain = explain
+        self.recorded = 0
+        self._entries = deque(maxlen=capacity)
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, conn, statement: str, parameters, executemany: bool, elapsed: float):
+        scope = _request_scope.get()
+        if executemany:
+            shape = {"rows": len(parameters), "row": parameters_shape(parameters[0]) if parameters else None}
+        else:
+            shape = parameters_shape(parameters)
+        entry = {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "duration_ms": round(elapsed * 1000, 3),
+            "method": scope["method"] if scope else None,
+            "route": _route_label(scope) if scope else None,
+            "statement": statement,
+            "parameters": shape,
+            "executemany": executemany,
+            "plan": self._plan(conn, statement, parameters[0] if executemany and parameters else parameters),
+        }
+        logger.warning(f"🐢 Consulta lenta ({entry['duration_ms']} ms) en {entry['route'] or 'segundo plano'}: {' '.join(statement.split())[:200]}")
+        with self._lock:
+            self.recorded += 1
+            self._entries.append(entry)
+
+    def _plan(self, conn, statement: str, parameters) -> Optional[List[str]]:
+        prefix = EXPLAIN_PREFIXES.get(conn.dialect.name)
+        if not self.explain or prefix is None or statement.lstrip()[:6].upper() not in _SQL_OPERATIONS:
+            return None
+        with self._lock:
+            if statement in self._plans:
+                self._plans.move_to_end(statement)
+                return self._plans[statement]
+        # En PostgreSQL un EXPLAIN fallido abortaría la transacción de la petición
+        savepoint = conn.dialect.name == "postgresql"
+        cursor = conn.connection.dbapi_connection.cursor()
+        try:
+            if savepoint:
+                cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(prefix + statement, parameters)
+                plan = _plan_lines(cursor.fetchall(), conn.dialect.name)
+            except Exception as e:
+                if savepoint:
+                    cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                return [f"No se pudo obtener el plan: {e}"]
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        finally:
+            cursor.close()
+        with self._lock:
+            self._plans[statement] = plan
+            while len(self._plans) > self.capacity:
+                self._plans.popitem(last=False)
+        return plan
+
+    def entries(self) -> List[dict]:
+        """Las más recientes primero."""
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._plans.clear()
+
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_LOG_SIZE, explain=SLOW_QUERY_EXPLAIN)
 
 # --- Modelos SQLAlchemy (Flexibles) ---
+# Las claves foráneas borran en cascada en la base (ON DELETE CASCADE) y las
+# relaciones usan passive_deletes: al borrar un padre el ORM no carga a sus
+# descendientes, la base los elimina con un DELETE por tabla.
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
@@ -67,61 +465,151 @@ class User(Base):
 class Line(Base):
     __tablename__ = "lines"
     id = Column(Integer, primary_key=True, index=True)
+    # Índice único: como no hay nombres repetidos, también sirve al orden (name, id)
     name = Column(String(100), unique=True, nullable=False, index=True)
     description = Column(Text, nullable=True)
-    brands = relationship("Brand", back_populates="line", cascade="all, delete-orphan")
-    categories = relationship("Category", back_populates="line", cascade="all, delete-orphan")
-    catalogs = relationship("Catalog", back_populates="line", cascade="all, delete-orphan")
+    brands = relationship("Brand", back_populates="line", cascade="all, delete-orphan", passive_deletes=True)
+    categories = relationship("Category", back_populates="line", cascade="all, delete-orphan", passive_deletes=True)
+    catalogs = relationship("Catalog", back_populates="line", cascade="all, delete-orphan", passive_deletes=True)
 
 class Category(Base):
     __tablename__ = "categories"
+    __table_args__ = (
+        Index("ix_categories_name_id", "name", "id"),
+        Index("ix_categories_line_id_name_id", "line_id", "name", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String(100), nullable=False, index=True)
+    name = Column(String(100), nullable=False)
     description = Column(Text, nullable=True)
-    line_id = Column(Integer, ForeignKey("lines.id"), nullable=False)
+    line_id = Column(Integer, ForeignKey("lines.id", ondelete="CASCADE"), nullable=False)
     line = relationship("Line", back_populates="categories")
-    subcategories = relationship("Subcategory", back_populates="category", cascade="all, delete-orphan")
-    brands = relationship("Brand", back_populates="category", cascade="all, delete-orphan")
-    catalogs = relationship("Catalog", back_populates="category", cascade="all, delete-orphan")
+    subcategories = relationship("Subcategory", back_populates="category", cascade="all, delete-orphan", passive_deletes=True)
+    brands = relationship("Brand", back_populates="category", cascade="all, delete-orphan", passive_deletes=True)
+    catalogs = relationship("Catalog", back_populates="category", cascade="all, delete-orphan", passive_deletes=True)
 
 class Subcategory(Base):
     __tablename__ = "subcategories"
+    __table_args__ = (
+        Index("ix_subcategories_name_id", "name", "id"),
+        Index("ix_subcategories_category_id_name_id", "category_id", "name", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String(100), nullable=False, index=True)
+    name = Column(String(100), nullable=False)
     description = Column(Text, nullable=True)
-    category_id = Column(Integer, ForeignKey("categories.id"), nullable=False)
+    category_id = Column(Integer, ForeignKey("categories.id", ondelete="CASCADE"), nullable=False)
     category = relationship("Category", back_populates="subcategories")
-    brands = relationship("Brand", back_populates="subcategory", cascade="all, delete-orphan")
-    catalogs = relationship("Catalog", back_populates="subcategory", cascade="all, delete-orphan")
+    brands = relationship("Brand", back_populates="subcategory", cascade="all, delete-orphan", passive_deletes=True)
+    catalogs = relationship("Catalog", back_populates="subcategory", cascade="all, delete-orphan", passive_deletes=True)
 
 class Brand(Base):
     __tablename__ = "brands"
+    __table_args__ = (
+        Index("ix_brands_name_id", "name", "id"),
+        Index("ix_brands_line_id_name_id", "line_id", "name", "id"),
+        Index("ix_brands_category_id_name_id", "category_id", "name", "id"),
+        Index("ix_brands_subcategory_id_name_id", "subcategory_id", "name", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String(100), nullable=False, index=True)
+    name = Column(String(100), nullable=False)
     description = Column(Text, nullable=True)
-    line_id = Column(Integer, ForeignKey("lines.id"), nullable=True)
-    category_id = Column(Integer, ForeignKey("categories.id"), nullable=True)
-    subcategory_id = Column(Integer, ForeignKey("subcategories.id"), nullable=True)
+    line_id = Column(Integer, ForeignKey("lines.id", ondelete="CASCADE"), nullable=True)
+    category_id = Column(Integer, ForeignKey("categories.id", ondelete="CASCADE"), nullable=True)
+    subcategory_id = Column(Integer, ForeignKey("subcategories.id", ondelete="CASCADE"), nullable=True)
     line = relationship("Line", back_populates="brands")
     category = relationship("Category", back_populates="brands")
     subcategory = relationship("Subcategory", back_populates="brands")
-    catalogs = relationship("Catalog", back_populates="brand", cascade="all, delete-orphan")
+    catalogs = relationship("Catalog", back_populates="brand", cascade="all, delete-orphan", passive_deletes=True)
 
 class Catalog(Base):
     __tablename__ = "catalogs"
+    __table_args__ = (
+        Index("ix_catalogs_name_id", "name", "id"),
+        Index("ix_catalogs_line_id_name_id", "line_id", "name", "id"),
+        Index("ix_catalogs_category_id_name_id", "category_id", "name", "id"),
+        Index("ix_catalogs_subcategory_id_name_id", "subcategory_id", "name", "id"),
+        Index("ix_catalogs_brand_id_name_id", "brand_id", "name", "id"),
+        Index("ix_catalogs_file_path", "file_path"),
+    )
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String(100), nullable=False, index=True)
+    name = Column(String(100), nullable=False)
     description = Column(Text, nullable=True)
     file_path = Column(String(255), nullable=True)
-    line_id = Column(Integer, ForeignKey("lines.id"), nullable=True)
-    category_id = Column(Integer, ForeignKey("categories.id"), nullable=True)
-    subcategory_id = Column(Integer, ForeignKey("subcategories.id"), nullable=True)
-    brand_id = Column(Integer, ForeignKey("brands.id"), nullable=True)
+    line_id = Column(Integer, ForeignKey("lines.id", ondelete="CASCADE"), nullable=True)
+    category_id = Column(Integer, ForeignKey("categories.id", ondelete="CASCADE"), nullable=True)
+    subcategory_id = Column(Integer, ForeignKey("subcategories.id", ondelete="CASCADE"), nullable=True)
+    brand_id = Column(Integer, ForeignKey("brands.id", ondelete="CASCADE"), nullable=True)
     line = relationship("Line", back_populates="catalogs")
     category = relationship("Category", back_populates="catalogs")
     subcategory = relationship("Subcategory", back_populates="catalogs")
     brand = relationship("Brand", back_populates="catalogs")
 
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+    id = Column(String(32), primary_key=True)
+    filename = Column(String(255), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    chunk_size = Column(Integer, nullable=False)
+    sha256 = Column(String(64), nullable=True)
+    name = Column(String(100), nullable=False)
+    description = Column(Text, nullable=True)
+    line_id = Column(Integer, nullable=True)
+    category_id = Column(Integer, nullable=True)
+    subcategory_id = Column(Integer, nullable=True)
+    brand_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Desde que empieza la finalización no se aceptan más partes
+    finalizing_at = Column(DateTime(timezone=True), nullable=True)
+    chunks = relationship("UploadChunk", cascade="all, delete-orphan", passive_deletes=True, order_by="UploadChunk.index")
+
+class UploadChunk(Base):
+    __tablename__ = "upload_chunks"
+    session_id = Column(String(32), ForeignKey("upload_sessions.id", ondelete="CASCADE"), primary_key=True)
+    index = Column(Integer, primary_key=True)
+    size = Column(Integer, nullable=False)
+
+class StoredCatalog(Base):
+    __tablename__ = "catalog_snapshots"
+    version = Column(Integer, primary_key=True)
+    digest = Column(String(64), nullable=False)
+    body = Column(LargeBinary, nullable=False)
+    body_gzip = Column(LargeBinary, nullable=False)
+    body_br = Column(LargeBinary, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class SyncJob(Base):
+    __tablename__ = "sync_jobs"
+    __table_args__ = (
+        Index("ix_sync_jobs_status_run_after", "status", "run_after"),
+        Index("ix_sync_jobs_status_finished_at", "status", "finished_at"),
+    )
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(20), nullable=False, default="full")
+    # pending → running → succeeded | failed (o de vuelta a pending para reintentar)
+    status = Column(String(20), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    base_url = Column(String(255), nullable=True)
+    run_after = Column(DateTime(timezone=True), nullable=False)
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+    worker = Column(String(100), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    duration_ms = Column(Float, nullable=True)
+    last_error = Column(Text, nullable=True)
+
+class CatalogChange(Base):
+    __tablename__ = "catalog_changes"
+    # Sin reutilizar versiones aunque se compacte el diario hasta vaciarlo
+    __table_args__ = {"sqlite_autoincrement": True}
+    version = Column(Integer, primary_key=True)
+    # upsert | delete | resync (importación masiva: el cliente debe volver a descargar todo)
+    op = Column(String(10), nullable=False)
+    kind = Column(String(20), nullable=True)
+    entity_id = Column(Integer, nullable=True)
+    # Campos públicos y claves foráneas tras el cambio (JSON), sólo en los upsert
+    data = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
 # --- Modelos Pydantic (Schemas) ---
 
 # Schemas para el JSON público
@@ -161,6 +649,69 @@ class LinePublic(BaseModel):
     catalogs: List[CatalogPublic] = []
     class Config: from_attributes = True
 
+# Schemas para la búsqueda
+class SearchPathItem(BaseModel):
+    kind: str
+    id: int
+    name: str
+
+class SearchResult(BaseModel):
+    kind: str
+    id: int
+    name: str
+    description: Optional[str] = None
+    file_url: Optional[str] = None
+    path: List[SearchPathItem] = []
+
+# Schemas para importación masiva (misma forma que catalog.json)
+class BulkNode(BaseModel):
+    kind: Optional[str] = None
+    id: Optional[int] = None
+    name: Optional[str] = Field(None, min_length=1, max_length=100)
+    description: Optional[str] = None
+    line_id: Optional[int] = None
+    category_id: Optional[int] = None
+    subcategory_id: Optional[int] = None
+    brand_id: Optional[int] = None
+    file_path: Optional[str] = Field(None, max_length=255)
+    categories: List["BulkNode"] = []
+    subcategories: List["BulkNode"] = []
+    brands: List["BulkNode"] = []
+    catalogs: List["BulkNode"] = []
+
+class BulkTree(BaseModel):
+    lines: List[BulkNode] = []
+
+class BulkResult(BaseModel):
+    created: Dict[str, int]
+    updated: Dict[str, int]
+    sync_job_id: Optional[int] = None
+
+class SyncJobResponse(BaseModel):
+    id: int
+    kind: str
+    status: str
+    attempts: int
+    created_at: Optional[datetime] = None
+    run_after: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    duration_ms: Optional[float] = None
+    last_error: Optional[str] = None
+    class Config: from_attributes = True
+
+class ChangeEntry(BaseModel):
+    op: str
+    kind: str
+    id: int
+    data: Optional[dict] = None
+
+class ChangesResponse(BaseModel):
+    version: int
+    resync: bool = False
+    has_more: bool = False
+    changes: List[ChangeEntry] = []
+
 # Schemas para Autenticación
 class UserLogin(BaseModel):
     email: EmailStr
@@ -204,7 +755,36 @@ class CatalogUpdate(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
 
+class CatalogUploadForm(BaseModel):
+    name: str
+    description: Optional[str] = None
+    line_id: Optional[int] = None
+    category_id: Optional[int] = None
+    subcategory_id: Optional[int] = None
+    brand_id: Optional[int] = None
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int = Field(..., gt=0)
+    chunk_size: Optional[int] = Field(None, ge=MIN_UPLOAD_SESSION_CHUNK_BYTES, le=MAX_UPLOAD_SESSION_CHUNK_BYTES)
+    sha256: Optional[str] = Field(None, pattern="^[0-9a-fA-F]{64}$")
+    name: str
+    description: Optional[str] = None
+    line_id: Optional[int] = None
+    category_id: Optional[int] = None
+    subcategory_id: Optional[int] = None
+    brand_id: Optional[int] = None
+
 # Schemas para CRUD (Respuesta)
+class UploadSessionResponse(BaseModel):
+    id: str
+    filename: str
+    size: int
+    chunk_size: int
+    total_chunks: int
+    received: List[List[int]]
+    missing_chunks: int
+
 class CatalogResponse(BaseModel):
     id: int
     name: str
@@ -252,6 +832,117 @@ app.mount(f"/{STATIC_DIR}", StaticFiles(directory=STATIC_DIR), name="static")
 
 
 # Middlewares
+class UploadSizeLimitMiddleware:
+    """
+    Corta las subidas que superan el tamaño máximo antes de que se procese el
+    cuerpo: por Content-Length si viene declarado y, si no, contando los bytes
+    a medida que llegan. Se instala una vez por prefijo, cada una con su límite.
+    """
+
+    def __init__(self, app, max_bytes: int, prefix: str = "/upload", detail: Optional[str] = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.detail = detail
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse(status_code=413, content={"detail": self.detail or _upload_too_large_detail()})
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail=self.detail or _upload_too_large_detail())
+            return message
+
+        return await self.app(scope, limited_receive, send)
+
+
+def _upload_too_large_detail() -> str:
+    return f"El archivo supera el tamaño máximo permitido ({CATALOG_UPLOAD_MAX_BYTES / (1024 * 1024):g} MB)."
+
+
+def _route_label(scope) -> str:
+    """Plantilla de la ruta (no la URL concreta) para no disparar la cardinalidad."""
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    if "endpoint" in scope:  # Montajes, como los archivos estáticos
+        return scope.get("root_path") or "/"
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Mide cada petición HTTP: latencia y estado por ruta, peticiones en curso,
+    consultas SQL y tiempo en base de datos de la petición y, en las subidas,
+    los bytes recibidos y la velocidad de recepción.
+    """
+
+    def __init__(self, app, upload_prefix: str = "/upload"):
+        self.app = app
+        self.upload_prefix = upload_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method = scope["method"]
+        status_code = 500
+        started = time.perf_counter()
+        db_usage = [0, 0.0]
+        upload = None
+
+        if method in ("POST", "PUT") and scope["path"].startswith(self.upload_prefix):
+            upload = [0, None]  # bytes recibidos, instante del último fragmento
+            inner_receive = receive
+
+            async def receive():
+                message = await inner_receive()
+                if message["type"] == "http.request":
+                    upload[0] += len(message.get("body", b""))
+                    upload[1] = time.perf_counter()
+                return message
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        token = _request_db_usage.set(db_usage)
+        scope_token = _request_scope.set(scope)
+        HTTP_IN_PROGRESS.inc(labels=(method,))
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_IN_PROGRESS.dec(labels=(method,))
+            _request_db_usage.reset(token)
+            _request_scope.reset(scope_token)
+            route = _route_label(scope)
+            HTTP_REQUESTS.inc(labels=(method, route, str(status_code)))
+            HTTP_LATENCY.observe(elapsed, (method, route))
+            HTTP_DB_QUERIES.observe(db_usage[0], (route,))
+            HTTP_DB_SECONDS.observe(db_usage[1], (route,))
+            if upload is not None and upload[0]:
+                UPLOAD_BYTES.inc(upload[0], (route,))
+                if upload[1] > started:
+                    UPLOAD_THROUGHPUT.observe(upload[0] / (upload[1] - started), (route,))
+
+
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=CATALOG_UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD_BYTES)
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=BULK_IMPORT_MAX_BYTES, prefix="/bulk",
+                   detail=f"La importación supera el tamaño máximo permitido ({BULK_IMPORT_MAX_BYTES / (1024 * 1024):g} MB).")
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 app.add_middleware(
@@ -260,7 +951,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Link"],
 )
+# La última en añadirse es la más externa: mide también las respuestas de los demás middlewares
+app.add_middleware(MetricsMiddleware)
 
 # --- Dependencias ---
 def get_db():
@@ -270,61 +964,1719 @@ def get_db():
     finally:
         db.close()
 
-def get_current_user(token: str = Depends(HTTPBearer()), db: Session = Depends(get_db)) -> User:
+
+class ThreadedSession:
+    """
+    Session síncrona con la parte de la interfaz de AsyncSession que usan los
+    handlers (`run_sync`, `close`), ejecutando cada llamada en el threadpool.
+
+    Cada llamada termina su transacción antes de volver al event loop (las
+    escrituras ya confirman dentro de las funciones): si la conexión quedara
+    tomada entre dos llamadas, bajo carga todos los hilos podrían acabar
+    esperando conexiones que sólo se liberan desde el mismo threadpool.
+    """
+
+    def __init__(self, session: Session):
+        self.sync_session = session
+        # Los objetos devueltos siguen cargados tras el commit que libera la conexión
+        session.expire_on_commit = False
+
+    def _call(self, fn, *args, **kwargs):
+        try:
+            result = fn(self.sync_session, *args, **kwargs)
+        except BaseException:
+            self.sync_session.rollback()
+            raise
+        self.sync_session.commit()
+        return result
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_in_threadpool(self._call, fn, *args, **kwargs)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
+
+
+AsyncDB = Union[AsyncSession, ThreadedSession]
+
+
+async def get_async_db():
+    """
+    Sesión de los handlers async: AsyncSession si DATABASE_URL usa un driver
+    asíncrono (la petición no ocupa un hilo mientras espera a la base) y, si
+    no, ThreadedSession. En ambos casos la lógica se escribe una vez, síncrona,
+    y se ejecuta con `await db.run_sync(fn, *args)`: fn recibe la Session.
+    """
+    db = AsyncSessionLocal() if AsyncSessionLocal is not None else ThreadedSession(SessionLocal())
+    try:
+        yield db
+    finally:
+        await db.close()
+
+def token_version(user: User) -> str:
+    """Huella del hash de la contraseña: cambia (e invalida los tokens) al cambiar la contraseña."""
+    return hashlib.sha256(user.password_hash.encode("utf-8")).hexdigest()[:16]
+
+def create_access_token(user: User) -> str:
+    now = datetime.now(timezone.utc)
+    payload = {
+        "sub": user.email,
+        "ver": token_version(user),
+        "iat": now,
+        "exp": now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+    }
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
+
+class PrincipalCache:
+    """
+    Caché LRU con TTL de usuarios ya resueltos, indexada por (email, versión
+    de la contraseña) del token. No sustituye a la validación del token: la
+    firma y el `exp` se comprueban antes de consultarla en cada petición.
+
+    El evento de SQLAlchemy sólo la vacía en el proceso que hizo el cambio;
+    en los demás, un token de una contraseña cambiada o de un usuario borrado
+    sigue valiendo como mucho PRINCIPAL_CACHE_TTL_SECONDS.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, email: str, version: str) -> Optional[User]:
+        key = (email, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def put(self, email: str, version: str, user: User):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        key = (email, version)
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, email: str):
+        """Descarta todas las entradas de un usuario (borrado o cambio de contraseña)."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == email]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL_SECONDS)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_principal(mapper, connection, target):
+    principal_cache.invalidate(target.email)
+    history = inspect(target).attrs.email.history
+    for email in history.deleted or ():
+        principal_cache.invalidate(email)
+
+
+def _load_principal(db: Session, email: str) -> Optional[User]:
+    user = db.query(User).filter(User.email == email).first()
+    if user is not None:
+        db.expunge(user)
+    return user
+
+
+async def get_current_user(token: str = Depends(HTTPBearer()), db: AsyncDB = Depends(get_async_db)) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token.credentials, SECRET_KEY, algorithms=[ALGORITHM],
+                             options={"require": ["exp", "sub", "ver"]})
         email: str = payload.get("sub")
-        if email is None:
+        version: str = payload.get("ver")
+        if email is None or version is None:
             raise credentials_exception
     except jwt.PyJWTError:
         raise credentials_exception
-    user = db.query(User).filter(User.email == email).first()
-    if user is None:
+    cached = principal_cache.get(email, version)
+    if cached is not None:
+        return cached
+    user = await db.run_sync(_load_principal, email)
+    if user is None or version != token_version(user):
         raise credentials_exception
+    principal_cache.put(email, version, user)
     return user
 
+
+# Índices de versiones anteriores que ya cubre un compuesto más ancho (mismo
+# prefijo): sólo encarecían cada escritura y la carga masiva.
+OBSOLETE_INDEXES = (
+    "ix_lines_name_id",
+    "ix_categories_name", "ix_subcategories_name", "ix_brands_name", "ix_catalogs_name",
+    "ix_categories_line_id_id", "ix_subcategories_category_id_id",
+    "ix_brands_line_id_id", "ix_brands_category_id_id", "ix_brands_subcategory_id_id",
+    "ix_catalogs_line_id_id", "ix_catalogs_category_id_id", "ix_catalogs_subcategory_id_id",
+    "ix_catalogs_brand_id_id",
+)
+
+
+@app.on_event("startup")
+def ensure_schema():
+    """
+    Crea las tablas, columnas opcionales e índices declarados en los modelos
+    que aún no existan en una base ya creada, y borra los índices obsoletos.
+    """
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except Exception as e:
+                logger.warning(f"No se pudo crear el índice {index.name}: {e}")
+    drop_obsolete_indexes()
+    create_binary_name_indexes()
+    migrate_cascade_foreign_keys()
+
+
+def add_missing_columns():
+    """Añade las columnas nuevas que admiten NULL (las demás necesitan una migración a mano)."""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            try:
+                with engine.begin() as conn:
+                    conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                logger.info(f"Columna {table.name}.{column.name} añadida.")
+            except Exception as e:
+                logger.warning(f"No se pudo añadir la columna {table.name}.{column.name}: {e}")
+
+
+def create_binary_name_indexes():
+    """
+    En PostgreSQL, índices sobre (name COLLATE "C", id) para el filtro
+    name_prefix de los listados, que compara con colación binaria: los
+    índices por nombre de los modelos usan la colación de la base.
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    for model in PUBLIC_MODELS.values():
+        table = model.__tablename__
+        try:
+            with engine.begin() as conn:
+                conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS ix_{table}_name_binary_id '
+                                     f'ON {table} (name COLLATE "C", id)')
+        except Exception as e:
+            logger.warning(f"No se pudo crear el índice ix_{table}_name_binary_id: {e}")
+
+
+def drop_obsolete_indexes():
+    existing = set()
+    inspector = inspect(engine)
+    for table_name in inspector.get_table_names():
+        existing |= {index["name"] for index in inspector.get_indexes(table_name)}
+    for name in OBSOLETE_INDEXES:
+        if name not in existing:
+            continue
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"DROP INDEX {name}"))
+            logger.info(f"Índice obsoleto {name} eliminado.")
+        except Exception as e:
+            logger.warning(f"No se pudo borrar el índice {name}: {e}")
+
+
+def _stale_foreign_keys(inspector, table) -> set:
+    """Columnas cuya clave foránea en la base no tiene el ON DELETE del modelo."""
+    expected = {fk.parent.name: fk.ondelete.upper() for fk in table.foreign_keys if fk.ondelete}
+    current = {fk["constrained_columns"][0]: (fk.get("options") or {}).get("ondelete", "").upper()
+               for fk in inspector.get_foreign_keys(table.name)}
+    return {column for column, ondelete in expected.items() if current.get(column) != ondelete}
+
+
+def _rebuild_sqlite_table(conn, table):
+    """SQLite no permite alterar claves foráneas: se copia la tabla a una nueva con el esquema actual."""
+    tmp_name = f"{table.name}__rebuild"
+    existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+    quote = conn.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(column.name) for column in table.columns if column.name in existing)
+    ddl = str(CreateTable(table).compile(dialect=conn.dialect))
+    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {tmp_name}")
+    conn.exec_driver_sql(ddl.replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE {tmp_name} ", 1))
+    conn.exec_driver_sql(f"INSERT INTO {tmp_name} ({columns}) SELECT {columns} FROM {table.name}")
+    conn.exec_driver_sql(f"DROP TABLE {table.name}")
+    conn.exec_driver_sql(f"ALTER TABLE {tmp_name} RENAME TO {table.name}")
+    for index in table.indexes:
+        index.create(conn)
+
+
+def migrate_cascade_foreign_keys():
+    """
+    create_all no modifica tablas existentes: las creadas antes de declarar
+    ON DELETE CASCADE se actualizan aquí (ALTER TABLE en PostgreSQL, copia
+    de la tabla en SQLite), una sola vez.
+    """
+    inspector = inspect(engine)
+    stale = {table: columns for table in Base.metadata.sorted_tables
+             if inspector.has_table(table.name) and (columns := _stale_foreign_keys(inspector, table))}
+    if not stale:
+        return
+    with engine.connect() as conn:
+        if conn.dialect.name == "sqlite":
+            # Con las claves activas, DROP TABLE de un padre borraría en cascada a sus hijos.
+            # El PRAGMA no tiene efecto dentro de una transacción: se confirma antes de empezar.
+            conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            conn.commit()
+        try:
+            with conn.begin():
+                for table, columns in stale.items():
+                    logger.info(f"Actualizando las claves foráneas de {table.name} a ON DELETE CASCADE...")
+                    if conn.dialect.name == "sqlite":
+                        _rebuild_sqlite_table(conn, table)
+                        continue
+                    for fk in inspector.get_foreign_keys(table.name):
+                        if fk["constrained_columns"][0] in columns:
+                            conn.exec_driver_sql(f'ALTER TABLE {table.name} DROP CONSTRAINT "{fk["name"]}"')
+                    for constraint in table.foreign_key_constraints:
+                        if constraint.column_keys[0] in columns:
+                            conn.execute(AddConstraint(constraint))
+            if conn.dialect.name == "sqlite":
+                orphans = conn.exec_driver_sql("PRAGMA foreign_key_check").fetchall()
+                if orphans:
+                    logger.warning(f"⚠️ {len(orphans)} filas apuntan a registros inexistentes (PRAGMA foreign_key_check).")
+        finally:
+            if conn.dialect.name == "sqlite":
+                conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+                conn.commit()
+    logger.info("✅ Claves foráneas actualizadas.")
+
+# --- Hash de contraseñas fuera del threadpool ---
+def _verify_and_update_password(password: str, password_hash: str):
+    return pwd_context.verify_and_update(password, password_hash)
+
+
+class PasswordHasher:
+    """
+    Ejecuta bcrypt en un pool de procesos de tamaño fijo (o de hilos propio si
+    la plataforma no permite procesos), con una cola de admisión acotada y un
+    tiempo máximo por operación. Así una ráfaga de logins no ocupa el
+    threadpool compartido por el resto de rutas síncronas.
+    """
+
+    def __init__(self, workers: int, queue_size: int, timeout: float):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._executor = None
+        self._semaphore = None
+        self._admitted = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            try:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            except (OSError, NotImplementedError, ImportError) as e:
+                logger.warning(f"Pool de procesos no disponible para bcrypt ({e}); se usan hilos dedicados.")
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self._admitted >= self.workers + self.queue_size:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Demasiados inicios de sesión simultáneos, intente de nuevo en unos segundos.",
+                headers={"Retry-After": "1"},
+            )
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        self._admitted += 1
+        try:
+            return await asyncio.wait_for(self._run(fn, *args), self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="La verificación de la contraseña tardó demasiado, intente de nuevo.",
+                headers={"Retry-After": "1"},
+            )
+        except BrokenExecutor as e:
+            logger.error(f"❌ El pool de hash de contraseñas se rompió: {e}")
+            self._executor = None
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Servicio de autenticación no disponible, intente de nuevo.")
+        finally:
+            self._admitted -= 1
+
+    async def _run(self, fn, *args):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+
+    async def verify_and_update(self, password: str, password_hash: str):
+        """Devuelve (válida, hash nuevo o None si no hace falta rehacerlo)."""
+        return await self.run(_verify_and_update_password, password, password_hash)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE, PASSWORD_HASH_TIMEOUT_SECONDS)
+
+
+@app.on_event("shutdown")
+def shutdown_password_hasher():
+    password_hasher.shutdown()
+
+# --- Paginación por cursor (keyset) ---
+# Colaciones que ordenan como Python (por punto de código); SQLite ya lo hace por defecto
+BINARY_COLLATIONS = {"postgresql": "C", "mysql": "utf8mb4_bin"}
+
+def encode_cursor(sort: str, item) -> str:
+    payload = [sort, getattr(item, sort), item.id]
+    return base64.urlsafe_b64encode(json.dumps(payload, ensure_ascii=False).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_sort, value, last_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    if cursor_sort != sort:
+        raise HTTPException(status_code=400, detail="El cursor no corresponde al orden solicitado")
+    return value, last_id
+
+def paginate(db: Session, model, request: Request, response: Response, *, limit: int, cursor: Optional[str],
+             sort: str, name_prefix: Optional[str] = None, **filters):
+    """
+    Aplica filtros, prefijo de nombre y paginación keyset sobre (sort, id).
+    Cada página es un rango sobre los índices compuestos de los modelos; el
+    cursor de la siguiente página se devuelve en X-Next-Cursor y en Link.
+    """
+    query = db.query(model)
+    for column, value in filters.items():
+        if value is not None:
+            query = query.filter(getattr(model, column) == value)
+    if name_prefix:
+        # El rango [prefijo, prefijo con el último carácter + 1) sólo equivale a
+        # "empieza por" comparando por punto de código: con la colación de la base
+        # (p. ej. en_US en PostgreSQL) se cuelan o se pierden nombres
+        collation = BINARY_COLLATIONS.get(db.get_bind().dialect.name)
+        name = model.name.collate(collation) if collation else model.name
+        query = query.filter(name >= name_prefix)
+        query = query.filter(name < name_prefix[:-1] + chr(ord(name_prefix[-1]) + 1))
+    if sort == "name":
+        order = (model.name, model.id)
+        if cursor:
+            value, last_id = decode_cursor(cursor, sort)
+            query = query.filter(tuple_(model.name, model.id) > tuple_(value, last_id))
+    else:
+        order = (model.id,)
+        if cursor:
+            _, last_id = decode_cursor(cursor, sort)
+            query = query.filter(model.id > last_id)
+    items = query.order_by(*order).limit(limit + 1).all()
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(sort, items[-1])
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    return items
+
 # --- Lógica de Negocio ---
-def generate_public_json(db: Session, request: Request):
+
+# Relaciones padre → hijo del JSON público, en el orden en que se serializan.
+PUBLIC_CHILDREN = {
+    "lines": ("categories", "brands", "catalogs"),
+    "categories": ("subcategories", "brands", "catalogs"),
+    "subcategories": ("brands", "catalogs"),
+    "brands": ("catalogs",),
+    "catalogs": (),
+}
+
+# Claves foráneas de cada entidad hacia sus posibles padres.
+PUBLIC_PARENTS = {
+    "lines": (),
+    "categories": (("lines", "line_id"),),
+    "subcategories": (("categories", "category_id"),),
+    "brands": (("lines", "line_id"), ("categories", "category_id"), ("subcategories", "subcategory_id")),
+    "catalogs": (("lines", "line_id"), ("categories", "category_id"),
+                 ("subcategories", "subcategory_id"), ("brands", "brand_id")),
+}
+
+# Campos públicos que se guardan por nodo (además de las claves foráneas).
+PUBLIC_FIELDS = {
+    "lines": ("id", "name"),
+    "categories": ("id", "name"),
+    "subcategories": ("id", "name"),
+    "brands": ("id", "name"),
+    "catalogs": ("id", "name", "file_path"),
+}
+
+
+PUBLIC_MODELS = {
+    "lines": Line,
+    "categories": Category,
+    "subcategories": Subcategory,
+    "brands": Brand,
+    "catalogs": Catalog,
+}
+
+
+def record_columns(kind: str) -> tuple:
+    """Columnas completas de una entidad tal como se indexan, exportan e importan."""
+    columns = ("id", "name", "description") + tuple(fk for _, fk in PUBLIC_PARENTS[kind])
+    return columns + ("file_path",) if kind == "catalogs" else columns
+
+
+def cascade_scope(kind: str, node_id: int) -> dict:
+    """
+    Condiciones que seleccionan el nodo y todo lo que ON DELETE CASCADE borra
+    con él, tabla por tabla, como subconsultas (sin traer los ids a Python).
+    """
+    ids = {kind: [node_id]}
+    scope = {kind: PUBLIC_MODELS[kind].id.in_(ids[kind])}
+    for child_kind, model in PUBLIC_MODELS.items():
+        parents = [getattr(model, fk).in_(ids[parent_kind])
+                   for parent_kind, fk in PUBLIC_PARENTS[child_kind] if parent_kind in ids]
+        if child_kind in ids or not parents:
+            continue
+        scope[child_kind] = or_(*parents)
+        ids[child_kind] = select(model.id).where(scope[child_kind])
+    return scope
+
+
+def _public_scope(line_ids: List[int]) -> dict:
+    """Condiciones que limitan cada tabla a los descendientes de las líneas dadas."""
+    category_ids = select(Category.id).where(Category.line_id.in_(line_ids))
+    subcategory_ids = select(Subcategory.id).where(Subcategory.category_id.in_(category_ids))
+    brand_ids = select(Brand.id).where(or_(Brand.line_id.in_(line_ids),
+                                           Brand.category_id.in_(category_ids),
+                                           Brand.subcategory_id.in_(subcategory_ids)))
+    return {
+        "lines": Line.id.in_(line_ids),
+        "categories": Category.line_id.in_(line_ids),
+        "subcategories": Subcategory.category_id.in_(category_ids),
+        "brands": Brand.id.in_(brand_ids),
+        "catalogs": or_(Catalog.line_id.in_(line_ids), Catalog.category_id.in_(category_ids),
+                        Catalog.subcategory_id.in_(subcategory_ids), Catalog.brand_id.in_(brand_ids)),
+    }
+
+
+def fetch_public_rows(db: Session, line_ids: Optional[List[int]] = None) -> dict:
+    """
+    Lee el árbol público con una consulta plana por tabla y sólo las columnas
+    necesarias, sin hidratar objetos ORM. Devuelve {tipo: [fila, ...]}.
+    Con `line_ids` se limita a esas líneas y sus descendientes (siguen siendo
+    cinco consultas, sin importar cuántas filas haya).
+    """
+    scope = _public_scope(line_ids) if line_ids is not None else {}
+    rows = {}
+    for kind, model in PUBLIC_MODELS.items():
+        columns = PUBLIC_FIELDS[kind] + tuple(fk for _, fk in PUBLIC_PARENTS[kind])
+        query = select(*[getattr(model, column) for column in columns]).order_by(model.id)
+        if kind in scope:
+            query = query.where(scope[kind])
+        rows[kind] = [dict(zip(columns, row)) for row in db.execute(query)]
+    return rows
+
+
+def assemble_public_lines(db: Session, request: Request, line_ids: List[int]) -> List[dict]:
+    """Árbol público (forma LinePublic) de las líneas dadas, en ese orden."""
+    if not line_ids:
+        return []
+    snapshot = CatalogSnapshot()
+    snapshot.set_base_url(request.base_url)
+    snapshot.load(fetch_public_rows(db, line_ids))
+    return snapshot.tree(line_ids)
+
+
+class CatalogSnapshot:
+    """
+    Árbol público del catálogo mantenido en memoria.
+
+    Cada mutación del CRUD se aplica sólo al nodo afectado y marca como
+    sucias las líneas que lo contienen; al regenerar el JSON se vuelven a
+    serializar únicamente esas líneas y el resto se reutiliza tal cual.
+
+    `version` es la del diario de cambios hasta la que el árbol está al día:
+    sólo la fijan load() y catch_up(), que aplican el diario sin huecos. Las
+    escrituras de este proceso se aplican en cuanto se confirman, pero no la
+    mueven (otro proceso puede haber confirmado una versión intermedia que
+    aquí aún no se ve); el árbol puede ir por delante de `version`, nunca
+    por detrás.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._nodes = {kind: {} for kind in PUBLIC_CHILDREN}
+        self._children = {kind: {} for kind in PUBLIC_CHILDREN}
+        self._fragments = {}
+        # Cambia cada vez que se descartan todos los fragmentos (recarga o nueva URL base)
+        self._generation = 0
+        self._dirty_lines = set()
+        self._base_url = None
+        self.version = 0
+        self.loaded = False
+
+    # -- Carga y mutaciones --
+
+    def invalidate(self):
+        """Descarta el árbol: la próxima regeneración lo recarga de la base de datos."""
+        with self._lock:
+            self.loaded = False
+
+    def set_base_url(self, base_url: URL):
+        with self._lock:
+            if self._base_url != base_url:
+                self._base_url = base_url
+                self._fragments.clear()
+                self._generation += 1
+
+    def load(self, rows: dict, version: Optional[int] = None):
+        """
+        Reconstruye el índice completo a partir de las filas planas de cada
+        tabla (ver fetch_public_rows), enlazando padres e hijos por id.
+        `version` es la del diario leída antes que las filas: todo lo
+        anterior ya está en ellas.
+        """
+        with self._lock:
+            if version is not None:
+                self.version = version
+            self._nodes = {kind: {node["id"]: node for node in rows[kind]} for kind in PUBLIC_CHILDREN}
+            self._children = {kind: {} for kind in PUBLIC_CHILDREN}
+            self._fragments.clear()
+            self._generation += 1
+            self._dirty_lines.clear()
+            for kind, parents in PUBLIC_PARENTS.items():
+                for node_id, node in self._nodes[kind].items():
+                    for parent_kind, fk in parents:
+                        if node[fk] is not None:
+                            self._link(kind, node_id, parent_kind, node[fk])
+            self.loaded = True
+
+    def catch_up(self, db: Session) -> bool:
+        """
+        Aplica las entradas del diario posteriores a `version`, también las
+        de otros procesos, y avanza `version` hasta la última. Devuelve False
+        si el árbol no está cargado o el diario no alcanza para ponerlo al
+        día (hay que recargarlo entero).
+        """
+        with self._lock:
+            if not self.loaded:
+                return False
+            since = self.version
+        # La consulta va fuera del candado: las escrituras de este proceso no esperan a la base
+        changes = read_journal(db, since, CHANGES_MAX_PAGE_LIMIT)
+        if changes is None or len(changes) > CHANGES_MAX_PAGE_LIMIT:
+            return False
+        with self._lock:
+            if not self.loaded:
+                return False
+            if self.version != since:
+                # Una recarga se adelantó: lo leído puede ser anterior a lo que ya tiene el árbol
+                return True
+            for change in changes:
+                if change.op == "delete":
+                    self._remove(change.kind, change.entity_id)
+                else:
+                    self._put(change.kind, json.loads(change.data))
+            if changes:
+                self.version = changes[-1].version
+            return True
+
+    def upsert(self, kind: str, row: dict, version: Optional[int] = None):
+        """
+        Inserta o actualiza un nodo con las columnas de una fila ya confirmada
+        en la versión `version` del diario; si catch_up() ya la aplicó, no hace nada.
+        """
+        with self._lock:
+            if not self.loaded or (version is not None and version <= self.version):
+                return
+            self._put(kind, row)
+
+    def remove(self, kind: str, node_id: int, version: Optional[int] = None) -> List[tuple]:
+        """
+        Elimina un nodo y, como hace el ON DELETE CASCADE de la base, todos
+        sus descendientes. Devuelve los pares (tipo, id) eliminados.
+        """
+        with self._lock:
+            if not self.loaded or (version is not None and version <= self.version):
+                return []
+            return self._remove(kind, node_id)
+
+    def _put(self, kind: str, row: dict):
+        node_id = row["id"]
+        node = {column: row.get(column) for column in PUBLIC_FIELDS[kind]}
+        node.update({fk: row.get(fk) for _, fk in PUBLIC_PARENTS[kind]})
+        previous = self._nodes[kind].get(node_id)
+        if previous is not None:
+            self._dirty_lines |= self._lines_of(kind, node_id)
+            for parent_kind, fk in PUBLIC_PARENTS[kind]:
+                if previous[fk] is not None:
+                    self._unlink(kind, node_id, parent_kind, previous[fk])
+        self._nodes[kind][node_id] = node
+        for parent_kind, fk in PUBLIC_PARENTS[kind]:
+            if node[fk] is not None:
+                self._link(kind, node_id, parent_kind, node[fk])
+        self._dirty_lines |= self._lines_of(kind, node_id)
+
+    def _remove(self, kind: str, node_id: int) -> List[tuple]:
+        if node_id not in self._nodes[kind]:
+            return []
+        self._dirty_lines |= self._lines_of(kind, node_id)
+        removed = []
+        pending = [(kind, node_id)]
+        while pending:
+            current_kind, current_id = pending.pop()
+            node = self._nodes[current_kind].pop(current_id, None)
+            if node is None:
+                continue
+            removed.append((current_kind, current_id))
+            for parent_kind, fk in PUBLIC_PARENTS[current_kind]:
+                if node[fk] is not None:
+                    self._unlink(current_kind, current_id, parent_kind, node[fk])
+            for child_kind, child_ids in self._children[current_kind].pop(current_id, {}).items():
+                pending.extend((child_kind, child_id) for child_id in child_ids)
+        return removed
+
+    def _link(self, kind: str, node_id: int, parent_kind: str, parent_id: int):
+        self._children[parent_kind].setdefault(parent_id, {}).setdefault(kind, set()).add(node_id)
+
+    def _unlink(self, kind: str, node_id: int, parent_kind: str, parent_id: int):
+        self._children[parent_kind].get(parent_id, {}).get(kind, set()).discard(node_id)
+
+    def _lines_of(self, kind: str, node_id: int) -> set:
+        """Líneas bajo las que aparece el nodo (su ruta de ancestros)."""
+        if kind == "lines":
+            return {node_id} if node_id in self._nodes["lines"] else set()
+        node = self._nodes[kind].get(node_id)
+        if node is None:
+            return set()
+        lines = set()
+        for parent_kind, fk in PUBLIC_PARENTS[kind]:
+            if node[fk] is not None:
+                lines |= self._lines_of(parent_kind, node[fk])
+        return lines
+
+    # -- Serialización --
+
+    def _copy(self, kind: str, node_id: int) -> tuple:
+        """
+        Estructura del subárbol (nodo y, en orden, sus hijos) sin serializar,
+        para renderizarla fuera del candado. Los nodos se comparten: _put()
+        los reemplaza, nunca los modifica.
+        """
+        children = self._children[kind].get(node_id, {})
+        return (kind, self._nodes[kind][node_id], [
+            (child_kind, [self._copy(child_kind, child_id)
+                          for child_id in sorted(children.get(child_kind, ()))
+                          if child_id in self._nodes[child_kind]])
+            for child_kind in PUBLIC_CHILDREN[kind]
+        ])
+
+    @staticmethod
+    def _render(copy: tuple, base_url: Optional[URL]) -> dict:
+        kind, node, children = copy
+        item = {field: node[field] for field in PUBLIC_FIELDS[kind]}
+        if kind == "catalogs":
+            item["file_url"] = None
+            if node["file_path"] and base_url is not None:
+                item["file_url"] = catalog_file_url(base_url, node["id"], node["file_path"])
+        for child_kind, child_copies in children:
+            item[child_kind] = [CatalogSnapshot._render(child, base_url) for child in child_copies]
+        return item
+
+    def tree(self, line_ids: List[int]) -> List[dict]:
+        """Subárbol de las líneas indicadas como diccionarios (forma LinePublic)."""
+        with self._lock:
+            base_url = self._base_url
+            copies = [self._copy("lines", line_id) for line_id in line_ids if line_id in self._nodes["lines"]]
+        return [self._render(copy, base_url) for copy in copies]
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        """
+        Genera catalog.json por partes, una línea a la vez. Bajo el candado
+        sólo se copia la estructura de las líneas modificadas; cada una se
+        serializa fuera de él y se entrega en cuanto está lista, así que las
+        escrituras del CRUD no esperan a la serialización.
+
+        Las líneas sin cambios reutilizan su fragmento ya serializado: el
+        proceso guarda en memoria una copia serializada de todo el catálogo
+        (más el árbol de nodos), el precio de no volver a serializarlo entero.
+        """
+        with self._lock:
+            for line_id in self._dirty_lines:
+                self._fragments.pop(line_id, None)
+            self._dirty_lines.clear()
+            version, base_url, generation = self.version, self._base_url, self._generation
+            plan = [(line_id, self._fragments.get(line_id) or self._copy("lines", line_id))
+                    for line_id in sorted(self._nodes["lines"])]
+        yield b'{"version":%d,"lines":[' % version
+        for index, (line_id, fragment) in enumerate(plan):
+            plan[index] = None
+            if not isinstance(fragment, bytes):
+                fragment = json.dumps(
+                    self._render(fragment, base_url), ensure_ascii=False, separators=(",", ":")
+                ).encode("utf-8")
+                with self._lock:
+                    # Si la línea cambió mientras se serializaba, la próxima vez se rehace
+                    if self._generation == generation and line_id not in self._dirty_lines:
+                        self._fragments[line_id] = fragment
+            if index:
+                yield b","
+            yield fragment
+        yield b"]}"
+
+    def render(self) -> bytes:
+        return b"".join(self.iter_chunks())
+
+catalog_snapshot = CatalogSnapshot()
+
+
+class PublishedCatalog:
+    """
+    Versión publicada de catalog.json: sus variantes (sin comprimir, gzip y
+    brotli) y el ETag, calculados una sola vez al publicarse.
+
+    Con `files` las variantes son copias inmutables en disco (codificación →
+    ruta) y se sirven desde ahí sin cargarlas en memoria; si no, se guardan
+    los bytes (p. ej. los leídos de catalog_snapshots).
+    """
+
+    def __init__(self, body: Optional[bytes] = None, modified_at: Optional[datetime] = None,
+                 digest: Optional[str] = None, compressed: Optional[dict] = None,
+                 version: Optional[int] = None, files: Optional[dict] = None):
+        # Versión en catalog_snapshots (None si no se guarda en la base)
+        self.version = version
+        self.modified_at = modified_at or datetime.now(timezone.utc)
+        self.files = files or {}
+        self.variants = {}
+        if self.files:
+            self.digest = digest
+        else:
+            self.digest = digest or hashlib.sha256(body).hexdigest()
+            if compressed is None:
+                compressed = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+                if brotli is not None:
+                    compressed["br"] = brotli.compress(body, quality=CATALOG_BROTLI_QUALITY)
+            self.variants = {"identity": body, **compressed}
+        self.encodings = set(self.variants) | set(self.files)
+
+    def etag(self, encoding: str) -> str:
+        if encoding == "identity":
+            return f'"{self.digest}"'
+        return f'"{self.digest}-{encoding}"'
+
+    def matches(self, if_none_match: str) -> bool:
+        if if_none_match.strip() == "*":
+            return True
+        etags = {self.etag(encoding) for encoding in self.encodings}
+        for candidate in if_none_match.split(","):
+            candidate = candidate.strip()
+            if candidate.startswith("W/"):
+                candidate = candidate[2:]
+            if candidate in etags:
+                return True
+        return False
+
+    def negotiate(self, accept_encoding: str) -> str:
+        accepted = {}
+        for part in accept_encoding.split(","):
+            coding, _, params = part.strip().partition(";")
+            q = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            if coding:
+                accepted[coding.lower()] = q
+        for encoding in ("br", "gzip"):
+            if encoding in self.encodings and accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+                return encoding
+        return "identity"
+
+
+published_catalog: Optional[PublishedCatalog] = None
+_published_stat = None
+_published_checked_at = 0.0
+_published_lock = threading.Lock()
+
+
+def catalog_variant_path(digest: str, encoding: str) -> str:
+    """Copia inmutable de una versión de catalog.json (o de una variante comprimida), nombrada por su hash."""
+    return f"{JSON_OUTPUT_PATH}.{digest}" + {"identity": "", "gzip": ".gz", "br": ".br"}[encoding]
+
+
+def prune_catalog_variants(keep: int = PUBLISHED_CATALOG_KEEP):
+    """Borra las copias de las versiones más antiguas; conserva las `keep` últimas (una petición puede estar sirviéndolas)."""
+    directory = os.path.dirname(JSON_OUTPUT_PATH)
+    prefix = os.path.basename(JSON_OUTPUT_PATH) + "."
+    versions = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(prefix):
+                digest = entry.name[len(prefix):].split(".")[0]
+                versions.setdefault(digest, []).append(entry)
+    newest = sorted(versions, key=lambda d: max(e.stat().st_mtime_ns for e in versions[d]), reverse=True)
+    for digest in newest[keep:]:
+        for entry in versions[digest]:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def publish_public_json(chunks: Iterable[bytes]):
+    """
+    Escribe catalog.json por partes en archivos temporales, calculando en la
+    misma pasada el hash y las variantes gzip y brotli, sin reunir el
+    documento en memoria. Las variantes quedan como copias inmutables
+    nombradas por el hash (catalog_variant_path) y catalog.json se renombra
+    de forma atómica: los lectores nunca ven un archivo a medio escribir.
+    Después reemplaza la versión servida, que apunta a esas copias.
+    """
+    global published_catalog, _published_stat, _published_checked_at
+    directory = os.path.dirname(JSON_OUTPUT_PATH)
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    brotli_compressor = brotli.Compressor(quality=CATALOG_BROTLI_QUALITY) if brotli is not None else None
+    tmp_paths = {}
+    try:
+        for encoding in ("identity", "gzip") + (("br",) if brotli_compressor is not None else ()):
+            fd, tmp_paths[encoding] = tempfile.mkstemp(prefix=".catalog-", suffix=".tmp", dir=directory)
+            os.close(fd)
+        with open(tmp_paths["identity"], "wb") as f, open(tmp_paths["gzip"], "wb") as gzip_file, \
+                gzip.GzipFile(fileobj=gzip_file, mode="wb", compresslevel=9, mtime=0) as gz, \
+                (open(tmp_paths["br"], "wb") if brotli_compressor is not None else nullcontext()) as br:
+            for chunk in chunks:
+                f.write(chunk)
+                digest.update(chunk)
+                gz.write(chunk)
+                if br is not None:
+                    br.write(brotli_compressor.process(chunk))
+            if br is not None:
+                br.write(brotli_compressor.finish())
+            f.flush()
+            os.fsync(f.fileno())
+        digest = digest.hexdigest()
+        files = {}
+        for encoding, tmp_path in tmp_paths.items():
+            os.chmod(tmp_path, 0o644)
+            files[encoding] = catalog_variant_path(digest, encoding)
+            if encoding != "identity":
+                os.replace(tmp_path, files[encoding])
+        # catalog.json y su copia inmutable son el mismo archivo
+        try:
+            os.link(tmp_paths["identity"], files["identity"])
+        except FileExistsError:
+            pass
+        os.replace(tmp_paths["identity"], JSON_OUTPUT_PATH)
+    except BaseException:
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        raise
+    prune_catalog_variants()
+    version = None
+    if CATALOG_SNAPSHOT_DB:
+        # La base guarda los bytes: se leen de las copias sólo para insertarlos
+        contents = {}
+        for encoding, path in files.items():
+            with open(path, "rb") as f:
+                contents[encoding] = f.read()
+        body = contents.pop("identity")
+        version = store_catalog_snapshot(body, digest, contents)
+        if version is None:
+            # La base ya tiene una versión más nueva: la próxima lectura sirve esa
+            published_catalog = None
+            return
+    published_catalog = PublishedCatalog(digest=digest, version=version, files=files)
+    _published_stat = _stat_signature(JSON_OUTPUT_PATH)
+    _published_checked_at = time.monotonic()
+
+
+_CATALOG_BODY_VERSION = re.compile(rb'\{"version":(\d+),')
+
+
+def catalog_body_version(body: bytes) -> Optional[int]:
+    """Versión del diario escrita al principio de catalog.json ({"version":N,...})."""
+    match = _CATALOG_BODY_VERSION.match(body)
+    return int(match.group(1)) if match else None
+
+
+def store_catalog_snapshot(body: bytes, digest: str, compressed: dict) -> Optional[int]:
+    """
+    Guarda la versión publicada en catalog_snapshots (con sus variantes ya
+    comprimidas, para que las demás instancias no tengan que recomprimir) y
+    borra las más antiguas. Si el contenido no cambió, no crea otra versión.
+    Se llama con el candado de construcción tomado. Devuelve la versión, o
+    None si la última guardada corresponde a una versión posterior del diario
+    (este proceso iba atrasado y no la pisa).
+    """
+    db = SessionLocal()
+    try:
+        latest = db.execute(select(StoredCatalog.version, StoredCatalog.digest,
+                                   func.substr(StoredCatalog.body, 1, 32).label("head"))
+                            .order_by(StoredCatalog.version.desc()).limit(1)).first()
+        if latest is not None and latest.digest == digest:
+            return latest.version
+        if latest is not None and (catalog_body_version(bytes(latest.head)) or 0) > (catalog_body_version(body) or 0):
+            logger.warning("catalog.json no se guarda: la base ya tiene una versión más nueva del diario.")
+            return None
+        stored = StoredCatalog(digest=digest, body=body, body_gzip=compressed["gzip"], body_br=compressed.get("br"))
+        db.add(stored)
+        db.flush()
+        db.execute(delete(StoredCatalog).where(StoredCatalog.version <= stored.version - CATALOG_SNAPSHOT_KEEP))
+        db.commit()
+        return stored.version
+    finally:
+        db.close()
+
+
+def load_stored_catalog() -> Optional[PublishedCatalog]:
+    """
+    Devuelve la última versión de catalog_snapshots. Como mucho una consulta
+    por proceso cada CATALOG_SNAPSHOT_POLL_SECONDS; el cuerpo sólo se lee
+    cuando cambia la versión. Si la base falla, se sigue sirviendo la anterior.
+    """
+    global published_catalog, _published_checked_at
+    if published_catalog is not None and time.monotonic() - _published_checked_at < CATALOG_SNAPSHOT_POLL_SECONDS:
+        return published_catalog
+    with _published_lock:
+        if published_catalog is not None and time.monotonic() - _published_checked_at < CATALOG_SNAPSHOT_POLL_SECONDS:
+            return published_catalog
+        db = SessionLocal()
+        try:
+            latest = db.scalar(select(func.max(StoredCatalog.version)))
+            if latest is not None and (published_catalog is None or published_catalog.version != latest):
+                stored = db.get(StoredCatalog, latest)
+                compressed = {"gzip": stored.body_gzip}
+                if stored.body_br is not None and brotli is not None:
+                    compressed["br"] = stored.body_br
+                modified_at = stored.created_at if stored.created_at.tzinfo else stored.created_at.replace(tzinfo=timezone.utc)
+                published_catalog = PublishedCatalog(stored.body, modified_at, stored.digest, compressed, stored.version)
+            _published_checked_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"❌ Error al leer la versión publicada de la base de datos: {e}")
+        finally:
+            db.close()
+    return published_catalog
+
+
+def _stat_signature(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def load_published_catalog() -> Optional[PublishedCatalog]:
+    """
+    Devuelve la versión publicada, recargándola del disco si otro proceso
+    reescribió catalog.json desde la última vez (o de la base, con
+    CATALOG_SNAPSHOT_DB).
+    """
+    global published_catalog, _published_stat
+    if CATALOG_SNAPSHOT_DB:
+        return load_stored_catalog()
+    signature = _stat_signature(JSON_OUTPUT_PATH)
+    if signature is None:
+        return published_catalog
+    if published_catalog is None or signature != _published_stat:
+        modified_at = datetime.fromtimestamp(signature[0] / 1e9, tz=timezone.utc)
+        # Otro proceso lo reescribió: se identifica por su hash, leyéndolo por bloques
+        digest = hashlib.sha256()
+        with open(JSON_OUTPUT_PATH, "rb") as f:
+            for block in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b""):
+                digest.update(block)
+        digest = digest.hexdigest()
+        files = {}
+        for encoding in ("identity", "gzip", "br"):
+            path = catalog_variant_path(digest, encoding)
+            if os.path.exists(path):
+                files[encoding] = path
+        if "identity" in files:
+            published_catalog = PublishedCatalog(modified_at=modified_at, digest=digest, files=files)
+        else:
+            # Sin copias inmutables (escrito por una versión anterior): se sirve desde memoria
+            with open(JSON_OUTPUT_PATH, "rb") as f:
+                published_catalog = PublishedCatalog(f.read(), modified_at)
+        _published_stat = signature
+    return published_catalog
+
+
+def write_public_json():
+    """
+    Reescribe catalog.json desde el árbol en memoria, tras ponerlo al día con
+    el diario de cambios (las escrituras de otros procesos sólo llegan por
+    ahí). Si el árbol aún no se cargó en este proceso o el diario no alcanza,
+    lo recarga entero de la base de datos. Se llama con el candado de
+    construcción tomado.
+    """
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        try:
+            caught_up = catalog_snapshot.catch_up(db)
+            if caught_up:
+                publish_public_json(catalog_snapshot.iter_chunks())
+                CATALOG_BUILD_SECONDS.observe(time.perf_counter() - started, ("incremental",))
+                logger.info(f"✅ Archivo {JSON_OUTPUT_PATH} actualizado de forma incremental.")
+        except Exception as e:
+            CATALOG_BUILD_ERRORS.inc(labels=("incremental",))
+            logger.error(f"❌ Error al escribir el JSON público: {e}")
+            return
+        if not caught_up:
+            generate_public_json(db)
+    finally:
+        db.close()
+
+
+class SharedLock:
+    """
+    Candado exclusivo entre hilos, procesos e instancias: un threading.Lock
+    entre los hilos del proceso y, entre procesos, un advisory lock de
+    PostgreSQL o, con otras bases (todos los procesos en la misma máquina),
+    un flock sobre un archivo local.
+    """
+
+    def __init__(self, lock_path: str, wait_metric: Optional[Histogram] = None):
+        self.lock_path = lock_path
+        self.wait_metric = wait_metric
+        self._thread_lock = threading.Lock()
+        self.key = int.from_bytes(hashlib.sha256(lock_path.encode()).digest()[:8], "big", signed=True)
+
+    @contextmanager
+    def hold(self, timeout: Optional[float] = None) -> Iterator[bool]:
+        """Toma el candado; con `timeout`, se rinde al vencer y entrega False."""
+        started = time.perf_counter()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._thread_lock.acquire(timeout=-1 if timeout is None else timeout):
+            yield False
+            return
+        try:
+            release = self._acquire_shared(deadline)
+            if self.wait_metric is not None:
+                self.wait_metric.observe(time.perf_counter() - started)
+            if release is None:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                release()
+        finally:
+            self._thread_lock.release()
+
+    def _wait(self, deadline: Optional[float]) -> bool:
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+        return True
+
+    def _acquire_shared(self, deadline: Optional[float]):
+        if engine.dialect.name == "postgresql":
+            return self._acquire_advisory(deadline)
+        if fcntl is None:
+            return lambda: None
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not self._wait(deadline):
+                    os.close(fd)
+                    return None
+
+        def release():
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        return release
+
+    def _acquire_advisory(self, deadline: Optional[float]):
+        # El advisory lock es de sesión: se mantiene una conexión propia mientras dura la construcción
+        conn = engine.connect()
+        try:
+            while not conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key}).scalar():
+                conn.rollback()
+                if not self._wait(deadline):
+                    conn.close()
+                    return None
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+
+        def release():
+            try:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.key})
+                conn.commit()
+            except Exception:
+                # Que la conexión no vuelva al pool con el candado tomado
+                conn.invalidate()
+            finally:
+                conn.close()
+        return release
+
+
+# Una sola construcción de catalog.json a la vez, venga del agrupador, de la
+# cola o de una petición en frío
+catalog_build_lock = SharedLock(CATALOG_BUILD_LOCK_PATH, CATALOG_BUILD_LOCK_WAIT)
+
+
+def build_catalog_once(request: Request) -> Optional[PublishedCatalog]:
+    """
+    Primera generación de catalog.json con un solo constructor: las demás
+    peticiones (de este y de otros procesos) esperan al candado y sirven lo
+    que él publique. Devuelve None si no hay versión al vencer la espera.
+    """
+    with catalog_build_lock.hold(timeout=CATALOG_BUILD_WAIT_SECONDS) as acquired:
+        published = load_published_catalog()
+        if published is None and acquired:
+            db = SessionLocal()
+            try:
+                generate_public_json(db, request)
+            finally:
+                db.close()
+            published = load_published_catalog()
+    return published
+
+
+def generate_public_json(db: Session, request: Optional[Request] = None, raise_errors: bool = False):
+    """Reconstrucción completa: recarga todo el árbol desde la base de datos."""
     logger.info("Iniciando la generación del archivo catalog.json...")
+    started = time.perf_counter()
     try:
-        lines = db.query(Line).options(
-            joinedload(Line.catalogs),
-            joinedload(Line.brands).joinedload(Brand.catalogs),
-            joinedload(Line.categories).joinedload(Category.catalogs),
-            joinedload(Line.categories).joinedload(Category.brands).joinedload(Brand.catalogs),
-            joinedload(Line.categories).joinedload(Category.subcategories).joinedload(Subcategory.catalogs),
-            joinedload(Line.categories).joinedload(Category.subcategories).joinedload(Subcategory.brands).joinedload(Brand.catalogs)
-        ).order_by(Line.id).all()
-        
-        validated_lines = [LinePublic.model_validate(line) for line in lines]
-        
-        def build_urls(item: dict):
-            if "file_path" in item and item["file_path"]:
-                item["file_url"] = str(request.base_url.replace(path=item["file_path"]))
-            
-            for key, value in item.items():
-                if isinstance(value, list):
-                    for sub_item in value:
-                        if isinstance(sub_item, dict):
-                            build_urls(sub_item)
-
-        result_lines = [line.model_dump() for line in validated_lines]
-        for line_dict in result_lines:
-            build_urls(line_dict)
-
-        os.makedirs(os.path.dirname(JSON_OUTPUT_PATH), exist_ok=True)
-        
-        with open(JSON_OUTPUT_PATH, "w", encoding="utf-8") as f:
-            json.dump({"lines": result_lines}, f, indent=4, ensure_ascii=False)
+        version = current_change_version(db)
+        rows = fetch_public_rows(db)
+        if request is not None:
+            catalog_snapshot.set_base_url(request.base_url)
+        catalog_snapshot.load(rows, version)
+        publish_public_json(catalog_snapshot.iter_chunks())
+        CATALOG_BUILD_SECONDS.observe(time.perf_counter() - started, ("full",))
         
         logger.info(f"✅ Archivo {JSON_OUTPUT_PATH} generado exitosamente.")
     except Exception as e:
+        CATALOG_BUILD_ERRORS.inc(labels=("full",))
         logger.error(f"❌ Error al generar el JSON público: {e}")
+        if raise_errors:
+            raise
+
+
+def rebuild_public_json(raise_errors: bool = False):
+    """Reconstrucción completa con una sesión propia (no la de la petición)."""
+    db = SessionLocal()
+    try:
+        generate_public_json(db, raise_errors=raise_errors)
+    finally:
+        db.close()
+
+
+class CatalogSyncScheduler:
+    """
+    Agrupa las regeneraciones incrementales de catalog.json tras el CRUD.
+
+    Todas las solicitudes que llegan dentro de la ventana (contada desde la
+    primera pendiente) se resuelven con una sola regeneración, ejecutada por
+    un único hilo. Las reconstrucciones completas no pasan por aquí: van a
+    la cola persistente (sync_jobs).
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._cond = threading.Condition()
+        self._thread = None
+        self._deadline = None
+        self.dirty = False
+        self.building = False
+        self.requested = 0
+        self.builds = 0
+        self.last_build_at = None
+        self.last_duration = None
+        self.last_error = None
+
+    def request(self):
+        with self._cond:
+            self.requested += 1
+            self.dirty = True
+            if self._deadline is None:
+                self._deadline = time.monotonic() + self.window
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="catalog-sync", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Adelanta la regeneración pendiente y espera a que termine."""
+        with self._cond:
+            if self.dirty:
+                self._deadline = time.monotonic()
+                self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self.dirty and not self.building, timeout)
+
+    def status(self) -> dict:
+        with self._cond:
+            return {
+                "pending": self.dirty,
+                "building": self.building,
+                "window_seconds": self.window,
+                "requested": self.requested,
+                "builds": self.builds,
+                "last_build_at": self.last_build_at.isoformat() if self.last_build_at else None,
+                "last_duration_ms": round(self.last_duration * 1000, 2) if self.last_duration is not None else None,
+                "last_error": self.last_error,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.dirty)
+                while time.monotonic() < self._deadline:
+                    self._cond.wait(self._deadline - time.monotonic())
+                self.dirty = False
+                self._deadline = None
+                self.building = True
+            started = time.perf_counter()
+            error = None
+            try:
+                with catalog_build_lock.hold():
+                    write_public_json()
+            except Exception as e:
+                error = str(e)
+                logger.error(f"❌ Error en la sincronización del catálogo: {e}")
+            with self._cond:
+                self.building = False
+                self.builds += 1
+                self.last_build_at = datetime.now(timezone.utc)
+                self.last_duration = time.perf_counter() - started
+                self.last_error = error
+                self._cond.notify_all()
+
+
+catalog_sync = CatalogSyncScheduler(CATALOG_SYNC_DEBOUNCE_SECONDS)
+
+
+def schedule_public_json(request: Request):
+    catalog_snapshot.set_base_url(request.base_url)
+    catalog_sync.request()
+
+
+@app.on_event("shutdown")
+def flush_catalog_sync():
+    catalog_sync.flush(timeout=30)
+
+
+# --- Diario de cambios (sincronización incremental) ---
+# Cada escritura del CRUD anota, en su misma transacción, qué entidad cambió y
+# sus campos públicos con una versión creciente (tabla catalog_changes).
+# catalog.json lleva la versión con la que se generó y GET /sync/changes
+# devuelve lo ocurrido desde entonces: el cliente descarga el árbol una vez y
+# después sólo los cambios.
+
+CHANGE_JOURNAL_LOCK_KEY = int.from_bytes(hashlib.sha256(b"catalog_changes").digest()[:8], "big", signed=True)
+
+
+def _lock_change_journal(db: Session):
+    # En PostgreSQL la versión se asigna al insertar pero sólo se ve al confirmar: los
+    # escritores se serializan hasta el commit para que nadie lea la N+1 antes que la N.
+    # SQLite ya admite un único escritor a la vez.
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": CHANGE_JOURNAL_LOCK_KEY})
+
+
+def _append_change(db: Session, change: CatalogChange) -> int:
+    _lock_change_journal(db)
+    db.add(change)
+    db.flush()
+    _compact_change_journal(db, change.version)
+    return change.version
+
+
+def _compact_change_journal(db: Session, version: int):
+    # Por clave primaria: en régimen estable cada escritura borra como mucho unas pocas filas
+    db.execute(delete(CatalogChange).where(CatalogChange.version <= version - CHANGE_JOURNAL_RETENTION))
+
+
+def record_upsert(db: Session, kind: str, record) -> int:
+    """
+    Anota el alta o modificación de `record` (ya volcado con flush) con sus
+    columnas completas, para que el índice de búsqueda también pueda seguir
+    el diario. Devuelve la versión.
+    """
+    data = {column: getattr(record, column) for column in record_columns(kind)}
+    return _append_change(db, CatalogChange(op="upsert", kind=kind, entity_id=record.id,
+                                            data=json.dumps(data, ensure_ascii=False)))
+
+
+def record_deletes(db: Session, scope: dict) -> int:
+    """
+    Anota el borrado de las filas que seleccionan las condiciones {tipo:
+    condición} (p. ej. cascade_scope), con un INSERT ... SELECT por tabla;
+    debe llamarse antes del DELETE. Devuelve la última versión.
+    """
+    _lock_change_journal(db)
+    for kind, condition in scope.items():
+        model = PUBLIC_MODELS[kind]
+        db.execute(insert(CatalogChange).from_select(
+            ["op", "kind", "entity_id"],
+            select(literal("delete"), literal(kind), model.id).where(condition).order_by(model.id),
+        ))
+    version = current_change_version(db)
+    _compact_change_journal(db, version)
+    return version
+
+
+def record_resync(db: Session) -> int:
+    """Anota un cambio en bloque (importación masiva): los clientes deben volver a descargar catalog.json."""
+    return _append_change(db, CatalogChange(op="resync"))
+
+
+def current_change_version(db: Session) -> int:
+    return db.scalar(select(func.max(CatalogChange.version))) or 0
+
+
+def read_journal(db: Session, since: int, limit: int) -> Optional[list]:
+    """
+    Entradas del diario posteriores a la versión `since`, en orden, hasta
+    `limit` + 1 (si llega la de más, quedan otras por leer). Devuelve None si
+    desde `since` no se puede reconstruir el estado: el diario ya se compactó
+    más allá, `since` es de otra base o en medio hubo una importación masiva.
+    """
+    oldest, current = db.execute(select(func.min(CatalogChange.version), func.max(CatalogChange.version))).one()
+    if since > (current or 0) or (oldest is not None and since < oldest - 1):
+        return None
+    rows = db.execute(
+        select(CatalogChange.version, CatalogChange.op, CatalogChange.kind, CatalogChange.entity_id, CatalogChange.data)
+        .where(CatalogChange.version > since).order_by(CatalogChange.version).limit(limit + 1)
+    ).all()
+    if any(row.op == "resync" for row in rows[:limit]):
+        return None
+    return rows
+
+
+def read_changes(db: Session, since: int, limit: int, base_url: URL) -> dict:
+    """
+    Cambios posteriores a la versión `since`, hasta `limit` entradas del
+    diario, con un solo registro por entidad (el último). Pide resincronizar
+    cuando read_journal no alcanza.
+    """
+    rows = read_journal(db, since, limit)
+    if rows is None:
+        return {"version": current_change_version(db), "resync": True}
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    latest = {}
+    for row in rows:
+        # Reinsertar deja cada entidad en la posición de su último cambio
+        latest.pop((row.kind, row.entity_id), None)
+        latest[(row.kind, row.entity_id)] = row
+    changes = []
+    for row in latest.values():
+        change = {"op": row.op, "kind": row.kind, "id": row.entity_id}
+        if row.op == "upsert":
+            # El diario guarda también la descripción (para el índice de búsqueda); aquí sólo lo público
+            data = json.loads(row.data)
+            columns = PUBLIC_FIELDS[row.kind] + tuple(fk for _, fk in PUBLIC_PARENTS[row.kind])
+            change["data"] = {column: data.get(column) for column in columns}
+            if row.kind == "catalogs":
+                file_path = change["data"]["file_path"]
+                change["data"]["file_url"] = catalog_file_url(base_url, row.entity_id, file_path) if file_path else None
+        changes.append(change)
+    return {"version": rows[-1].version if rows else since, "has_more": has_more, "changes": changes}
+
+
+# --- Índice de búsqueda y cola de sincronización ---
+# Viven en search.py y sync_queue.py, que importan de este módulo lo que usan
+# (igual que storage_gc.py); por eso se cargan aquí, con todo eso ya definido.
+from .search import reload_search_index, search_index  # noqa: E402
+from .sync_queue import request_full_rebuild, sync_queue_status, sync_worker  # noqa: E402
+
+
+@app.on_event("startup")
+def start_search_index():
+    reload_search_index()
+
+
+@app.on_event("startup")
+def start_sync_worker():
+    # Recoge los trabajos que quedaron en la cola antes de un reinicio
+    if SYNC_WORKER_EMBEDDED:
+        sync_worker.start()
+    else:
+        logger.info("La cola de sincronización la atiende run_worker.py (SYNC_WORKER_EMBEDDED=0).")
+
+
+@app.on_event("shutdown")
+def stop_sync_worker():
+    sync_worker.stop(timeout=30)
+
+
+# --- Importación y exportación masiva ---
+class BulkImportError(Exception):
+    """Errores de validación de una importación, todos juntos y con su ubicación."""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def parse_bulk_body(body: bytes, content_type: str) -> tuple:
+    """
+    Valida el cuerpo de una importación en una sola pasada y lo aplana en
+    registros {kind, node, parent, loc}, en el orden padre → hijo. Devuelve
+    (registros, errores) para que plan_bulk_upsert informe todo junto.
+    Acepta el árbol de catalog.json ({"lines": [...]}) o NDJSON, donde cada
+    línea es un nodo con su `kind` (y opcionalmente hijos anidados).
+    """
+    errors, roots = [], []
+    if "ndjson" in content_type:
+        for number, raw in enumerate(body.splitlines(), start=1):
+            if not raw.strip():
+                continue
+            try:
+                node = BulkNode.model_validate_json(raw)
+            except ValidationError as e:
+                errors.extend(f"línea {number}: {_validation_message(error)}" for error in e.errors())
+                continue
+            if node.kind not in PUBLIC_MODELS:
+                errors.append(f"línea {number}: kind debe ser uno de {', '.join(PUBLIC_MODELS)}")
+                continue
+            roots.append((node.kind, node, f"línea {number}"))
+    else:
+        try:
+            tree = BulkTree.model_validate_json(body)
+        except ValidationError as e:
+            raise BulkImportError([_validation_message(error) for error in e.errors()])
+        roots = [("lines", node, f"lines[{index}]") for index, node in enumerate(tree.lines)]
+
+    records = []
+    pending = [(kind, node, None, loc) for kind, node, loc in reversed(roots)]
+    while pending:
+        kind, node, parent, loc = pending.pop()
+        record = {"kind": kind, "node": node, "parent": parent, "loc": loc, "id": node.id, "has_children": False}
+        records.append(record)
+        if parent is not None:
+            parent["has_children"] = True
+        for child_kind in ("categories", "subcategories", "brands", "catalogs"):
+            children = getattr(node, child_kind)
+            if children and child_kind not in PUBLIC_CHILDREN[kind]:
+                errors.append(f"{loc}: {kind} no admite hijos de tipo {child_kind}")
+                continue
+            pending.extend((child_kind, child, record, f"{loc}.{child_kind}[{index}]")
+                           for index, child in reversed(list(enumerate(children))))
+    return records, errors
+
+
+def _validation_message(error: dict) -> str:
+    location = ".".join(str(part) for part in error["loc"])
+    return f"{location}: {error['msg']}" if location else error["msg"]
+
+
+def _existing_ids(db: Session, model, ids: set, batch_size: int = 900) -> set:
+    """Ids que ya existen en la tabla, consultados por lotes para no pasar el límite de parámetros."""
+    ids, found = sorted(ids), set()
+    for start in range(0, len(ids), batch_size):
+        found.update(db.execute(select(model.id).where(model.id.in_(ids[start:start + batch_size]))).scalars())
+    return found
+
+
+def _valid_catalog_path(file_path: str) -> bool:
+    prefix = CATALOGS_DIR.replace("\\", "/") + "/"
+    return posixpath.normpath(file_path) == file_path and file_path.startswith(prefix)
+
+
+def plan_bulk_upsert(db: Session, records: List[dict], errors: List[str]):
+    """
+    Comprueba todas las referencias con una consulta por tabla y decide, para
+    cada registro, si es una alta o una actualización. Lanza BulkImportError
+    con todos los problemas encontrados (incluidos los de `errors`).
+    """
+    wanted = {kind: set() for kind in PUBLIC_MODELS}
+    batch_ids = {kind: set() for kind in PUBLIC_MODELS}
+    for record in records:
+        node = record["node"]
+        if node.id is not None:
+            if node.id in batch_ids[record["kind"]]:
+                errors.append(f"{record['loc']}: id {node.id} repetido en la importación")
+            batch_ids[record["kind"]].add(node.id)
+            wanted[record["kind"]].add(node.id)
+        for parent_kind, fk in PUBLIC_PARENTS[record["kind"]]:
+            if getattr(node, fk) is not None:
+                wanted[parent_kind].add(getattr(node, fk))
+    existing = {kind: _existing_ids(db, PUBLIC_MODELS[kind], ids) for kind, ids in wanted.items() if ids}
+
+    for record in records:
+        kind, node, parent, loc = record["kind"], record["node"], record["parent"], record["loc"]
+        record["exists"] = node.id is not None and node.id in existing.get(kind, ())
+        if kind == "lines":
+            # Las líneas son de solo lectura: en la importación sólo sirven de ancla
+            if not record["exists"]:
+                errors.append(f"{loc}: las líneas no se crean ni modifican; indique el id de una línea existente")
+            continue
+        fields = node.model_fields_set & set(record_columns(kind)) - {"id"}
+        values = {field: getattr(node, field) for field in fields}
+        for parent_kind, fk in PUBLIC_PARENTS[kind]:
+            if fk in values and values[fk] is not None and values[fk] not in existing.get(parent_kind, ()) \
+                    and values[fk] not in batch_ids[parent_kind]:
+                errors.append(f"{loc}: {fk} {values[fk]} no existe")
+        if parent is not None:
+            values[dict(PUBLIC_PARENTS[kind])[parent["kind"]]] = parent
+        if not record["exists"]:
+            if not node.name:
+                errors.append(f"{loc}: name es obligatorio para crear")
+            parents = [fk for _, fk in PUBLIC_PARENTS[kind] if values.get(fk) is not None]
+            if not parents:
+                errors.append(f"{loc}: debe asociarse al menos a un padre ({', '.join(fk for _, fk in PUBLIC_PARENTS[kind])})")
+        if values.get("file_path") and not _valid_catalog_path(values["file_path"]):
+            errors.append(f"{loc}: file_path debe apuntar a un archivo dentro de {CATALOGS_DIR}")
+        record["values"] = values
+    if errors:
+        raise BulkImportError(errors)
+
+
+def _grouped_by_keys(rows: List[dict]) -> Iterator[List[dict]]:
+    """Agrupa filas con las mismas columnas, para que cada grupo sea un único executemany."""
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    return iter(groups.values())
+
+
+def reset_id_sequences(db: Session, models: Iterable):
+    """En PostgreSQL, adelanta la secuencia de ids tras insertar filas con id explícito."""
+    if engine.dialect.name != "postgresql":
+        return
+    for model in models:
+        table = model.__tablename__
+        db.execute(select(func.setval(f"{table}_id_seq",
+                                      select(func.coalesce(func.max(model.id), 1)).scalar_subquery())))
+
+
+def apply_bulk_upsert(db: Session, records: List[dict]) -> dict:
+    """
+    Escribe los registros ya validados en una sola transacción, tabla por
+    tabla (padres antes que hijos) y con inserciones/actualizaciones por lotes.
+    Devuelve las rutas de archivo que dejaron de usarse.
+    """
+    created = {kind: 0 for kind in PUBLIC_MODELS if kind != "lines"}
+    updated = dict(created)
+    with_explicit_ids = []
+    replaced_paths = set()
+    for kind, model in PUBLIC_MODELS.items():
+        if kind == "lines":
+            continue
+        kind_records = [record for record in records if record["kind"] == kind]
+        if not kind_records:
+            continue
+        for record in kind_records:
+            # Los padres anidados ya se escribieron: se sustituye la referencia por su id
+            for field, value in record["values"].items():
+                if isinstance(value, dict):
+                    record["values"][field] = value["id"]
+
+        updates = [{"id": record["id"], **record["values"]} for record in kind_records if record["exists"]]
+        if kind == "catalogs":
+            changed = {row["id"]: row["file_path"] for row in updates if "file_path" in row}
+            if changed:
+                replaced_paths.update(
+                    path for catalog_id, path in db.execute(
+                        select(Catalog.id, Catalog.file_path).where(Catalog.id.in_(list(changed))))
+                    if path and path != changed[catalog_id])
+        for rows in _grouped_by_keys(updates):
+            db.execute(update(model), rows)
+        updated[kind] = len(updates)
+
+        columns = [column for column in record_columns(kind) if column != "id"]
+        new_records = [record for record in kind_records if not record["exists"]]
+        with_id = [record for record in new_records if record["id"] is not None]
+        without_id = [record for record in new_records if record["id"] is None]
+        if with_id:
+            db.execute(insert(model), [{"id": record["id"], **{column: record["values"].get(column) for column in columns}}
+                                       for record in with_id])
+            with_explicit_ids.append(model)
+        # Sólo hace falta conocer el id de las altas con hijos anidados; el resto va en un executemany
+        # simple (SQLite no garantiza el orden de RETURNING con varias filas y lo haría fila a fila)
+        parents = [record for record in without_id if record["has_children"]]
+        leaves = [record for record in without_id if not record["has_children"]]
+        if parents:
+            ids = db.execute(
+                insert(model).returning(model.id, sort_by_parameter_order=True),
+                [{column: record["values"].get(column) for column in columns} for record in parents],
+            ).scalars().all()
+            for record, new_id in zip(parents, ids):
+                record["id"] = new_id
+        if leaves:
+            db.execute(insert(model), [{column: record["values"].get(column) for column in columns}
+                                       for record in leaves])
+        created[kind] = len(new_records)
+    reset_id_sequences(db, with_explicit_ids)
+    return {"created": created, "updated": updated, "replaced_paths": replaced_paths}
+
+
+def bulk_upsert(db: Session, body: bytes, content_type: str) -> dict:
+    records, errors = parse_bulk_body(body, content_type)
+    plan_bulk_upsert(db, records, errors)
+    try:
+        result = apply_bulk_upsert(db, records)
+        record_resync(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    replaced_paths = result.pop("replaced_paths")
+    if replaced_paths:
+        with blob_lock.hold():
+            for file_path in replaced_paths:
+                release_blob(db, file_path)
+    logger.info(f"Importación masiva: creados {result['created']}, actualizados {result['updated']}.")
+    return result
+
+
+def iter_export_ndjson() -> Iterator[bytes]:
+    """
+    Exporta todas las entidades como NDJSON (una por línea, padres antes que
+    hijos), leyendo por lotes con un cursor del servidor y una sesión propia.
+    El resultado puede volver a importarse tal cual.
+    """
+    db = SessionLocal()
+    try:
+        for kind, model in PUBLIC_MODELS.items():
+            columns = record_columns(kind)
+            query = select(*[getattr(model, column) for column in columns]).order_by(model.id)
+            result = db.execute(query.execution_options(yield_per=EXPORT_BATCH_ROWS))
+            for partition in result.partitions():
+                yield "".join(
+                    json.dumps({"kind": kind, **dict(zip(columns, row))}, ensure_ascii=False) + "\n"
+                    for row in partition
+                ).encode("utf-8")
+    finally:
+        db.close()
 
 # --- Endpoints ---
 
@@ -336,289 +2688,1043 @@ def read_root(request: Request):
 
 @app.get("/health", tags=["General"])
 @limiter.limit("10/minute")
-def health_check(request: Request, db: Session = Depends(get_db)):
+async def health_check(request: Request, db: AsyncDB = Depends(get_async_db)):
     try:
-        db.execute(text("SELECT 1"))
+        await db.run_sync(lambda session: session.execute(text("SELECT 1")))
         return {"status": "ok", "database": "connected"}
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"Error de base de datos: {e}")
 
+# Sin límite de velocidad (lo consulta el scraper) y async para no competir
+# por el threadpool: sólo lee contadores en memoria, nunca la base de datos
+@app.get("/metrics", tags=["General"], include_in_schema=False)
+async def metrics(request: Request):
+    if METRICS_TOKEN and not secrets.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Token de métricas inválido.")
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/catalog.json", tags=["General"])
-@limiter.limit("20/minute")
+@limiter.limit("120/minute")
 def get_public_catalog(request: Request):
-    if not os.path.exists(JSON_OUTPUT_PATH):
-        db = SessionLocal()
-        try:
-            generate_public_json(db, request)
-        finally:
-            db.close()
-        
-        if not os.path.exists(JSON_OUTPUT_PATH):
-             raise HTTPException(status_code=404, detail="El archivo de catálogo no pudo ser generado.")
+    published = load_published_catalog() or build_catalog_once(request)
+    if published is None:
+        raise HTTPException(status_code=503, detail="El catálogo se está generando; inténtalo de nuevo en unos segundos.",
+                            headers={"Retry-After": "5"})
+
+    encoding = published.negotiate(request.headers.get("accept-encoding", ""))
+    headers = {
+        "ETag": published.etag(encoding),
+        "Last-Modified": formatdate(published.modified_at.timestamp(), usegmt=True),
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and published.matches(if_none_match):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    if encoding in published.files:
+        path = published.files[encoding]
+        return CatalogFileResponse(path, 0, os.path.getsize(path), headers=headers, media_type="application/json")
+    return Response(content=published.variants[encoding], media_type="application/json", headers=headers)
+
+@app.get("/sync/changes", response_model=ChangesResponse, tags=["General"])
+@limiter.limit("120/minute")
+async def get_catalog_changes(
+    request: Request,
+    since: int = Query(..., ge=0),
+    limit: int = Query(CHANGES_PAGE_LIMIT, ge=1, le=CHANGES_MAX_PAGE_LIMIT),
+    db: AsyncDB = Depends(get_async_db),
+):
+    # `since` es el "version" de catalog.json o de la respuesta anterior
+    return await db.run_sync(read_changes, since, limit, request.base_url)
 
-    with open(JSON_OUTPUT_PATH, "r", encoding="utf-8") as f:
-        content = json.load(f)
-    return JSONResponse(content=content)
+@app.get("/search", response_model=List[SearchResult], tags=["General"])
+@limiter.limit("600/minute")
+def search_catalog(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    kind: Optional[List[str]] = Query(None),
+    db: Session = Depends(get_db),
+):
+    if kind and not set(kind) <= set(PUBLIC_MODELS):
+        raise HTTPException(status_code=400, detail=f"Tipo no válido; use: {', '.join(PUBLIC_MODELS)}.")
+    search_index.refresh(db)
+    results = search_index.search(q, limit=limit, kinds=kind)
+    for result in results:
+        file_path = result.pop("file_path")
+        result["file_url"] = catalog_file_url(request.base_url, result["id"], file_path) if file_path else None
+    return results
 
 # Endpoints de Autenticación
 @app.post("/auth/login", response_model=Token, tags=["Autenticación"])
 @limiter.limit("5/minute")
-def login_for_access_token(request: Request, form_data: UserLogin, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == form_data.email).first()
-    if not user or not pwd_context.verify(form_data.password, user.password_hash):
+async def login_for_access_token(request: Request, form_data: UserLogin, db: AsyncDB = Depends(get_async_db)):
+    user = await db.run_sync(lambda session: session.query(User).filter(User.email == form_data.email).first())
+    valid, new_hash = (False, None)
+    if user:
+        valid, new_hash = await password_hasher.verify_and_update(form_data.password, user.password_hash)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Email o contraseña incorrecta",
         )
-    access_token = jwt.encode(
-        {"sub": user.email}, SECRET_KEY, algorithm=ALGORITHM
-    )
+    if new_hash:
+        # Los parámetros de coste cambiaron: se guarda el hash rehecho de forma transparente
+        user.password_hash = new_hash
+        await db.run_sync(Session.commit)
+    access_token = create_access_token(user)
     return {"access_token": access_token, "token_type": "bearer"}
 
 # --- START: CRUD Endpoints Protegidos ---
 
+# Operaciones del CRUD sobre una Session síncrona; los handlers las ejecutan con db.run_sync
+def get_or_404(db: Session, model, record_id: int, detail: str):
+    record = db.get(model, record_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=detail)
+    return record
+
+def commit_or_400(db: Session, kind: str, record):
+    """
+    Confirma el alta o modificación de `record` junto con su entrada en el
+    diario de cambios y la deja anotada para apply_memory_changes().
+    """
+    try:
+        db.flush()
+        version = record_upsert(db, kind, record)
+        db.commit()
+    except IntegrityError:
+        # Con las claves foráneas activas, un padre inexistente se rechaza en la base
+        db.rollback()
+        raise HTTPException(status_code=400, detail="La entidad padre indicada no existe")
+    db.refresh(record)
+    row = {column: getattr(record, column) for column in record_columns(kind)}
+    db.info.setdefault("memory_changes", []).append(("upsert", kind, row, version))
+
+def create_record(db: Session, model, data: dict):
+    record = model(**data)
+    db.add(record)
+    commit_or_400(db, model.__tablename__, record)
+    return record
+
+def update_record(db: Session, model, record_id: int, data: dict, detail: str):
+    record = get_or_404(db, model, record_id, detail)
+    for key, value in data.items():
+        setattr(record, key, value)
+    commit_or_400(db, model.__tablename__, record)
+    return record
+
+def delete_subtree(db: Session, kind: str, record_id: int, detail: str) -> List[str]:
+    """
+    Borra el registro con un único DELETE; la base elimina a sus descendientes
+    (ON DELETE CASCADE). Antes se leen, en una sola consulta, las rutas de los
+    archivos afectados, que se devuelven para borrarlos fuera de la petición,
+    y se anota el borrado de todo el subárbol en el diario de cambios.
+    """
+    model = PUBLIC_MODELS[kind]
+    scope = cascade_scope(kind, record_id)
+    file_paths = db.scalars(
+        select(Catalog.file_path).distinct()
+        .where(scope["catalogs"], Catalog.file_path.isnot(None))
+    ).all()
+    version = record_deletes(db, scope)
+    if db.execute(delete(model).where(model.id == record_id)).rowcount == 0:
+        db.rollback()
+        raise HTTPException(status_code=404, detail=detail)
+    db.commit()
+    db.info.setdefault("memory_changes", []).append(("delete", kind, record_id, version))
+    return file_paths
+
+def apply_memory_changes(db: Session):
+    """
+    Aplica al árbol en memoria y al índice de búsqueda las escrituras ya
+    confirmadas en la sesión. Sus candados pueden estar tomados un rato por
+    otro hilo (publicación de catalog.json, recarga del índice), así que
+    nunca se llama desde el event loop: ahí se usa apply_changes_and_publish().
+    """
+    for op, kind, payload, version in db.info.pop("memory_changes", []):
+        if op == "delete":
+            catalog_snapshot.remove(kind, payload, version)
+            search_index.remove(kind, payload, version)
+        else:
+            catalog_snapshot.upsert(kind, payload, version)
+            search_index.upsert(kind, payload, version)
+
+async def apply_changes_and_publish(db: AsyncDB, request: Request):
+    """Tras un `db.run_sync` que escribió: actualiza la memoria en el threadpool y agenda catalog.json."""
+    await run_in_threadpool(apply_memory_changes, db.sync_session)
+    schedule_public_json(request)
+
 # CRUD para Líneas (Solo lectura)
 @app.get("/lines", response_model=List[LinePublic], tags=["Administración - Líneas"])
-def get_lines(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    return db.query(Line).all()
+async def get_lines(
+    request: Request, response: Response,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    sort: str = Query("id", pattern="^(id|name)$"),
+    name_prefix: Optional[str] = None,
+    db: AsyncDB = Depends(get_async_db),
+    current_user: User = Depends(get_current_user),
+):
+    def run(session: Session):
+        lines = paginate(session, Line, request, response, limit=limit, cursor=cursor, sort=sort,
+                         name_prefix=name_prefix)
+        return assemble_public_lines(session, request, [line.id for line in lines])
+    return await db.run_sync(run)
 
 @app.get("/lines/{line_id}", response_model=LinePublic, tags=["Administración - Líneas"])
-def get_line(line_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_line = db.query(Line).filter(Line.id == line_id).first()
-    if not db_line:
+async def get_line(line_id: int, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    lines = await db.run_sync(assemble_public_lines, request, [line_id])
+    if not lines:
         raise HTTPException(status_code=404, detail="Línea no encontrada")
-    return db_line
+    return lines[0]
 
 # CRUD para Categorías
 @app.post("/categories", response_model=CategoryResponse, status_code=status.HTTP_201_CREATED, tags=["Administración - Categorías"])
-def create_category(category: CategoryCreate, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_category = Category(**category.model_dump())
-    db.add(db_category)
-    db.commit()
-    db.refresh(db_category)
-    background_tasks.add_task(generate_public_json, db, request)
+async def create_category(category: CategoryCreate, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    db_category = await db.run_sync(create_record, Category, category.model_dump())
+    await apply_changes_and_publish(db, request)
     return db_category
 
 @app.get("/categories", response_model=List[CategoryResponse], tags=["Administración - Categorías"])
-def get_categories(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    return db.query(Category).all()
+async def get_categories(
+    request: Request, response: Response,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    sort: str = Query("id", pattern="^(id|name)$"),
+    name_prefix: Optional[str] = None,
+    line_id: Optional[int] = None,
+    db: AsyncDB = Depends(get_async_db),
+    current_user: User = Depends(get_current_user),
+):
+    return await db.run_sync(paginate, Category, request, response, limit=limit, cursor=cursor, sort=sort,
+                            name_prefix=name_prefix, line_id=line_id)
 
 @app.get("/categories/{category_id}", response_model=CategoryResponse, tags=["Administración - Categorías"])
-def get_category(category_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_category = db.query(Category).filter(Category.id == category_id).first()
-    if not db_category:
-        raise HTTPException(status_code=404, detail="Categoría no encontrada")
-    return db_category
+async def get_category(category_id: int, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    return await db.run_sync(get_or_404, Category, category_id, "Categoría no encontrada")
 
 @app.put("/categories/{category_id}", response_model=CategoryResponse, tags=["Administración - Categorías"])
-def update_category(category_id: int, category_data: CategoryUpdate, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_category = db.query(Category).filter(Category.id == category_id).first()
-    if not db_category:
-        raise HTTPException(status_code=404, detail="Categoría no encontrada")
-    for key, value in category_data.model_dump(exclude_unset=True).items():
-        setattr(db_category, key, value)
-    db.commit()
-    db.refresh(db_category)
-    background_tasks.add_task(generate_public_json, db, request)
+async def update_category(category_id: int, category_data: CategoryUpdate, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    db_category = await db.run_sync(update_record, Category, category_id, category_data.model_dump(exclude_unset=True), "Categoría no encontrada")
+    await apply_changes_and_publish(db, request)
     return db_category
 
 @app.delete("/categories/{category_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Administración - Categorías"])
-def delete_category(category_id: int, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_category = db.query(Category).filter(Category.id == category_id).first()
-    if not db_category:
-        raise HTTPException(status_code=404, detail="Categoría no encontrada")
-    db.delete(db_category)
-    db.commit()
-    background_tasks.add_task(generate_public_json, db, request)
+async def delete_category(category_id: int, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    file_cleanup.enqueue(await db.run_sync(delete_subtree, "categories", category_id, "Categoría no encontrada"))
+    await apply_changes_and_publish(db, request)
     return
 
 # CRUD para Subcategorías
 @app.post("/subcategories", response_model=SubcategoryResponse, status_code=status.HTTP_201_CREATED, tags=["Administración - Subcategorías"])
-def create_subcategory(subcategory: SubcategoryCreate, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_subcategory = Subcategory(**subcategory.model_dump())
-    db.add(db_subcategory)
-    db.commit()
-    db.refresh(db_subcategory)
-    background_tasks.add_task(generate_public_json, db, request)
+async def create_subcategory(subcategory: SubcategoryCreate, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    db_subcategory = await db.run_sync(create_record, Subcategory, subcategory.model_dump())
+    await apply_changes_and_publish(db, request)
     return db_subcategory
 
 @app.get("/subcategories", response_model=List[SubcategoryResponse], tags=["Administración - Subcategorías"])
-def get_subcategories(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    return db.query(Subcategory).all()
+async def get_subcategories(
+    request: Request, response: Response,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    sort: str = Query("id", pattern="^(id|name)$"),
+    name_prefix: Optional[str] = None,
+    category_id: Optional[int] = None,
+    db: AsyncDB = Depends(get_async_db),
+    current_user: User = Depends(get_current_user),
+):
+    return await db.run_sync(paginate, Subcategory, request, response, limit=limit, cursor=cursor, sort=sort,
+                            name_prefix=name_prefix, category_id=category_id)
 
 @app.get("/subcategories/{subcategory_id}", response_model=SubcategoryResponse, tags=["Administración - Subcategorías"])
-def get_subcategory(subcategory_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_subcategory = db.query(Subcategory).filter(Subcategory.id == subcategory_id).first()
-    if not db_subcategory:
-        raise HTTPException(status_code=404, detail="Subcategoría no encontrada")
-    return db_subcategory
+async def get_subcategory(subcategory_id: int, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    return await db.run_sync(get_or_404, Subcategory, subcategory_id, "Subcategoría no encontrada")
 
 @app.put("/subcategories/{subcategory_id}", response_model=SubcategoryResponse, tags=["Administración - Subcategorías"])
-def update_subcategory(subcategory_id: int, subcategory_data: SubcategoryUpdate, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_subcategory = db.query(Subcategory).filter(Subcategory.id == subcategory_id).first()
-    if not db_subcategory:
-        raise HTTPException(status_code=404, detail="Subcategoría no encontrada")
-    for key, value in subcategory_data.model_dump(exclude_unset=True).items():
-        setattr(db_subcategory, key, value)
-    db.commit()
-    db.refresh(db_subcategory)
-    background_tasks.add_task(generate_public_json, db, request)
+async def update_subcategory(subcategory_id: int, subcategory_data: SubcategoryUpdate, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    db_subcategory = await db.run_sync(update_record, Subcategory, subcategory_id, subcategory_data.model_dump(exclude_unset=True), "Subcategoría no encontrada")
+    await apply_changes_and_publish(db, request)
     return db_subcategory
 
 @app.delete("/subcategories/{subcategory_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Administración - Subcategorías"])
-def delete_subcategory(subcategory_id: int, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_subcategory = db.query(Subcategory).filter(Subcategory.id == subcategory_id).first()
-    if not db_subcategory:
-        raise HTTPException(status_code=404, detail="Subcategoría no encontrada")
-    db.delete(db_subcategory)
-    db.commit()
-    background_tasks.add_task(generate_public_json, db, request)
+async def delete_subcategory(subcategory_id: int, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    file_cleanup.enqueue(await db.run_sync(delete_subtree, "subcategories", subcategory_id, "Subcategoría no encontrada"))
+    await apply_changes_and_publish(db, request)
     return
 
 # CRUD para Marcas
 @app.post("/brands", response_model=BrandResponse, status_code=status.HTTP_201_CREATED, tags=["Administración - Marcas"])
-def create_brand(brand: BrandCreate, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_brand(brand: BrandCreate, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
     if not any([brand.line_id, brand.category_id, brand.subcategory_id]):
         raise HTTPException(status_code=400, detail="La marca debe estar asociada al menos a una línea, categoría o subcategoría.")
-    db_brand = Brand(**brand.model_dump())
-    db.add(db_brand)
-    db.commit()
-    db.refresh(db_brand)
-    background_tasks.add_task(generate_public_json, db, request)
+    db_brand = await db.run_sync(create_record, Brand, brand.model_dump())
+    await apply_changes_and_publish(db, request)
     return db_brand
 
 @app.get("/brands", response_model=List[BrandResponse], tags=["Administración - Marcas"])
-def get_brands(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    return db.query(Brand).all()
+async def get_brands(
+    request: Request, response: Response,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    sort: str = Query("id", pattern="^(id|name)$"),
+    name_prefix: Optional[str] = None,
+    line_id: Optional[int] = None,
+    category_id: Optional[int] = None,
+    subcategory_id: Optional[int] = None,
+    db: AsyncDB = Depends(get_async_db),
+    current_user: User = Depends(get_current_user),
+):
+    return await db.run_sync(paginate, Brand, request, response, limit=limit, cursor=cursor, sort=sort,
+                            name_prefix=name_prefix, line_id=line_id, category_id=category_id,
+                            subcategory_id=subcategory_id)
 
 @app.get("/brands/{brand_id}", response_model=BrandResponse, tags=["Administración - Marcas"])
-def get_brand(brand_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_brand = db.query(Brand).filter(Brand.id == brand_id).first()
-    if not db_brand:
-        raise HTTPException(status_code=404, detail="Marca no encontrada")
-    return db_brand
+async def get_brand(brand_id: int, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    return await db.run_sync(get_or_404, Brand, brand_id, "Marca no encontrada")
 
 @app.put("/brands/{brand_id}", response_model=BrandResponse, tags=["Administración - Marcas"])
-def update_brand(brand_id: int, brand_data: BrandUpdate, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_brand = db.query(Brand).filter(Brand.id == brand_id).first()
-    if not db_brand:
-        raise HTTPException(status_code=404, detail="Marca no encontrada")
-    for key, value in brand_data.model_dump(exclude_unset=True).items():
-        setattr(db_brand, key, value)
-    db.commit()
-    db.refresh(db_brand)
-    background_tasks.add_task(generate_public_json, db, request)
+async def update_brand(brand_id: int, brand_data: BrandUpdate, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    db_brand = await db.run_sync(update_record, Brand, brand_id, brand_data.model_dump(exclude_unset=True), "Marca no encontrada")
+    await apply_changes_and_publish(db, request)
     return db_brand
 
 @app.delete("/brands/{brand_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Administración - Marcas"])
-def delete_brand(brand_id: int, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_brand = db.query(Brand).filter(Brand.id == brand_id).first()
-    if not db_brand:
-        raise HTTPException(status_code=404, detail="Marca no encontrada")
-    db.delete(db_brand)
-    db.commit()
-    background_tasks.add_task(generate_public_json, db, request)
+async def delete_brand(brand_id: int, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    file_cleanup.enqueue(await db.run_sync(delete_subtree, "brands", brand_id, "Marca no encontrada"))
+    await apply_changes_and_publish(db, request)
     return
 
 # CRUD para Catálogos
-@app.post("/upload/catalog", response_model=CatalogResponse, tags=["Administración - Catálogos"])
+# --- Almacenamiento de archivos por contenido ---
+# Cada archivo se guarda una sola vez en static/catalogs/<sha[:2]>/<sha256><ext>;
+# varias filas de catalogs pueden apuntar a la misma ruta y el archivo sólo se
+# borra cuando desaparece la última referencia. blob_lock serializa, entre
+# todos los procesos, la decisión de reutilizar un archivo (y confirmar su
+# fila) con la de borrarlo por no tener referencias.
+blob_lock = SharedLock(BLOB_LOCK_PATH)
+
+
+def blob_extension(filename: Optional[str]) -> str:
+    extension = os.path.splitext(filename or "")[1].lower()
+    return extension if re.fullmatch(r"\.[a-z0-9]{1,10}", extension) else ""
+
+
+def blob_path(sha256: str, extension: str) -> str:
+    return os.path.join(CATALOGS_DIR, sha256[:2], f"{sha256}{extension}").replace("\\", "/")
+
+
+def blob_digest(file_path: Optional[str]) -> Optional[str]:
+    """SHA-256 codificado en el nombre del archivo, o None si no es un archivo por contenido."""
+    match = re.fullmatch(r"([0-9a-f]{64})(\.[a-z0-9]{1,10})?", os.path.basename(file_path or ""))
+    return match.group(1) if match else None
+
+
+def catalog_file_url(base_url: URL, catalog_id: int, file_path: str) -> str:
+    """
+    URL pública de descarga. Los archivos por contenido llevan ?v=<sha256>,
+    de modo que la URL cambia con el contenido y puede cachearse para siempre.
+    """
+    digest = blob_digest(file_path)
+    return str(base_url.replace(path=f"/catalogs/{catalog_id}/file", query=f"v={digest}" if digest else ""))
+
+
+class StreamedUpload:
+    """
+    Lee un multipart/form-data directamente del stream de la petición. Los
+    campos de texto quedan en `fields`; la parte del archivo se escribe por
+    bloques en un temporal de uploads/ (no servido), calculando SHA-256 y tamaño en
+    la misma pasada. No hay copia intermedia (UploadFile ya volcaba todo el
+    cuerpo a su propio temporal) y la escritura se hace fuera del event loop.
+    """
+
+    def __init__(self, file_field: str):
+        self.file_field = file_field
+        self.fields = {}
+        self.filename = None
+        self.tmp_path = None
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._file = None
+        self._buffer = bytearray()
+        self._header_field = bytearray()
+        self._header_value = bytearray()
+        self._headers = {}
+        self._part = None
+
+    @property
+    def sha256(self) -> str:
+        return self._digest.hexdigest()
+
+    async def receive(self, request: Request):
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or not params.get(b"boundary"):
+            raise HTTPException(status_code=400, detail="Se esperaba un formulario multipart/form-data.")
+        parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": lambda data, start, end: self._header_field.extend(data[start:end]),
+            "on_header_value": lambda data, start, end: self._header_value.extend(data[start:end]),
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+        try:
+            async for piece in request.stream():
+                try:
+                    parser.write(piece)
+                except MultipartParseError:
+                    raise HTTPException(status_code=400, detail="Formulario multipart mal formado.")
+                if len(self._buffer) >= UPLOAD_CHUNK_BYTES:
+                    await run_in_threadpool(self._flush)
+            parser.finalize()
+            if self.filename is not None:
+                await run_in_threadpool(self._flush, True)
+        except BaseException:
+            await run_in_threadpool(self.discard)
+            raise
+
+    def discard(self):
+        """Borra el temporal (p. ej. si la subida no llega a guardarse)."""
+        if self._file is not None:
+            self._file.close()
+        if self.tmp_path and os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+    def _on_part_begin(self):
+        self._headers = {}
+        self._part = None
+
+    def _on_header_end(self):
+        self._headers[bytes(self._header_field).lower()] = bytes(self._header_value)
+        self._header_field.clear()
+        self._header_value.clear()
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        if name == self.file_field and b"filename" in options:
+            if self.filename is not None:
+                raise HTTPException(status_code=400, detail="Sólo se admite un archivo por subida.")
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+            self._part = None
+        else:
+            self._part = (name, bytearray())
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._part is not None:
+            if len(self._part[1]) + end - start > UPLOAD_FORM_OVERHEAD_BYTES:
+                raise HTTPException(status_code=413, detail=f"El campo {self._part[0]} es demasiado largo.")
+            self._part[1].extend(data[start:end])
+            return
+        self.size += end - start
+        if self.size > CATALOG_UPLOAD_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=_upload_too_large_detail())
+        self._buffer.extend(data[start:end])
+
+    def _on_part_end(self):
+        if self._part is not None:
+            name, value = self._part
+            self.fields[name] = value.decode("utf-8", "replace")
+            self._part = None
+
+    def _flush(self, close: bool = False):
+        if self._file is None:
+            # Fuera de static (no se sirve a medio escribir) pero en el mismo sistema de archivos: os.replace sigue siendo atómico
+            os.makedirs(UPLOAD_SESSIONS_DIR, exist_ok=True)
+            fd, self.tmp_path = tempfile.mkstemp(prefix=".upload-", suffix=".tmp", dir=UPLOAD_SESSIONS_DIR)
+            self._file = os.fdopen(fd, "wb")
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        self._digest.update(data)
+        self._file.write(data)
+        if close:
+            self._file.close()
+
+
+def commit_blob(tmp_path: str, sha256: str, extension: str) -> str:
+    """
+    Mueve el temporal a su ruta por contenido. Si ese contenido ya estaba
+    guardado, el temporal se descarta sin reescribir el archivo existente.
+    Llamar con blob_lock tomado.
+    """
+    file_path = blob_path(sha256, extension)
+    if os.path.exists(file_path):
+        os.unlink(tmp_path)
+        logger.info(f"Archivo {file_path} ya existente; se reutiliza.")
+        return file_path
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+def blob_references(db: Session, file_path: str) -> int:
+    return db.query(func.count(Catalog.id)).filter(Catalog.file_path == file_path).scalar()
+
+
+def release_blob(db: Session, file_path: Optional[str]):
+    """Borra el archivo si ya ninguna fila de catalogs lo referencia. Llamar con blob_lock tomado."""
+    if not file_path:
+        return
+    remaining = blob_references(db, file_path)
+    if remaining:
+        logger.info(f"Archivo {file_path} conservado ({remaining} referencias restantes).")
+        return
+    if os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+            logger.info(f"Archivo {file_path} eliminado del servidor.")
+        except OSError as e:
+            logger.error(f"Error al eliminar el archivo {file_path}: {e}")
+
+
+class FileCleanupWorker:
+    """
+    Borra en segundo plano los archivos de los catálogos eliminados.
+
+    Las rutas se procesan por lotes en un único hilo: por lote, una consulta
+    descarta las que otra fila de catalogs sigue referenciando (archivos por
+    contenido compartidos) y el resto se borra bajo blob_lock, de modo que
+    no compite con una subida que esté reutilizando el mismo archivo.
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = max(1, batch_size)
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()
+        self._thread = None
+        self.busy = False
+
+    def enqueue(self, file_paths: Iterable[str]):
+        with self._cond:
+            for file_path in file_paths:
+                self._pending[file_path] = None
+            if not self._pending:
+                return
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="file-cleanup", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Espera a que se procesen todas las rutas pendientes."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self.busy, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                batch = [self._pending.popitem(last=False)[0]
+                         for _ in range(min(self.batch_size, len(self._pending)))]
+                self.busy = True
+            try:
+                self._delete_batch(batch)
+            except Exception as e:
+                FILE_CLEANUP.inc(len(batch), ("error",))
+                logger.error(f"❌ Error en la limpieza de archivos: {e}")
+            with self._cond:
+                self.busy = False
+                self._cond.notify_all()
+
+    def _delete_batch(self, file_paths: List[str]):
+        db = SessionLocal()
+        try:
+            with blob_lock.hold():
+                referenced = set()
+                # Por tramos: SQLite limita el número de parámetros por sentencia
+                for start in range(0, len(file_paths), 900):
+                    chunk = file_paths[start:start + 900]
+                    referenced.update(db.scalars(select(Catalog.file_path).distinct()
+                                                 .where(Catalog.file_path.in_(chunk))))
+                db.rollback()
+                for file_path in file_paths:
+                    if file_path in referenced:
+                        FILE_CLEANUP.inc(labels=("kept",))
+                        continue
+                    try:
+                        os.remove(file_path)
+                        FILE_CLEANUP.inc(labels=("deleted",))
+                    except FileNotFoundError:
+                        FILE_CLEANUP.inc(labels=("missing",))
+                    except OSError as e:
+                        FILE_CLEANUP.inc(labels=("error",))
+                        logger.error(f"Error al eliminar el archivo {file_path}: {e}")
+        finally:
+            db.close()
+        logger.info(f"Limpieza de archivos: {len(file_paths) - len(referenced)} eliminados, "
+                    f"{len(referenced)} conservados por seguir referenciados.")
+
+
+file_cleanup = FileCleanupWorker(FILE_CLEANUP_BATCH_SIZE)
+
+
+@app.on_event("shutdown")
+def flush_file_cleanup():
+    file_cleanup.flush(timeout=30)
+
+
+def save_uploaded_catalog(db: Session, new_catalog: Catalog, tmp_path: str, sha256: str, extension: str):
+    """Publica el archivo subido y crea su fila de Catalog bajo el mismo candado."""
+    with blob_lock.hold():
+        new_catalog.file_path = commit_blob(tmp_path, sha256, extension)
+        try:
+            save_new_catalog(db, new_catalog)
+        except Exception:
+            db.rollback()
+            release_blob(db, new_catalog.file_path)
+            raise
+    apply_memory_changes(db)
+
+
+def save_new_catalog(db: Session, new_catalog: Catalog):
+    db.add(new_catalog)
+    commit_or_400(db, "catalogs", new_catalog)
+
+
+def _upload_form_schema() -> dict:
+    # El cuerpo se lee a mano (StreamedUpload): se documenta el formulario para /docs
+    schema = CatalogUploadForm.model_json_schema()
+    schema["properties"] = {"file": {"type": "string", "format": "binary", "title": "File"}, **schema["properties"]}
+    schema["required"] = ["file", *schema.get("required", [])]
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": schema}}}}
+
+
+@app.post("/upload/catalog", response_model=CatalogResponse, tags=["Administración - Catálogos"],
+          openapi_extra=_upload_form_schema())
 @limiter.limit("10/minute")
 async def upload_catalog(
     request: Request,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
-    file: UploadFile = File(...),
-    name: str = Form(...),
-    description: Optional[str] = Form(None),
-    line_id: Optional[int] = Form(None),
-    category_id: Optional[int] = Form(None),
-    subcategory_id: Optional[int] = Form(None),
-    brand_id: Optional[int] = Form(None),
 ):
-    if not any([line_id, category_id, subcategory_id, brand_id]):
-        raise HTTPException(status_code=400, detail="Debe asociar el catálogo al menos a una línea, categoría, subcategoría o marca.")
-
-    os.makedirs(CATALOGS_DIR, exist_ok=True)
-    safe_filename = f"{secrets.token_hex(8)}_{file.filename.replace(' ', '_')}"
-    file_path = os.path.join(CATALOGS_DIR, safe_filename)
-    
+    upload = StreamedUpload("file")
+    await upload.receive(request)
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-    finally:
-        file.file.close()
-
-    new_catalog = Catalog(
-        name=name,
-        description=description,
-        file_path=file_path.replace("\\", "/"),
-        line_id=line_id,
-        category_id=category_id,
-        subcategory_id=subcategory_id,
-        brand_id=brand_id,
-    )
-    db.add(new_catalog)
-    db.commit()
-    db.refresh(new_catalog)
+        # Como con Form(...), un campo vacío cuenta como no enviado
+        fields = {key: value for key, value in upload.fields.items() if value != ""}
+        errors = [] if upload.filename is not None else [
+            {"type": "missing", "loc": ("body", "file"), "msg": "Field required", "input": None}]
+        try:
+            form = CatalogUploadForm.model_validate(fields)
+        except ValidationError as e:
+            errors += [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        if errors:
+            raise RequestValidationError(errors)
+        if not any([form.line_id, form.category_id, form.subcategory_id, form.brand_id]):
+            raise HTTPException(status_code=400, detail="Debe asociar el catálogo al menos a una línea, categoría, subcategoría o marca.")
+    except Exception:
+        await run_in_threadpool(upload.discard)
+        raise
+    logger.info(f"Archivo {upload.filename} recibido ({upload.size} bytes, sha256={upload.sha256}).")
+
+    new_catalog = Catalog(**form.model_dump())
+    await run_in_threadpool(save_uploaded_catalog, db, new_catalog, upload.tmp_path, upload.sha256,
+                            blob_extension(upload.filename))
     
-    background_tasks.add_task(generate_public_json, db, request)
+    schedule_public_json(request)
     
     return new_catalog
 
+# Subidas reanudables por partes
+def _upload_part_path(session_id: str) -> str:
+    return os.path.join(UPLOAD_SESSIONS_DIR, f"{session_id}.part")
+
+def _upload_session_total_chunks(session: UploadSession) -> int:
+    return -(-session.size // session.chunk_size)
+
+def _upload_session_response(session: UploadSession) -> UploadSessionResponse:
+    ranges = []
+    for chunk in session.chunks:
+        if ranges and ranges[-1][1] == chunk.index - 1:
+            ranges[-1][1] = chunk.index
+        else:
+            ranges.append([chunk.index, chunk.index])
+    total = _upload_session_total_chunks(session)
+    return UploadSessionResponse(
+        id=session.id, filename=session.filename, size=session.size, chunk_size=session.chunk_size,
+        total_chunks=total, received=ranges, missing_chunks=total - len(session.chunks),
+    )
+
+def _get_upload_session(db: Session, session_id: str) -> UploadSession:
+    session = db.query(UploadSession).filter(UploadSession.id == session_id).first()
+    if not session:
+        raise HTTPException(status_code=404, detail="Sesión de subida no encontrada")
+    return session
+
+def _discard_upload_session(db: Session, session: UploadSession):
+    part_path = _upload_part_path(session.id)
+    db.delete(session)
+    db.commit()
+    if os.path.exists(part_path):
+        os.remove(part_path)
+
+def purge_expired_upload_sessions(db: Session):
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+    for session in db.query(UploadSession).filter(UploadSession.created_at < cutoff).all():
+        logger.info(f"Sesión de subida {session.id} expirada; se descarta.")
+        _discard_upload_session(db, session)
+
+def _create_upload_session(db: Session, data: UploadSessionCreate) -> UploadSessionResponse:
+    purge_expired_upload_sessions(db)
+    session = UploadSession(id=secrets.token_hex(16),
+                            chunk_size=data.chunk_size or DEFAULT_UPLOAD_SESSION_CHUNK_BYTES,
+                            **data.model_dump(exclude={"chunk_size"}))
+    os.makedirs(UPLOAD_SESSIONS_DIR, exist_ok=True)
+    with open(_upload_part_path(session.id), "wb") as f:
+        f.truncate(session.size)
+    db.add(session)
+    db.commit()
+    db.refresh(session)
+    return _upload_session_response(session)
+
+def _upload_session_closed() -> HTTPException:
+    return HTTPException(status_code=409, detail="La sesión de subida ya se está finalizando o se descartó.")
+
+def _record_upload_chunk(db: Session, session_id: str, index: int, size: int):
+    # Una parte que termina cuando la finalización ya empezó puede no estar en el archivo publicado
+    finalizing = db.execute(select(UploadSession.finalizing_at).where(UploadSession.id == session_id)).first()
+    if finalizing is None or finalizing[0] is not None:
+        db.rollback()
+        raise _upload_session_closed()
+    try:
+        db.merge(UploadChunk(session_id=session_id, index=index, size=size))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise _upload_session_closed()
+
+def _copy_upload_part(part_path: str) -> tuple:
+    """
+    Copia la parte ensamblada a un temporal y calcula en la misma pasada el
+    SHA-256 de lo copiado: el archivo publicado tiene exactamente los bytes
+    con los que se nombra, aunque una petición tardía siga escribiendo en la
+    parte. Devuelve (ruta del temporal, sha256).
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=".upload-", suffix=".tmp", dir=UPLOAD_SESSIONS_DIR)
+    digest = hashlib.sha256()
+    try:
+        with open(part_path, "rb") as src, os.fdopen(fd, "wb") as dst:
+            while True:
+                block = src.read(UPLOAD_CHUNK_BYTES)
+                if not block:
+                    break
+                digest.update(block)
+                dst.write(block)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest()
+
+def _finalize_upload_session(db: Session, session_id: str) -> Catalog:
+    session = _get_upload_session(db, session_id)
+    missing = _upload_session_total_chunks(session) - len(session.chunks)
+    if missing:
+        raise HTTPException(status_code=409, detail=f"Faltan {missing} partes por subir.")
+    # Actualización condicional: una sola finalización a la vez y, desde aquí, las partes se rechazan
+    claimed = db.execute(update(UploadSession)
+                         .where(UploadSession.id == session_id, UploadSession.finalizing_at.is_(None))
+                         .values(finalizing_at=func.now())).rowcount
+    db.commit()
+    if not claimed:
+        raise _upload_session_closed()
+    try:
+        try:
+            tmp_path, sha256 = _copy_upload_part(_upload_part_path(session_id))
+        except FileNotFoundError:
+            raise _upload_session_closed()
+        try:
+            if session.sha256 and session.sha256.lower() != sha256:
+                raise HTTPException(status_code=400, detail="El SHA-256 del archivo ensamblado no coincide con el declarado.")
+            new_catalog = Catalog(
+                name=session.name,
+                description=session.description,
+                line_id=session.line_id,
+                category_id=session.category_id,
+                subcategory_id=session.subcategory_id,
+                brand_id=session.brand_id,
+            )
+            save_uploaded_catalog(db, new_catalog, tmp_path, sha256, blob_extension(session.filename))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    except BaseException:
+        # La sesión vuelve a aceptar partes y puede finalizarse de nuevo
+        db.rollback()
+        db.execute(update(UploadSession).where(UploadSession.id == session_id).values(finalizing_at=None))
+        db.commit()
+        raise
+    _discard_upload_session(db, session)
+    return new_catalog
+
+@app.post("/upload/sessions", response_model=UploadSessionResponse, status_code=status.HTTP_201_CREATED, tags=["Administración - Catálogos"])
+@limiter.limit("10/minute")
+def create_upload_session(request: Request, data: UploadSessionCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    if not any([data.line_id, data.category_id, data.subcategory_id, data.brand_id]):
+        raise HTTPException(status_code=400, detail="Debe asociar el catálogo al menos a una línea, categoría, subcategoría o marca.")
+    if data.size > CATALOG_UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=_upload_too_large_detail())
+    return _create_upload_session(db, data)
+
+@app.get("/upload/sessions/{session_id}", response_model=UploadSessionResponse, tags=["Administración - Catálogos"])
+def get_upload_session(session_id: str, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    return _upload_session_response(_get_upload_session(db, session_id))
+
+@app.put("/upload/sessions/{session_id}/chunks/{index}", response_model=UploadSessionResponse, tags=["Administración - Catálogos"])
+async def put_upload_chunk(session_id: str, index: int, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    session = await run_in_threadpool(_get_upload_session, db, session_id)
+    if session.finalizing_at is not None:
+        raise _upload_session_closed()
+    if not 0 <= index < _upload_session_total_chunks(session):
+        raise HTTPException(status_code=400, detail="Número de parte fuera de rango.")
+    offset = index * session.chunk_size
+    expected = min(session.chunk_size, session.size - offset)
+    try:
+        fd = await run_in_threadpool(os.open, _upload_part_path(session.id), os.O_WRONLY)
+    except FileNotFoundError:
+        raise _upload_session_closed()
+    written = 0
+    buffer = bytearray()
+    try:
+        async for piece in request.stream():
+            if written + len(buffer) + len(piece) > expected:
+                raise HTTPException(status_code=400, detail=f"La parte {index} debe medir {expected} bytes.")
+            buffer += piece
+            if len(buffer) >= UPLOAD_CHUNK_BYTES:
+                await run_in_threadpool(os.pwrite, fd, bytes(buffer), offset + written)
+                written += len(buffer)
+                buffer.clear()
+        if buffer:
+            await run_in_threadpool(os.pwrite, fd, bytes(buffer), offset + written)
+            written += len(buffer)
+    finally:
+        await run_in_threadpool(os.close, fd)
+    if written != expected:
+        raise HTTPException(status_code=400, detail=f"La parte {index} debe medir {expected} bytes.")
+    await run_in_threadpool(_record_upload_chunk, db, session.id, index, written)
+    await run_in_threadpool(db.refresh, session)
+    return _upload_session_response(session)
+
+@app.post("/upload/sessions/{session_id}/finalize", response_model=CatalogResponse, tags=["Administración - Catálogos"])
+def finalize_upload_session(session_id: str, request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    new_catalog = _finalize_upload_session(db, session_id)
+    schedule_public_json(request)
+    return new_catalog
+
+@app.delete("/upload/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Administración - Catálogos"])
+def delete_upload_session(session_id: str, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    _discard_upload_session(db, _get_upload_session(db, session_id))
+    return
+
 @app.get("/catalogs", response_model=List[CatalogResponse], tags=["Administración - Catálogos"])
-def get_catalogs(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    return db.query(Catalog).all()
+async def get_catalogs(
+    request: Request, response: Response,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    sort: str = Query("id", pattern="^(id|name)$"),
+    name_prefix: Optional[str] = None,
+    line_id: Optional[int] = None,
+    category_id: Optional[int] = None,
+    subcategory_id: Optional[int] = None,
+    brand_id: Optional[int] = None,
+    db: AsyncDB = Depends(get_async_db),
+    current_user: User = Depends(get_current_user),
+):
+    return await db.run_sync(paginate, Catalog, request, response, limit=limit, cursor=cursor, sort=sort,
+                            name_prefix=name_prefix, line_id=line_id, category_id=category_id,
+                            subcategory_id=subcategory_id, brand_id=brand_id)
 
 @app.get("/catalogs/{catalog_id}", response_model=CatalogResponse, tags=["Administración - Catálogos"])
-def get_catalog(catalog_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_catalog = db.query(Catalog).filter(Catalog.id == catalog_id).first()
-    if not db_catalog:
-        raise HTTPException(status_code=404, detail="Catálogo no encontrado")
-    return db_catalog
+async def get_catalog(catalog_id: int, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    return await db.run_sync(get_or_404, Catalog, catalog_id, "Catálogo no encontrado")
+
+class CatalogFileResponse(Response):
+    """
+    Respuesta de descarga de un archivo de catálogo (o de un rango de bytes).
+    Usa la extensión ASGI `http.response.zerocopysend` si el servidor la
+    ofrece; si no, lee el archivo por bloques fuera del event loop.
+    """
+
+    def __init__(self, file_path: str, start: int, length: int, status_code: int = 200,
+                 headers: Optional[dict] = None, media_type: Optional[str] = None, send_body: bool = True):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.file_path = file_path
+        self.start = start
+        self.length = length
+        self.send_body = send_body
+        self.headers["content-length"] = str(length)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or not self.length:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        fd = await run_in_threadpool(os.open, self.file_path, os.O_RDONLY)
+        try:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": fd,
+                            "offset": self.start, "count": self.length, "more_body": False})
+                return
+            offset, remaining = self.start, self.length
+            while remaining:
+                block = await run_in_threadpool(os.pread, fd, min(UPLOAD_CHUNK_BYTES, remaining), offset)
+                if not block:
+                    break
+                offset += len(block)
+                remaining -= len(block)
+                await send({"type": "http.response.body", "body": block, "more_body": bool(remaining)})
+            if remaining:
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            await run_in_threadpool(os.close, fd)
+
+
+def _parse_byte_range(header: str, size: int) -> Optional[tuple]:
+    """
+    Interpreta una cabecera Range de un solo intervalo. Devuelve (inicio, fin)
+    inclusivos, None si la cabecera se ignora (p. ej. varios intervalos) o
+    lanza 416 si el rango no es satisfacible.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    else:
+        start, end = size - min(int(last), size), size - 1
+    if start >= size:
+        raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            detail="Rango no satisfacible", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/") == etag.removeprefix("W/") for candidate in candidates)
+
+
+def _not_modified_since(header: Optional[str], modified_at: float) -> bool:
+    try:
+        return header is not None and int(modified_at) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+@app.api_route("/catalogs/{catalog_id}/file", methods=["GET", "HEAD"], tags=["General"])
+def download_catalog_file(catalog_id: int, request: Request, v: Optional[str] = None, db: Session = Depends(get_db)):
+    file_path = db.query(Catalog.file_path).filter(Catalog.id == catalog_id).scalar()
+    try:
+        stat_result = os.stat(file_path) if file_path else None
+    except FileNotFoundError:
+        stat_result = None
+    if stat_result is None:
+        raise HTTPException(status_code=404, detail="Archivo de catálogo no encontrado")
+
+    digest = blob_digest(file_path)
+    etag = f'"{digest}"' if digest else f'W/"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        # Con ?v=<sha256> la URL identifica un contenido concreto que nunca cambia
+        "Cache-Control": "public, max-age=31536000, immutable" if digest and v == digest else "no-cache",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if (if_none_match and _etag_matches(if_none_match, etag)) or (
+            if_none_match is None and _not_modified_since(request.headers.get("if-modified-since"), stat_result.st_mtime)):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    size = stat_result.st_size
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header and size:
+        if_range = request.headers.get("if-range")
+        if if_range is None or (if_range == etag and digest) or (
+                not if_range.startswith(("\"", "W/")) and _not_modified_since(if_range, stat_result.st_mtime)):
+            byte_range = _parse_byte_range(range_header, size)
+
+    media_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    send_body = request.method != "HEAD"
+    if byte_range is None:
+        return CatalogFileResponse(file_path, 0, size, headers=headers, media_type=media_type, send_body=send_body)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return CatalogFileResponse(file_path, start, end - start + 1, status_code=status.HTTP_206_PARTIAL_CONTENT,
+                               headers=headers, media_type=media_type, send_body=send_body)
 
 @app.put("/catalogs/{catalog_id}", response_model=CatalogResponse, tags=["Administración - Catálogos"])
-def update_catalog(catalog_id: int, catalog_data: CatalogUpdate, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_catalog = db.query(Catalog).filter(Catalog.id == catalog_id).first()
-    if not db_catalog:
-        raise HTTPException(status_code=404, detail="Catálogo no encontrado")
-    for key, value in catalog_data.model_dump(exclude_unset=True).items():
-        setattr(db_catalog, key, value)
-    db.commit()
-    db.refresh(db_catalog)
-    background_tasks.add_task(generate_public_json, db, request)
+async def update_catalog(catalog_id: int, catalog_data: CatalogUpdate, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    db_catalog = await db.run_sync(update_record, Catalog, catalog_id, catalog_data.model_dump(exclude_unset=True), "Catálogo no encontrado")
+    await apply_changes_and_publish(db, request)
     return db_catalog
 
 @app.delete("/catalogs/{catalog_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Administración - Catálogos"])
-def delete_catalog(catalog_id: int, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    db_catalog = db.query(Catalog).filter(Catalog.id == catalog_id).first()
-    if not db_catalog:
-        raise HTTPException(status_code=404, detail="Catálogo no encontrado")
-    
-    file_path_to_delete = db_catalog.file_path
-    
-    db.delete(db_catalog)
-    db.commit()
-
-    if file_path_to_delete and os.path.exists(file_path_to_delete):
-        try:
-            os.remove(file_path_to_delete)
-            logger.info(f"Archivo {file_path_to_delete} eliminado del servidor.")
-        except OSError as e:
-            logger.error(f"Error al eliminar el archivo {file_path_to_delete}: {e}")
-
-    background_tasks.add_task(generate_public_json, db, request)
+async def delete_catalog(catalog_id: int, request: Request, db: AsyncDB = Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    file_cleanup.enqueue(await db.run_sync(delete_subtree, "catalogs", catalog_id, "Catálogo no encontrado"))
+    await apply_changes_and_publish(db, request)
     return
 
 @app.post("/sync/catalog", tags=["Administración - General"])
 @limiter.limit("5/minute")
 def sync_catalog_manually(
     request: Request,
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    background_tasks.add_task(generate_public_json, db, request)
-    return {"message": "La sincronización del catálogo ha comenzado en segundo plano."}
+    job = request_full_rebuild(request)
+    return {"message": "La sincronización del catálogo se ha encolado.", "job_id": job.id, "status": job.status}
+
+@app.get("/sync/catalog/status", tags=["Administración - General"])
+def sync_catalog_status(job_id: Optional[int] = None, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    # Los campos de primer nivel son los del agrupador incremental de este proceso
+    result = {**catalog_sync.status(), "queue": sync_queue_status(db)}
+    if job_id is not None:
+        job = db.get(SyncJob, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Trabajo de sincronización no encontrado")
+        result["job"] = SyncJobResponse.model_validate(job).model_dump()
+    return result
+
+@app.post("/bulk/catalog", response_model=BulkResult, tags=["Administración - General"])
+@limiter.limit("5/minute")
+async def bulk_import_catalog(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+    body = await request.body()
+    try:
+        result = await run_in_threadpool(bulk_upsert, db, body, request.headers.get("content-type", ""))
+    except BulkImportError as e:
+        raise HTTPException(status_code=422, detail=e.errors)
+    # Una sola reconstrucción del JSON y del índice de búsqueda para toda la importación
+    result["sync_job_id"] = (await run_in_threadpool(request_full_rebuild, request)).id
+    reload_search_index()
+    return result
+
+@app.get("/bulk/catalog.ndjson", tags=["Administración - General"])
+@limiter.limit("5/minute")
+def bulk_export_catalog(request: Request, current_user: User = Depends(get_current_user)):
+    return StreamingResponse(iter_export_ndjson(), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": 'attachment; filename="catalog.ndjson"'})
+
+@app.get("/admin/slow-queries", tags=["Administración - General"])
+def list_slow_queries(current_user: User = Depends(get_current_user)):
+    return {
+        "enabled": SLOW_QUERY_THRESHOLD_MS > 0,
+        "threshold_ms": SLOW_QUERY_THRESHOLD_MS,
+        "capacity": slow_query_log.capacity,
+        "recorded": slow_query_log.recorded,
+        "entries": slow_query_log.entries(),
+    }
+
+@app.delete("/admin/slow-queries", status_code=status.HTTP_204_NO_CONTENT, tags=["Administración - General"])
+def clear_slow_queries(current_user: User = Depends(get_current_user)):
+    slow_query_log.clear()
+    return
 
 # --- END: CRUD Endpoints Protegidos ---
\ No newline at end of file
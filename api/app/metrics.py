@@ -0,0 +1,125 @@
+"""
+Métricas en el formato de texto de Prometheus.
+
+Contadores, medidores e histogramas con etiquetas fijas; cada serie se
+registra al crearse y render_metrics() las vuelca todas para GET /metrics.
+No depende del resto de la API: main.py define las series que mide.
+"""
+import threading
+from bisect import bisect_left
+from typing import Iterator
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+THROUGHPUT_BUCKETS = tuple(1024 * 4 ** n for n in range(2, 9))  # 16 KiB/s … 64 MiB/s
+INF_BUCKET = 'le="+Inf"'
+
+metrics_registry = []
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value) -> str:
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class Metric:
+    """
+    Serie de Prometheus con un conjunto fijo de etiquetas. Los valores se
+    guardan por tupla de etiquetas y sólo se formatean al pedir /metrics.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def _selector(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{label}="{_escape_label(value)}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{self._selector(labels)} {_number(value)}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Valor instantáneo; con `collect` se calcula al leerlo en vez de mantenerse."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), collect=None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: tuple = ()):
+        self.inc(-amount, labels)
+
+    def samples(self) -> Iterator[str]:
+        if self.collect is None:
+            yield from super().samples()
+            return
+        for labels, value in self.collect().items():
+            yield f"{self.name}{self._selector(labels)} {_number(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: tuple = ()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{self._selector(labels, le)} {cumulative}"
+            yield f"{self.name}_bucket{self._selector(labels, INF_BUCKET)} {count}"
+            yield f"{self.name}_sum{self._selector(labels)} {_number(total)}"
+            yield f"{self.name}_count{self._selector(labels)} {count}"
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in metrics_registry) + "\n"
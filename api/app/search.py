@@ -0,0 +1,370 @@
+"""
+Índice de búsqueda en memoria de las entidades públicas.
+
+Guarda los términos plegados (sin acentos ni mayúsculas) de cada entidad
+ordenados, de modo que un prefijo se resuelve con búsqueda binaria. Se carga
+una vez desde la base y se pone al día leyendo el diario de cambios.
+"""
+import heapq
+import json
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from itertools import chain
+from typing import Iterable, Iterator, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .main import (PUBLIC_MODELS, PUBLIC_PARENTS, CHANGES_MAX_PAGE_LIMIT, SEARCH_INDEX_REFRESH_SECONDS,
+                   SessionLocal, current_change_version, logger, read_journal, record_columns)
+
+
+class _FoldTable(dict):
+    """Tabla para str.translate que calcula y memoriza el plegado de cada carácter."""
+
+    def __missing__(self, codepoint: int) -> str:
+        decomposed = unicodedata.normalize("NFKD", chr(codepoint))
+        folded = "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+        self[codepoint] = folded
+        return folded
+
+_FOLD_TABLE = _FoldTable()
+
+
+def fold_text(text: Optional[str]) -> str:
+    """Texto sin tildes ni diacríticos y en minúsculas ("QUÍMICOS" → "quimicos")."""
+    text = text or ""
+    return text.casefold() if text.isascii() else text.translate(_FOLD_TABLE)
+
+
+_SEARCH_TERM = re.compile(r"[^\W_]+")
+
+
+def search_terms(text: Optional[str]) -> List[str]:
+    return _SEARCH_TERM.findall(fold_text(text)) if text else []
+
+
+class SearchIndex:
+    """
+    Índice invertido en memoria sobre nombres y descripciones de toda la
+    jerarquía, insensible a tildes y mayúsculas.
+
+    Los términos se guardan en una lista ordenada, así que una búsqueda por
+    prefijo es un rango obtenido con bisect. Cada término apunta a una lista
+    de documentos ordenada por su clave de orden (nombre más corto, tipo más
+    alto en la jerarquía, id); al mezclar esas listas los documentos ya salen
+    en el orden final y la búsqueda se detiene en cuanto tiene `limit`
+    resultados, sin puntuar todas las coincidencias.
+
+    Como CatalogSnapshot, se carga entero una vez y después cada escritura
+    del CRUD actualiza sólo los documentos afectados; las de otros procesos
+    llegan por el diario de cambios, que refresh() aplica como mucho cada
+    SEARCH_INDEX_REFRESH_SECONDS.
+    """
+
+    KINDS = tuple(PUBLIC_MODELS)
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Una sola carga o puesta al día a la vez; las consultas a la base van fuera de _lock
+        self._refresh_lock = threading.Lock()
+        self._docs = {}
+        self._children = {}
+        self._terms = []
+        # término → claves de orden; en todo el texto, sólo en el nombre y como primera palabra del nombre
+        self._postings = {}
+        self._name_postings = {}
+        self._first_postings = {}
+        self._checked_at = 0.0
+        self.version = 0
+        self.loaded = False
+
+    # -- Carga y mutaciones --
+
+    @classmethod
+    def order_key(cls, kind: str, node_id: int, name: str) -> int:
+        """
+        (largo del nombre, tipo, id) empaquetados en un entero: se ordena igual
+        que la tupla pero las comparaciones al mezclar listas son mucho más baratas.
+        """
+        return (len(name) << 40) | (cls.KINDS.index(kind) << 36) | node_id
+
+    @classmethod
+    def key_of(cls, order: int) -> tuple:
+        return cls.KINDS[(order >> 36) & 0xF], order & ((1 << 36) - 1)
+
+    @staticmethod
+    def fetch_rows(db: Session) -> dict:
+        """Columnas indexadas de cada tabla, con una consulta plana por tabla."""
+        rows = {}
+        for kind, model in PUBLIC_MODELS.items():
+            columns = record_columns(kind)
+            query = select(*[getattr(model, column) for column in columns])
+            rows[kind] = [dict(zip(columns, row)) for row in db.execute(query)]
+        return rows
+
+    def load(self, rows: dict, version: Optional[int] = None):
+        """
+        `version` es la del diario leída antes que las filas, como en
+        CatalogSnapshot.load(). El índice nuevo se arma aparte y sólo el
+        reemplazo toma el candado: las búsquedas siguen sobre el anterior.
+        """
+        staged = SearchIndex()
+        for kind, kind_rows in rows.items():
+            for row in kind_rows:
+                staged._add(kind, row, list.append)
+        for postings in (staged._postings, staged._name_postings, staged._first_postings):
+            for keys in postings.values():
+                keys.sort()
+        staged._terms = sorted(staged._postings)
+        with self._lock:
+            if version is not None:
+                self.version = version
+            self._docs, self._children, self._terms = staged._docs, staged._children, staged._terms
+            self._postings, self._name_postings = staged._postings, staged._name_postings
+            self._first_postings = staged._first_postings
+            self.loaded = True
+
+    def ensure_loaded(self, db: Session):
+        if self.loaded:
+            return
+        with self._refresh_lock:
+            if not self.loaded:
+                self._reload(db)
+
+    def _reload(self, db: Session):
+        version = current_change_version(db)
+        self.load(self.fetch_rows(db), version)
+        self._checked_at = time.monotonic()
+
+    def refresh(self, db: Session):
+        """
+        Carga el índice si hace falta y, si pasaron SEARCH_INDEX_REFRESH_SECONDS
+        desde la última comprobación, aplica las entradas nuevas del diario (o lo
+        recarga entero si el diario no alcanza). Si otro hilo ya lo está poniendo
+        al día, se busca sobre el índice tal como está en vez de esperarlo.
+        """
+        if self.loaded and time.monotonic() - self._checked_at < SEARCH_INDEX_REFRESH_SECONDS:
+            return
+        if not self._refresh_lock.acquire(blocking=not self.loaded):
+            return
+        try:
+            if not self.loaded:
+                self._reload(db)
+                return
+            if time.monotonic() - self._checked_at < SEARCH_INDEX_REFRESH_SECONDS:
+                return
+            changes = read_journal(db, self.version, CHANGES_MAX_PAGE_LIMIT)
+            if changes is None or len(changes) > CHANGES_MAX_PAGE_LIMIT:
+                self._reload(db)
+                return
+            with self._lock:
+                for change in changes:
+                    if change.op == "delete":
+                        self._remove(change.kind, change.entity_id)
+                    else:
+                        self._put(change.kind, json.loads(change.data))
+                if changes:
+                    self.version = changes[-1].version
+            self._checked_at = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+
+    def invalidate(self):
+        """Descarta el índice para que se recargue entero (p. ej. tras una importación masiva)."""
+        with self._lock:
+            self.loaded = False
+
+    def upsert(self, kind: str, row: dict, version: Optional[int] = None):
+        """
+        Indexa o reindexa una entidad con las columnas de una fila ya confirmada
+        en la versión `version` del diario; si refresh() ya la aplicó, no hace nada.
+        """
+        with self._lock:
+            if not self.loaded or (version is not None and version <= self.version):
+                return
+            self._put(kind, row)
+
+    def remove(self, kind: str, node_id: int, version: Optional[int] = None):
+        """Quita la entidad y, como el ON DELETE CASCADE de la base, todos sus descendientes."""
+        with self._lock:
+            if not self.loaded or (version is not None and version <= self.version):
+                return
+            self._remove(kind, node_id)
+
+    def _put(self, kind: str, row: dict):
+        row = {column: row.get(column) for column in record_columns(kind)}
+        self._discard((kind, row["id"]))
+        for term in self._add(kind, row, insort):
+            if len(self._postings[term]) == 1:
+                insort(self._terms, term)
+
+    def _remove(self, kind: str, node_id: int):
+        pending = [(kind, node_id)]
+        while pending:
+            key = pending.pop()
+            pending.extend(self._children.pop(key, ()))
+            self._discard(key)
+
+    def _add(self, kind: str, row: dict, add_posting) -> set:
+        key = (kind, row["id"])
+        name_terms = search_terms(row["name"])
+        terms = set(name_terms) | set(search_terms(row["description"]))
+        parents = [(parent_kind, row[fk]) for parent_kind, fk in PUBLIC_PARENTS[kind] if row[fk] is not None]
+        doc = {
+            "name": row["name"],
+            "description": row["description"],
+            "file_path": row.get("file_path"),
+            "order": self.order_key(kind, row["id"], row["name"]),
+            "first_term": name_terms[0] if name_terms else None,
+            "name_terms": set(name_terms),
+            "terms": terms,
+            "parents": parents,
+            # Padre más específico: el último de la cadena línea → ... → marca
+            "parent": parents[-1] if parents else None,
+        }
+        self._docs[key] = doc
+        for parent_key in parents:
+            self._children.setdefault(parent_key, set()).add(key)
+        for term in terms:
+            add_posting(self._postings.setdefault(term, []), doc["order"])
+        for term in doc["name_terms"]:
+            add_posting(self._name_postings.setdefault(term, []), doc["order"])
+        if doc["first_term"] is not None:
+            add_posting(self._first_postings.setdefault(doc["first_term"], []), doc["order"])
+        return terms
+
+    def _discard(self, key: tuple):
+        doc = self._docs.pop(key, None)
+        if doc is None:
+            return
+        for parent_key in doc["parents"]:
+            self._children.get(parent_key, set()).discard(key)
+        for postings, terms in ((self._postings, doc["terms"]), (self._name_postings, doc["name_terms"]),
+                                (self._first_postings, [doc["first_term"]] if doc["first_term"] else [])):
+            for term in terms:
+                keys = postings[term]
+                del keys[bisect_left(keys, doc["order"])]
+                if not keys:
+                    del postings[term]
+                    if postings is self._postings:
+                        del self._terms[bisect_left(self._terms, term)]
+
+    # -- Consulta --
+
+    def _expand(self, prefix: str) -> List[str]:
+        """Términos del índice que empiezan por `prefix`."""
+        start = bisect_left(self._terms, prefix)
+        end = bisect_left(self._terms, prefix + "\U0010ffff", lo=start)
+        return self._terms[start:end]
+
+    def _stream(self, postings: dict, terms: List[str]) -> Iterator[tuple]:
+        """Claves de orden de los documentos de esos términos, en orden y sin repetir."""
+        lists = [postings[term] for term in terms if term in postings]
+        # Con muchos términos (p. ej. el prefijo "1"), ordenar todo de una vez es más barato que mezclar
+        merged = sorted(chain.from_iterable(lists)) if len(lists) > 64 else heapq.merge(*lists)
+        previous = None
+        for order in merged:
+            if order != previous:
+                previous = order
+                yield order
+
+    def path(self, key: tuple) -> List[dict]:
+        """Ruta de ancestros desde la línea hasta el padre directo."""
+        ancestors = []
+        parent = self._docs[key]["parent"]
+        while parent is not None and parent in self._docs:
+            ancestors.append({"kind": parent[0], "id": parent[1], "name": self._docs[parent]["name"]})
+            parent = self._docs[parent]["parent"]
+        return ancestors[::-1]
+
+    def search(self, query: str, limit: int = 20, kinds: Optional[Iterable[str]] = None) -> List[dict]:
+        """
+        Todas las palabras de la consulta deben aparecer, completas o como
+        prefijo (búsqueda mientras se escribe). Primero van los nombres que
+        empiezan por la primera palabra buscada, después los que contienen
+        todas las palabras en el nombre y por último las coincidencias en la
+        descripción; dentro de cada grupo, los nombres más cortos.
+        """
+        tokens = list(dict.fromkeys(search_terms(query)))[:8]
+        if not tokens:
+            return []
+        kinds = set(kinds) if kinds else None
+        with self._lock:
+            expansions = {token: self._expand(token) for token in tokens}
+            matched = {token: set(terms) for token, terms in expansions.items()}
+            ranked, seen = [], set()
+
+            # 1) Nombres cuya primera palabra empieza por la primera palabra buscada
+            others = [matched[token] for token in tokens[1:]]
+            for order in self._stream(self._first_postings, expansions[tokens[0]]):
+                key = self.key_of(order)
+                if kinds and key[0] not in kinds:
+                    continue
+                name_terms = self._docs[key]["name_terms"]
+                if all(not name_terms.isdisjoint(terms) for terms in others):
+                    ranked.append(order)
+                    seen.add(order)
+                    if len(ranked) == limit:
+                        return self._results(ranked)
+
+            # 2) y 3) Se recorre el término más selectivo una sola vez, separando
+            # los que coinciden en el nombre de los que sólo coinciden en la descripción
+            seed = min(tokens, key=lambda token: sum(len(self._postings[term]) for term in expansions[token]))
+            others = [matched[token] for token in tokens if token != seed]
+            needed = limit - len(ranked)
+            in_name, in_text = [], []
+            for order in self._stream(self._postings, expansions[seed]):
+                if order in seen:
+                    continue
+                key = self.key_of(order)
+                if kinds and key[0] not in kinds:
+                    continue
+                doc = self._docs[key]
+                if not all(not doc["terms"].isdisjoint(terms) for terms in others):
+                    continue
+                if all(not doc["name_terms"].isdisjoint(matched[token]) for token in tokens):
+                    in_name.append(order)
+                    if len(in_name) == needed:
+                        break
+                elif len(in_text) < needed:
+                    in_text.append(order)
+            return self._results(ranked + (in_name + in_text)[:needed])
+
+    def _results(self, ranked: List[int]) -> List[dict]:
+        results = []
+        for order in ranked:
+            key = self.key_of(order)
+            doc = self._docs[key]
+            results.append({
+                "kind": key[0],
+                "id": key[1],
+                "name": doc["name"],
+                "description": doc["description"],
+                "file_path": doc["file_path"],
+                "path": self.path(key),
+            })
+        return results
+
+search_index = SearchIndex()
+
+
+def warm_search_index():
+    """Carga el índice con una sesión propia, para que la primera búsqueda no pague la carga."""
+    db = SessionLocal()
+    try:
+        search_index.ensure_loaded(db)
+        logger.info("Índice de búsqueda cargado.")
+    except Exception as e:
+        logger.error(f"❌ Error al cargar el índice de búsqueda: {e}")
+    finally:
+        db.close()
+
+
+def reload_search_index():
+    """Recarga el índice en segundo plano; mientras tanto, las búsquedas lo cargan si lo necesitan."""
+    search_index.invalidate()
+    threading.Thread(target=warm_search_index, name="search-index-warmup", daemon=True).start()
@@ -1,42 +1,15 @@
 import os
 import json
+import random
+import time
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import insert, text
 
 # CORRECCIÓN: Se usa una importación relativa (.main) porque seeds.py está en el mismo paquete que main.py
 from .main import (Base, User, Line, Category, Subcategory, Brand, Catalog,
                    engine, SessionLocal, pwd_context)
 
-def run_initial_setup():
-    """
-    Función principal para recrear la BD y poblarla con datos iniciales.
-    """
-    db = SessionLocal()
-    try:
-        # 1. Recrear la base de datos
-        print("🗑️  Eliminando y recreando todas las tablas...")
-        Base.metadata.drop_all(bind=engine)
-        Base.metadata.create_all(bind=engine)
-        print("✅ Base de datos recreada exitosamente.")
-
-        # 2. Crear usuarios iniciales
-        print("\n👤 Creando usuarios administradores...")
-        users_data = [
-            {"email": "admin@example.com", "password": "adminpassword"},
-            {"email": "user1@example.com", "password": "user1password"},
-            {"email": "user2@example.com", "password": "user2password"},
-        ]
-        for user_data in users_data:
-            if not db.query(User).filter(User.email == user_data["email"]).first():
-                hashed_password = pwd_context.hash(user_data["password"])
-                db_user = User(email=user_data["email"], password_hash=hashed_password)
-                db.add(db_user)
-        db.commit()
-        print(f"✅ Creados {len(users_data)} usuarios.")
-
-        # 3. Poblar desde el JSON autocontenido
-        print("\n🌱 Poblando la base de datos con los datos de catálogos...")
-        lines_data = [
+LINES_DATA = [
     {
         "id": 4,
         "name": "ABRASIVOS",
@@ -196,7 +169,61 @@ def run_initial_setup():
     }
 ]
 
-        for line_data in lines_data:
+USERS_DATA = [
+    {"email": "admin@example.com", "password": "adminpassword"},
+    {"email": "user1@example.com", "password": "user1password"},
+    {"email": "user2@example.com", "password": "user2password"},
+]
+
+def recreate_database():
+    print("🗑️  Eliminando y recreando todas las tablas...")
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    print("✅ Base de datos recreada exitosamente.")
+
+def create_users(db: Session):
+    print("\n👤 Creando usuarios administradores...")
+    for user_data in USERS_DATA:
+        if not db.query(User).filter(User.email == user_data["email"]).first():
+            hashed_password = pwd_context.hash(user_data["password"])
+            db_user = User(email=user_data["email"], password_hash=hashed_password)
+            db.add(db_user)
+    db.commit()
+    print(f"✅ Creados {len(USERS_DATA)} usuarios.")
+
+def reset_sequences(db: Session):
+    """Actualiza las secuencias de IDs en PostgreSQL tras insertar filas con id explícito."""
+    if engine.dialect.name != "postgresql":
+        return
+    print("\n🔄 Actualizando secuencias de IDs para PostgreSQL...")
+    table_names = ["users", "lines", "categories", "subcategories", "brands", "catalogs"]
+    for table in table_names:
+        try:
+            # Este comando SQL reinicia el contador del ID al valor máximo actual en la tabla
+            sequence_name = f"{table}_id_seq"
+            db.execute(text(f"SELECT setval('{sequence_name}', (SELECT MAX(id) FROM {table}));"))
+            print(f"  - Secuencia para '{table}' actualizada.")
+        except Exception as seq_e:
+            print(f"  - ⚠️  No se pudo actualizar la secuencia para '{table}': {seq_e}")
+    db.commit()
+    print("✅ Secuencias actualizadas.")
+
+def run_initial_setup():
+    """
+    Función principal para recrear la BD y poblarla con datos iniciales.
+    """
+    db = SessionLocal()
+    try:
+        # 1. Recrear la base de datos
+        recreate_database()
+
+        # 2. Crear usuarios iniciales
+        create_users(db)
+
+        # 3. Poblar desde el JSON autocontenido
+        print("\n🌱 Poblando la base de datos con los datos de catálogos...")
+
+        for line_data in LINES_DATA:
             db_line = Line(id=line_data['id'], name=line_data['name'])
             db.add(db_line)
             db.flush()
@@ -231,22 +258,8 @@ def run_initial_setup():
         db.commit()
         print("✅ Datos de catálogos poblados exitosamente.")
 
-        # --- INICIO DE LA CORRECCIÓN ---
         # 4. Actualizar las secuencias de IDs en PostgreSQL
-        if engine.dialect.name == "postgresql":
-            print("\n🔄 Actualizando secuencias de IDs para PostgreSQL...")
-            table_names = ["users", "lines", "categories", "subcategories", "brands", "catalogs"]
-            for table in table_names:
-                try:
-                    # Este comando SQL reinicia el contador del ID al valor máximo actual en la tabla
-                    sequence_name = f"{table}_id_seq"
-                    db.execute(text(f"SELECT setval('{sequence_name}', (SELECT MAX(id) FROM {table}));"))
-                    print(f"  - Secuencia para '{table}' actualizada.")
-                except Exception as seq_e:
-                    print(f"  - ⚠️  No se pudo actualizar la secuencia para '{table}': {seq_e}")
-            db.commit()
-            print("✅ Secuencias actualizadas.")
-        # --- FIN DE LA CORRECCIÓN ---
+        reset_sequences(db)
 
     except Exception as e:
         print(f"❌ Ocurrió un error durante la configuración: {e}")
@@ -254,3 +267,146 @@ def run_initial_setup():
     finally:
         db.close()
 
+
+# --- Carga masiva ---
+
+BULK_BATCH_ROWS = 20_000
+
+# Vocabulario con tildes para que los nombres sintéticos se parezcan a los reales
+SYNTHETIC_WORDS = [
+    "abrasivos", "adhesivos", "automotriz", "cerrajería", "construcción", "cubiertos", "eléctrica",
+    "embalaje", "ferretería", "fontanería", "herramienta", "iluminación", "jardinería", "limpieza",
+    "madera", "pintura", "plásticos", "químicos", "seguridad", "tornillería", "acero", "industrial",
+]
+
+
+def fixture_rows() -> dict:
+    """Filas planas (con id explícito) del árbol de LINES_DATA, por tabla."""
+    rows = {"lines": [], "categories": [], "subcategories": [], "brands": [], "catalogs": []}
+
+    def add_brands(node, **parent):
+        for brand_data in node.get("brands", []):
+            rows["brands"].append({"id": brand_data["id"], "name": brand_data["name"], "line_id": None,
+                                   "category_id": None, "subcategory_id": None, **parent})
+
+    for line_data in LINES_DATA:
+        rows["lines"].append({"id": line_data["id"], "name": line_data["name"]})
+        add_brands(line_data, line_id=line_data["id"])
+        for category_data in line_data.get("categories", []):
+            rows["categories"].append({"id": category_data["id"], "name": category_data["name"],
+                                       "line_id": line_data["id"]})
+            add_brands(category_data, category_id=category_data["id"])
+            for sub_data in category_data.get("subcategories", []):
+                rows["subcategories"].append({"id": sub_data["id"], "name": sub_data["name"],
+                                              "category_id": category_data["id"]})
+                add_brands(sub_data, subcategory_id=sub_data["id"])
+    return rows
+
+
+def synthetic_rows(lines: int = 50, categories: int = 40, subcategories: int = 10, brands: int = 8,
+                   catalogs: int = 5, seed: int = 0) -> dict:
+    """
+    Árbol sintético determinista: `lines` líneas, `categories` categorías por
+    línea, `subcategories` por categoría, `brands` marcas por subcategoría y
+    `catalogs` catálogos por marca (por defecto, 800 000 catálogos y unas
+    982 000 filas en total). Los ids se derivan de la posición en el
+    árbol, así que cada tabla se genera por separado y de forma perezosa
+    (nunca se tiene todo el árbol en memoria). La misma semilla produce
+    siempre los mismos datos.
+    """
+
+    def generate(kind, count, fan_out, parent_fk, label):
+        rng = random.Random(f"{seed}:{kind}")
+        for node_id in range(1, count + 1):
+            words = rng.sample(SYNTHETIC_WORDS, 2)
+            row = {
+                "id": node_id,
+                "name": f"{label} {words[0]} {words[1]} {node_id}"[:100],
+                "description": " ".join(rng.choices(SYNTHETIC_WORDS, k=6)) if rng.random() < 0.3 else None,
+            }
+            if parent_fk:
+                row[parent_fk] = (node_id - 1) // fan_out + 1
+            yield row
+
+    total_categories = lines * categories
+    total_subcategories = total_categories * subcategories
+    total_brands = total_subcategories * brands
+    return {
+        "lines": generate("lines", lines, 1, None, "Línea"),
+        "categories": generate("categories", total_categories, categories, "line_id", "Categoría"),
+        "subcategories": generate("subcategories", total_subcategories, subcategories, "category_id", "Subcategoría"),
+        "brands": generate("brands", total_brands, brands, "subcategory_id", "Marca"),
+        "catalogs": generate("catalogs", total_brands * catalogs, catalogs, "brand_id", "Catálogo"),
+    }
+
+
+def bulk_insert(conn, table, rows, batch_size: int = BULK_BATCH_ROWS) -> int:
+    """
+    Inserta las filas con executemany por lotes (Core, sin objetos ORM).
+    Con drivers de parámetros posicionales (SQLite) se llama directamente al
+    executemany del driver con tuplas, que evita el procesado de parámetros
+    fila a fila de SQLAlchemy; en el resto se usa insert() de Core, que en
+    PostgreSQL ya agrupa las filas en INSERTs de varios VALUES.
+    Devuelve cuántas filas se insertaron.
+    """
+    columns = [column.name for column in table.columns]
+    if conn.dialect.paramstyle == "qmark":
+        quote = conn.dialect.identifier_preparer.quote
+        statement = (f"INSERT INTO {quote(table.name)} ({', '.join(quote(column) for column in columns)}) "
+                     f"VALUES ({', '.join('?' * len(columns))})")
+        to_params = lambda row: tuple(row.get(column) for column in columns)
+        execute = lambda batch: conn.exec_driver_sql(statement, batch)
+    else:
+        statement = insert(table)
+        to_params = lambda row: {column: row.get(column) for column in columns}
+        execute = lambda batch: conn.execute(statement, batch)
+
+    total, batch = 0, []
+    for row in rows:
+        batch.append(to_params(row))
+        if len(batch) == batch_size:
+            execute(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        execute(batch)
+        total += len(batch)
+    return total
+
+
+def run_bulk_setup(rows: dict = None, batch_size: int = BULK_BATCH_ROWS):
+    """
+    Igual que run_initial_setup pero con inserciones por lotes e ids
+    explícitos en una sola transacción. Sin `rows` carga LINES_DATA; con
+    synthetic_rows(...) genera un catálogo del tamaño que se quiera.
+    Los índices secundarios se crean después de la carga, que es mucho
+    más rápido que mantenerlos fila a fila.
+    """
+    rows = rows if rows is not None else fixture_rows()
+    db = SessionLocal()
+    try:
+        recreate_database()
+        create_users(db)
+
+        print("\n🌱 Poblando la base de datos por lotes...")
+        models = [Line, Category, Subcategory, Brand, Catalog]
+        indexes = [index for model in models for index in model.__table__.indexes]
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            for index in indexes:
+                index.drop(bind=conn)
+            for model in models:
+                count = bulk_insert(conn, model.__table__, rows[model.__tablename__], batch_size)
+                print(f"  - {model.__tablename__}: {count} filas ({time.perf_counter() - started:.1f} s)")
+            print("  - Creando índices...")
+            for index in indexes:
+                index.create(bind=conn)
+        print(f"✅ Datos de catálogos poblados en {time.perf_counter() - started:.1f} s.")
+
+        reset_sequences(db)
+
+    except Exception as e:
+        print(f"❌ Ocurrió un error durante la configuración: {e}")
+        db.rollback()
+    finally:
+        db.close()
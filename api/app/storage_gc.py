@@ -0,0 +1,326 @@
+"""
+Recolector de archivos huérfanos y conciliación del almacenamiento.
+
+Compara lo que hay en disco con lo que la base de datos referencia:
+
+- static/catalogs/ frente a catalogs.file_path
+- uploads/ (partes de subidas reanudables) frente a upload_sessions.id
+
+Los dos lados se recorren ordenados por ruta y se cruzan en una sola
+pasada (merge join). El directorio se ordena por tramos en temporales y se
+mezcla con heapq.merge; la base se lee por páginas de clave (sin OFFSET ni
+transacciones largas), de modo que la memoria no depende del número de
+archivos ni de filas.
+"""
+import heapq
+import json
+import os
+import tempfile
+import time
+from contextlib import nullcontext
+from itertools import islice
+from typing import Callable, Iterator, List, Optional
+
+from sqlalchemy import delete, select, tuple_
+
+from .main import (Catalog, UploadSession, SessionLocal, BINARY_COLLATIONS, CATALOGS_DIR, UPLOAD_SESSIONS_DIR,
+                   _upload_part_path, blob_lock, record_deletes)
+
+# Entradas del directorio que se ordenan en memoria antes de volcarlas a un temporal
+GC_SORT_RUN_ENTRIES = 100_000
+# Filas por página al leer la base, y archivos o filas por lote al borrar
+GC_BATCH_ROWS = 500
+
+
+def scan_files(root: str, recursive: bool = True) -> Iterator[list]:
+    """Archivos bajo `root` como [ruta, tamaño, mtime], en el orden de os.scandir."""
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    yield [entry.path.replace("\\", "/"), stat.st_size, stat.st_mtime]
+
+
+def external_sorted(entries: Iterator[list], run_entries: int = GC_SORT_RUN_ENTRIES) -> Iterator[list]:
+    """
+    Ordena las entradas por su primer elemento con memoria acotada: tramos de
+    `run_entries` ordenados y volcados a temporales, mezclados al leer.
+    """
+    entries = iter(entries)
+    runs = []
+    try:
+        while True:
+            chunk = sorted(islice(entries, run_entries))
+            if not runs and len(chunk) < run_entries:
+                yield from chunk
+                return
+            if not chunk:
+                break
+            run = tempfile.TemporaryFile("w+", encoding="utf-8")
+            # json escapa los nombres no UTF-8 (surrogateescape) y los saltos de línea
+            run.writelines(json.dumps(entry) + "\n" for entry in chunk)
+            run.seek(0)
+            runs.append(run)
+        yield from heapq.merge(*(map(json.loads, run) for run in runs), key=lambda entry: entry[0])
+    finally:
+        for run in runs:
+            run.close()
+
+
+def ordered_rows(key_column, id_column, *conditions) -> Iterator[tuple]:
+    """
+    (clave, id) de las filas ordenadas por clave con colación binaria, por
+    páginas de clave: cada página es una transacción corta, así que el
+    recorrido no bloquea las escrituras de la API aunque dure minutos.
+    Si la clave es única, `id_column` puede ser la misma columna.
+    """
+    db = SessionLocal()
+    try:
+        collation = BINARY_COLLATIONS.get(db.get_bind().dialect.name)
+        key = key_column.collate(collation) if collation else key_column
+        order = (key,) if id_column is key_column else (key, id_column)
+        query = select(key_column, id_column.label("row_id")).where(*conditions).order_by(*order).limit(GC_BATCH_ROWS)
+        last = None
+        while True:
+            page_query = query if last is None else query.where(tuple_(*order) > tuple_(*last[:len(order)]))
+            page = db.execute(page_query).all()
+            db.rollback()
+            yield from page
+            if len(page) < GC_BATCH_ROWS:
+                return
+            last = tuple(page[-1])
+    finally:
+        db.close()
+
+
+def merge_join(files: Iterator[list], rows: Iterator[tuple]) -> Iterator[tuple]:
+    """
+    Cruza archivos y filas, ambos ordenados por clave. Genera
+    ("referenced", archivo), ("orphan", archivo) y ("dangling", fila).
+    Varias filas pueden apuntar al mismo archivo.
+    """
+    file, row = next(files, None), next(rows, None)
+    matched = False
+    while file is not None or row is not None:
+        if file is not None and (row is None or file[0] < row[0]):
+            yield ("referenced" if matched else "orphan", file)
+            file, matched = next(files, None), False
+        elif file is None or row[0] < file[0]:
+            yield "dangling", row
+            row = next(rows, None)
+        else:
+            matched = True
+            row = next(rows, None)
+
+
+def new_report() -> dict:
+    return {"files": 0, "referenced": 0, "orphans": 0, "orphan_bytes": 0, "recent": 0,
+            "deleted": 0, "reclaimed_bytes": 0, "dangling": 0, "dangling_deleted": 0, "errors": 0}
+
+
+class _Reconciler:
+    """Estado de una pasada: lotes de huérfanos por borrar e ids colgantes pendientes."""
+
+    def __init__(self, report: dict, apply: bool, delete_dangling: bool, min_age_seconds: float,
+                 verbose: bool, still_referenced: Callable, delete_rows: Callable, lock: Callable = nullcontext):
+        self.report = report
+        self.apply = apply
+        self.delete_dangling = apply and delete_dangling
+        self.cutoff = time.time() - min_age_seconds
+        self.verbose = verbose
+        self.still_referenced = still_referenced
+        self.delete_rows = delete_rows
+        self.lock = lock
+        self._orphans: List[list] = []
+        # Los ids colgantes se guardan en disco: se borran al terminar el recorrido
+        self._dangling = tempfile.TemporaryFile("w+", encoding="utf-8") if self.delete_dangling else None
+
+    def consume(self, results: Iterator[tuple]):
+        try:
+            for kind, item in results:
+                if kind == "dangling":
+                    self.dangling(item)
+                    continue
+                self.report["files"] += 1
+                if kind == "referenced":
+                    self.report["referenced"] += 1
+                else:
+                    self.orphan(item)
+            self.flush_orphans()
+            self.flush_dangling()
+        finally:
+            if self._dangling is not None:
+                self._dangling.close()
+
+    def orphan(self, entry: list):
+        path, size, mtime = entry
+        # Un archivo recién escrito puede pertenecer a una subida que aún no confirmó su fila
+        if mtime > self.cutoff:
+            self.report["recent"] += 1
+            return
+        self.report["orphans"] += 1
+        self.report["orphan_bytes"] += size
+        if self.verbose:
+            print(f"  huérfano  {path} ({size:,} bytes)")
+        if self.apply:
+            self._orphans.append(entry)
+            if len(self._orphans) >= GC_BATCH_ROWS:
+                self.flush_orphans()
+
+    def dangling(self, row: tuple):
+        self.report["dangling"] += 1
+        if self.verbose:
+            print(f"  colgante  {row[0]} (id {row[1]})")
+        if self.delete_dangling:
+            self._dangling.write(json.dumps(row[1]) + "\n")
+
+    def flush_orphans(self):
+        if not self._orphans:
+            return
+        # Se vuelve a consultar justo antes de borrar, con el candado tomado: la API pudo
+        # referenciarlos durante el recorrido o estar reutilizándolos en una subida
+        with self.lock():
+            referenced = self.still_referenced([path for path, _, _ in self._orphans])
+            for path, size, _ in self._orphans:
+                if path in referenced:
+                    continue
+                try:
+                    os.remove(path)
+                    self.report["deleted"] += 1
+                    self.report["reclaimed_bytes"] += size
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self.report["errors"] += 1
+                    print(f"  ⚠️ No se pudo eliminar {path}: {e}")
+        self._orphans = []
+
+    def flush_dangling(self):
+        if self._dangling is None:
+            return
+        self._dangling.seek(0)
+        ids = map(json.loads, self._dangling)
+        while batch := list(islice(ids, GC_BATCH_ROWS)):
+            self.report["dangling_deleted"] += self.delete_rows(batch)
+
+
+def _referenced_catalog_paths(paths: List[str]) -> set:
+    db = SessionLocal()
+    try:
+        return set(db.scalars(select(Catalog.file_path).where(Catalog.file_path.in_(paths))))
+    finally:
+        db.close()
+
+
+def _existing_upload_parts(paths: List[str]) -> set:
+    db = SessionLocal()
+    try:
+        session_ids = db.scalars(select(UploadSession.id).where(
+            UploadSession.id.in_([os.path.basename(path)[:-len(".part")] for path in paths])))
+        return {_upload_part_path(session_id).replace("\\", "/") for session_id in session_ids}
+    finally:
+        db.close()
+
+
+def _delete_dangling_catalogs(ids: List[int]) -> int:
+    # Sólo si el archivo sigue sin existir: pudo restaurarse durante el recorrido
+    db = SessionLocal()
+    try:
+        paths = dict(db.execute(select(Catalog.id, Catalog.file_path).where(Catalog.id.in_(ids))).all())
+        missing = [catalog_id for catalog_id, path in paths.items() if path and not os.path.exists(path)]
+        if not missing:
+            return 0
+        # Los clientes de /sync/changes también deben enterarse de estos borrados
+        record_deletes(db, {"catalogs": Catalog.id.in_(missing)})
+        deleted = db.execute(delete(Catalog).where(Catalog.id.in_(missing))).rowcount
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+
+def _delete_dangling_upload_sessions(ids: List[str]) -> int:
+    db = SessionLocal()
+    try:
+        missing = [session_id for session_id in ids if not os.path.exists(_upload_part_path(session_id))]
+        deleted = db.execute(delete(UploadSession).where(UploadSession.id.in_(missing))).rowcount if missing else 0
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+
+def reconcile_catalog_files(apply: bool = False, delete_dangling: bool = False, min_age_seconds: float = 3600,
+                            verbose: bool = False, run_entries: int = GC_SORT_RUN_ENTRIES) -> dict:
+    """
+    Cruza static/catalogs con catalogs.file_path. Los huérfanos (archivos sin
+    fila) se borran con `apply`; las filas colgantes (ruta sin archivo) sólo
+    se informan, salvo con `delete_dangling`. Las rutas de catalogs fuera de
+    static/catalogs se comprueban una a una.
+    """
+    report = new_report()
+    prefix = CATALOGS_DIR.replace("\\", "/") + "/"
+    reconciler = _Reconciler(report, apply, delete_dangling, min_age_seconds, verbose,
+                             _referenced_catalog_paths, _delete_dangling_catalogs, blob_lock.hold)
+
+    def rows() -> Iterator[tuple]:
+        for row in ordered_rows(Catalog.file_path, Catalog.id, Catalog.file_path.isnot(None)):
+            if row[0].startswith(prefix):
+                yield row
+            elif not os.path.exists(row[0]):
+                reconciler.dangling(row)
+
+    files = external_sorted(scan_files(CATALOGS_DIR), run_entries)
+    reconciler.consume(merge_join(files, rows()))
+    return report
+
+
+def reconcile_upload_parts(apply: bool = False, delete_dangling: bool = False, min_age_seconds: float = 3600,
+                           verbose: bool = False, run_entries: int = GC_SORT_RUN_ENTRIES) -> dict:
+    """
+    Cruza uploads/ con upload_sessions: partes sin sesión (huérfanas) y
+    sesiones cuyo archivo de partes ya no existe (colgantes).
+    """
+    report = new_report()
+    reconciler = _Reconciler(report, apply, delete_dangling, min_age_seconds, verbose,
+                             _existing_upload_parts, _delete_dangling_upload_sessions)
+    # Los ids de sesión tienen longitud fija: ordenar por id es ordenar por nombre de archivo
+    rows = ((_upload_part_path(session_id).replace("\\", "/"), session_id)
+            for session_id, _ in ordered_rows(UploadSession.id, UploadSession.id))
+    files = external_sorted(scan_files(UPLOAD_SESSIONS_DIR, recursive=False), run_entries)
+    reconciler.consume(merge_join(files, rows))
+    return report
+
+
+def run_storage_gc(apply: bool = False, delete_dangling: bool = False, min_age_seconds: float = 3600,
+                   verbose: bool = False, run_entries: Optional[int] = None) -> dict:
+    options = dict(apply=apply, delete_dangling=delete_dangling, min_age_seconds=min_age_seconds,
+                   verbose=verbose, run_entries=run_entries or GC_SORT_RUN_ENTRIES)
+    print(f"🧹 {'Limpiando' if apply else 'Simulacro (sin cambios) sobre'} el almacenamiento de catálogos...")
+    reports = {}
+    for area, reconcile in (("catalogs", reconcile_catalog_files), ("uploads", reconcile_upload_parts)):
+        started = time.perf_counter()
+        report = reports[area] = reconcile(**options)
+        print(f"\n📁 {area} ({time.perf_counter() - started:.1f} s)")
+        print(f"  - Archivos: {report['files']:,} ({report['referenced']:,} referenciados)")
+        print(f"  - Huérfanos: {report['orphans']:,} ({report['orphan_bytes']:,} bytes); "
+              f"{report['recent']:,} más recientes que --min-age-minutes, sin tocar")
+        if apply:
+            print(f"  - Eliminados: {report['deleted']:,}; espacio recuperado: {report['reclaimed_bytes']:,} bytes")
+        print(f"  - Filas sin archivo: {report['dangling']:,}"
+              + (f" ({report['dangling_deleted']:,} eliminadas)" if apply and delete_dangling else ""))
+        if report["errors"]:
+            print(f"  - Errores: {report['errors']:,}")
+    if reports["catalogs"]["dangling_deleted"]:
+        print("\nℹ️  Se eliminaron catálogos: ejecuta POST /sync/catalog para regenerar catalog.json.")
+    return reports
@@ -0,0 +1,199 @@
+"""
+Cola persistente de trabajos de sincronización.
+
+Las reconstrucciones completas se guardan en sync_jobs antes de ejecutarse:
+sobreviven a un reinicio y las ejecuta cualquier worker (el embebido en la
+API o run_worker.py), que reclama cada trabajo con una actualización
+condicional, válida igual en SQLite que en PostgreSQL.
+"""
+import os
+import secrets
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from fastapi import Request
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+from starlette.datastructures import URL
+
+from .main import (SyncJob, SyncJobResponse, SessionLocal, SYNC_JOBS, SYNC_JOB_BACKOFF_MAX_SECONDS,
+                   SYNC_JOB_BACKOFF_SECONDS, SYNC_JOB_LEASE_SECONDS, SYNC_JOB_MAX_ATTEMPTS, SYNC_WORKER_EMBEDDED,
+                   SYNC_WORKER_POLL_SECONDS, catalog_build_lock, catalog_snapshot, logger, rebuild_public_json)
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def enqueue_sync_job(db: Session, base_url: Optional[URL] = None, kind: str = "full") -> SyncJob:
+    """Encola una reconstrucción; si ya hay una esperando sin empezar, se devuelve esa."""
+    job = db.scalars(select(SyncJob).where(SyncJob.kind == kind, SyncJob.status == "pending",
+                                           SyncJob.attempts == 0).order_by(SyncJob.id).limit(1)).first()
+    if job is None:
+        job = SyncJob(kind=kind, status="pending", attempts=0, run_after=_utcnow(),
+                      base_url=str(base_url) if base_url is not None else None)
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+    if SYNC_WORKER_EMBEDDED:
+        sync_worker.wake()
+    return job
+
+
+def claim_sync_job(db: Session, worker: str) -> Optional[SyncJob]:
+    """
+    Reclama el siguiente trabajo disponible: pendiente y vencido, o en curso
+    con el plazo de su worker agotado. El UPDATE sólo tiene efecto si el
+    trabajo sigue en el estado leído, así que dos workers nunca se llevan el
+    mismo; el que pierde prueba con el siguiente.
+    """
+    while True:
+        now = _utcnow()
+        candidate = db.execute(
+            select(SyncJob.id, SyncJob.status, SyncJob.attempts)
+            .where(or_(and_(SyncJob.status == "pending", SyncJob.run_after <= now),
+                       and_(SyncJob.status == "running", SyncJob.locked_until < now)))
+            .order_by(SyncJob.run_after, SyncJob.id).limit(1)
+        ).first()
+        if candidate is None:
+            db.rollback()
+            return None
+        claimed = db.execute(
+            update(SyncJob)
+            .where(SyncJob.id == candidate.id, SyncJob.status == candidate.status,
+                   SyncJob.attempts == candidate.attempts)
+            .values(status="running", attempts=candidate.attempts + 1, worker=worker, started_at=now,
+                    locked_until=now + timedelta(seconds=SYNC_JOB_LEASE_SECONDS))
+        ).rowcount
+        db.commit()
+        if claimed:
+            return db.get(SyncJob, candidate.id, populate_existing=True)
+
+
+def finish_sync_job(db: Session, job: SyncJob, duration: float, error: Optional[str] = None) -> str:
+    """
+    Registra el resultado. Si falla y quedan intentos, vuelve a la cola con
+    espera exponencial. Devuelve el estado final.
+    """
+    now = _utcnow()
+    values = {"finished_at": now, "duration_ms": round(duration * 1000, 2), "last_error": error,
+              "locked_until": None}
+    if error is None:
+        values["status"] = "succeeded"
+    elif job.attempts >= SYNC_JOB_MAX_ATTEMPTS:
+        values["status"] = "failed"
+    else:
+        delay = min(SYNC_JOB_BACKOFF_SECONDS * 2 ** (job.attempts - 1), SYNC_JOB_BACKOFF_MAX_SECONDS)
+        values.update(status="pending", run_after=now + timedelta(seconds=delay))
+    # Si el plazo venció y otro worker lo reclamó, el resultado de este ya no cuenta
+    db.execute(update(SyncJob).where(SyncJob.id == job.id, SyncJob.worker == job.worker,
+                                     SyncJob.attempts == job.attempts).values(**values))
+    db.commit()
+    return values["status"]
+
+
+def execute_sync_job(job: SyncJob):
+    if job.base_url:
+        catalog_snapshot.set_base_url(URL(job.base_url))
+    with catalog_build_lock.hold():
+        rebuild_public_json(raise_errors=True)
+
+
+class SyncJobWorker:
+    """
+    Ejecuta los trabajos de sync_jobs de uno en uno. Embebido en la API corre
+    en un hilo que se despierta al encolar; con run_worker.py, en primer
+    plano. En ambos casos revisa la cola cada `poll_interval` segundos para
+    recoger reintentos vencidos y trabajos de otros procesos.
+    """
+
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self.name = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self.run, name="sync-worker", daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        logger.info(f"Worker de sincronización {self.name} iniciado.")
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                while not self._stop.is_set() and self.run_once():
+                    pass
+            except Exception as e:
+                logger.error(f"❌ Error en el worker de sincronización: {e}")
+            self._wake.wait(self.poll_interval)
+
+    def run_once(self) -> bool:
+        """Ejecuta un trabajo si hay alguno disponible. Devuelve si lo había."""
+        db = SessionLocal()
+        try:
+            job = claim_sync_job(db, self.name)
+            if job is None:
+                return False
+            logger.info(f"Ejecutando el trabajo de sincronización {job.id} (intento {job.attempts}).")
+            started = time.perf_counter()
+            error = None
+            try:
+                execute_sync_job(job)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            status = finish_sync_job(db, job, time.perf_counter() - started, error)
+            SYNC_JOBS.inc(labels=({"pending": "retried"}.get(status, status),))
+            if error is not None:
+                logger.warning(f"⚠️ Trabajo de sincronización {job.id}: {error} ({status}).")
+            return True
+        finally:
+            db.close()
+
+
+sync_worker = SyncJobWorker(SYNC_WORKER_POLL_SECONDS)
+
+
+def request_full_rebuild(request: Request) -> SyncJob:
+    """
+    Encola una reconstrucción completa. El árbol en memoria se descarta: si
+    otro proceso la ejecuta, la siguiente escritura del CRUD en este lo
+    recarga de la base en vez de publicar una versión anterior.
+    """
+    catalog_snapshot.invalidate()
+    db = SessionLocal()
+    try:
+        return enqueue_sync_job(db, request.base_url)
+    finally:
+        db.close()
+
+
+def sync_queue_status(db: Session) -> dict:
+    depth = dict(db.execute(select(SyncJob.status, func.count(SyncJob.id))
+                            .where(SyncJob.status.in_(("pending", "running"))).group_by(SyncJob.status)).all())
+    last_success = db.scalars(select(SyncJob).where(SyncJob.status == "succeeded")
+                              .order_by(SyncJob.finished_at.desc()).limit(1)).first()
+    return {
+        "pending": depth.get("pending", 0),
+        "running": depth.get("running", 0),
+        "last_success": SyncJobResponse.model_validate(last_success).model_dump() if last_success else None,
+    }
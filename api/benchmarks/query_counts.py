@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Verifica que las lecturas de administración ejecuten un número acotado de
+consultas SQL: se pide cada endpoint sobre dos bases de distinto tamaño y
+falla (código de salida 1) si el número de consultas crece con los datos o
+supera el presupuesto de QUERY_BUDGETS. Lo ejecuta la CI en cada cambio de
+api/ (.github/workflows/api-checks.yml).
+
+Uso (desde api/):
+    python -m benchmarks.query_counts
+"""
+import os
+import sys
+import tempfile
+
+# La app usa rutas relativas (static/, sync/) y lee DATABASE_URL al importarse:
+# se trabaja dentro de un directorio temporal para no tocar los archivos del repo.
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, API_DIR)
+_tmp = tempfile.TemporaryDirectory()
+os.chdir(_tmp.name)
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp.name, 'queries.db')}"
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import delete  # noqa: E402
+
+from app.main import (app, engine, Base, User, Line, Category, Subcategory, Brand, Catalog,  # noqa: E402
+                      get_current_user, count_queries)
+from benchmarks.tree_build import populate  # noqa: E402
+
+# Consultas máximas por petición: una por tabla para el árbol de líneas (más
+# la página de líneas) y una por página en los listados
+QUERY_BUDGETS = {
+    "/lines": 6,
+    "/lines/1": 5,
+    "/categories?limit=500": 1,
+    "/subcategories?limit=500": 1,
+    "/brands?limit=500": 1,
+    "/catalogs?limit=500": 1,
+}
+ENDPOINTS = list(QUERY_BUDGETS)
+
+
+def measure(client: TestClient, catalogs: int) -> dict:
+    with engine.begin() as conn:
+        for model in (Catalog, Brand, Subcategory, Category, Line):
+            conn.execute(delete(model))
+    populate(engine, catalogs)
+    counts = {}
+    for url in ENDPOINTS:
+        with count_queries() as counter:
+            response = client.get(url)
+        response.raise_for_status()
+        counts[url] = counter["count"]
+    return counts
+
+
+def main() -> int:
+    Base.metadata.create_all(bind=engine)
+    app.dependency_overrides[get_current_user] = lambda: User(id=0, email="queries@example.com")
+    client = TestClient(app)
+    small = measure(client, 100)
+    large = measure(client, 5_000)
+    failed = False
+    for url in ENDPOINTS:
+        bad = large[url] > small[url] or large[url] > QUERY_BUDGETS[url]
+        failed = failed or bad
+        print(f"{'✗' if bad else '✓'} {url:<28} {small[url]:>4} consultas → {large[url]:>4} consultas"
+              f" (máx. {QUERY_BUDGETS[url]})")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
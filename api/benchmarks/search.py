@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Benchmark del índice de búsqueda en memoria.
+
+Carga el índice sobre una base SQLite temporal con el árbol sintético de
+tree_build y mide p50/p99 de una serie de consultas de autocompletado
+(prefijos cortos, varias palabras, números).
+
+Uso (desde api/):
+    python -m benchmarks.search
+    python -m benchmarks.search --sizes 10000 100000 --repeat 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# La app usa rutas relativas (static/, sync/) y lee DATABASE_URL al importarse:
+# se trabaja dentro de un directorio temporal para no tocar los archivos del repo.
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, API_DIR)
+_tmp = tempfile.TemporaryDirectory()
+os.chdir(_tmp.name)
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp.name, 'app.db')}"
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app.main import Base  # noqa: E402
+from app.search import SearchIndex  # noqa: E402
+from benchmarks.tree_build import populate  # noqa: E402
+
+QUERIES = ["c", "cat", "catalogo", "catálogo 5", "marca 12", "MARC", "linea 3", "subcat 40", "categoria 7", "1"]
+
+
+def percentile(samples, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run(size: int, repeat: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(bind=engine)
+        populate(engine, size)
+        db = sessionmaker(bind=engine)()
+        try:
+            index = SearchIndex()
+            started = time.perf_counter()
+            index.ensure_loaded(db)
+            load_time = time.perf_counter() - started
+        finally:
+            db.close()
+        engine.dispose()
+
+    print(f"{size:>8,} catálogos | carga del índice {load_time * 1000:>8.1f} ms")
+    for query in QUERIES:
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            index.search(query)
+            samples.append(time.perf_counter() - started)
+        print(f"    {query!r:<16} p50 {percentile(samples, 50) * 1000:>7.2f} ms   p99 {percentile(samples, 99) * 1000:>7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=100, help="repeticiones por consulta")
+    args = parser.parse_args()
+    for size in args.sizes:
+        run(size, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
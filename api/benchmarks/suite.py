@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Suite de benchmarks de las rutas críticas de la API.
+
+Levanta la aplicación en el mismo proceso sobre una base SQLite temporal,
+la llena con el árbol sintético de tree_build para cada tamaño y mide, por
+escenario: percentiles de latencia, operaciones por segundo, consultas SQL
+por operación y pico de memoria. Los resultados se guardan en JSON y pueden
+compararse con una línea base: la comparación falla (código de salida 1) si
+algún escenario empeora más que el umbral (en latencia, además, por más de
+--min-delta-ms, para que el ruido de fracciones de milisegundo no cuente).
+
+Uso (desde api/):
+    python -m benchmarks.suite --output bench.json
+    python -m benchmarks.suite --sizes 1000 --compare bench.json --threshold 0.25
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+# La app usa rutas relativas (static/, sync/) y lee DATABASE_URL al importarse:
+# se trabaja dentro de un directorio temporal para no tocar los archivos del repo.
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INVOCATION_DIR = os.getcwd()
+sys.path.insert(0, API_DIR)
+_tmp = tempfile.TemporaryDirectory()
+os.chdir(_tmp.name)
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp.name, 'suite.db')}"
+# Sin el worker de la cola: su sondeo periódico añadiría ruido a las mediciones
+os.environ["SYNC_WORKER_EMBEDDED"] = "0"
+# La caché de usuarios no vence a mitad de un escenario: esa consulta extra contaría como regresión
+os.environ["PRINCIPAL_CACHE_TTL_SECONDS"] = "3600"
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import delete  # noqa: E402
+
+from app.main import (app, engine, limiter, Base, SessionLocal, User, Line, Category, Subcategory,  # noqa: E402
+                      Brand, Catalog, pwd_context, count_queries, rebuild_public_json, search_index)
+from benchmarks.tree_build import populate  # noqa: E402
+
+ADMIN_EMAIL = "bench@example.com"
+ADMIN_PASSWORD = "benchpassword"
+
+# Métricas que se comparan con la línea base y si "más es peor"
+COMPARED_METRICS = ("p50_ms", "queries_per_op", "peak_memory_kib")
+
+
+def reset_dataset(catalogs: int):
+    with engine.begin() as conn:
+        for model in (Catalog, Brand, Subcategory, Category, Line, User):
+            conn.execute(delete(model))
+    populate(engine, catalogs)
+    db = SessionLocal()
+    try:
+        db.add(User(email=ADMIN_EMAIL, password_hash=pwd_context.hash(ADMIN_PASSWORD)))
+        db.commit()
+    finally:
+        db.close()
+    search_index.invalidate()
+    rebuild_public_json()
+
+
+def build_scenarios(client: TestClient, token: str) -> dict:
+    auth = {"Authorization": f"Bearer {token}"}
+
+    def get(url, headers=None, expected=200):
+        def run():
+            response = client.get(url, headers=headers)
+            assert response.status_code == expected, (url, response.status_code, response.text[:200])
+        return run
+
+    etag = client.get("/catalog.json", headers={"Accept-Encoding": "gzip"}).headers["etag"]
+
+    def login():
+        response = client.post("/auth/login", json={"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD})
+        assert response.status_code == 200, response.text[:200]
+
+    return {
+        "generate_public_json": rebuild_public_json,
+        "catalog_json_gzip": get("/catalog.json", {"Accept-Encoding": "gzip"}),
+        "catalog_json_not_modified": get("/catalog.json", {"Accept-Encoding": "gzip", "If-None-Match": etag}, 304),
+        "auth_login": login,
+        "list_lines": get("/lines?limit=20", auth),
+        "list_catalogs": get("/catalogs?limit=100&sort=name", auth),
+        "list_brands_by_parent": get("/brands?limit=100&subcategory_id=1", auth),
+        "search": get("/search?q=cat%C3%A1logo%201", None),
+    }
+
+
+def measure(fn, iterations: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    # Como timeit: sin pausas del recolector de basura dentro de las mediciones
+    gc.collect()
+    gc.disable()
+    try:
+        with count_queries() as counter:
+            started = time.perf_counter()
+            for _ in range(iterations):
+                op_started = time.perf_counter()
+                fn()
+                samples.append(time.perf_counter() - op_started)
+            elapsed = time.perf_counter() - started
+    finally:
+        gc.enable()
+    # El pico de memoria se mide aparte: tracemalloc ralentiza y falsearía las latencias
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    ordered = sorted(samples)
+
+    def percentile(pct):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] * 1000
+
+    return {
+        "iterations": iterations,
+        "p50_ms": round(percentile(50), 3),
+        "p95_ms": round(percentile(95), 3),
+        "p99_ms": round(percentile(99), 3),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+        "ops_per_s": round(iterations / elapsed, 1),
+        "queries_per_op": round(counter["count"] / iterations, 2),
+        "peak_memory_kib": round(peak / 1024, 1),
+    }
+
+
+def run_suite(sizes, iterations: int, login_iterations: int, warmup: int, only=None) -> list:
+    Base.metadata.create_all(bind=engine)
+    # Los límites por IP de slowapi cortarían las repeticiones con 429
+    limiter.enabled = False
+    results = []
+    with TestClient(app) as client:
+        for size in sizes:
+            reset_dataset(size)
+            token = client.post("/auth/login", json={"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD}).json()["access_token"]
+            for name, fn in build_scenarios(client, token).items():
+                if only and name not in only:
+                    continue
+                count = login_iterations if name == "auth_login" else iterations
+                metrics = measure(fn, count, warmup)
+                results.append({"scenario": name, "size": size, **metrics})
+                print(f"{name:<28} {size:>8,} | p50 {metrics['p50_ms']:>9.2f} ms  p95 {metrics['p95_ms']:>9.2f} ms  "
+                      f"p99 {metrics['p99_ms']:>9.2f} ms | {metrics['ops_per_s']:>9.1f} op/s | "
+                      f"{metrics['queries_per_op']:>6.2f} consultas | {metrics['peak_memory_kib']:>10.1f} KiB")
+    return results
+
+
+def compare(results: list, baseline: list, threshold: float, min_delta_ms: float = 0.0) -> list:
+    """
+    Escenarios que empeoran más que `threshold` (fracción) respecto de la línea
+    base; en latencia, el empeoramiento además debe superar `min_delta_ms`.
+    """
+    previous = {(entry["scenario"], entry["size"]): entry for entry in baseline}
+    regressions = []
+    for entry in results:
+        base = previous.get((entry["scenario"], entry["size"]))
+        if base is None:
+            continue
+        for metric in COMPARED_METRICS:
+            before, after = base.get(metric), entry.get(metric)
+            if before is None or after is None:
+                continue
+            # Las consultas SQL son deterministas: cualquier aumento cuenta como regresión
+            limit = before if metric == "queries_per_op" else before * (1 + threshold)
+            if metric.endswith("_ms"):
+                limit = max(limit, before + min_delta_ms)
+            if after > limit:
+                regressions.append(f"{entry['scenario']} ({entry['size']:,}): {metric} {before} → {after}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000], help="catálogos por tamaño de datos")
+    parser.add_argument("--iterations", type=int, default=100, help="repeticiones medidas por escenario")
+    parser.add_argument("--login-iterations", type=int, default=10, help="repeticiones de /auth/login (bcrypt es lento)")
+    parser.add_argument("--warmup", type=int, default=3, help="repeticiones previas que no se miden")
+    parser.add_argument("--scenario", action="append", help="ejecuta sólo este escenario (repetible)")
+    parser.add_argument("--output", help="archivo JSON donde guardar los resultados")
+    parser.add_argument("--compare", help="archivo JSON de una ejecución anterior con el que comparar")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="empeoramiento tolerado en latencia y memoria (0.2 = 20%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="aumento de latencia, en ms, por debajo del cual no hay regresión")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(INVOCATION_DIR, args.compare), encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    results = run_suite(args.sizes, args.iterations, args.login_iterations, args.warmup, args.scenario)
+
+    if args.output:
+        output = os.path.join(INVOCATION_DIR, args.output)
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump({
+                "meta": {
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "iterations": args.iterations,
+                    "sizes": args.sizes,
+                },
+                "results": results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"Resultados guardados en {output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline["results"], args.threshold, args.min_delta_ms)
+        for regression in regressions:
+            print(f"✗ {regression}")
+        if regressions:
+            return 1
+        print(f"✓ Sin regresiones por encima del {args.threshold:.0%} respecto de {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la construcción del árbol público de catalog.json.
+
+Compara la ruta anterior (cadena de joinedload + LinePublic.model_validate)
+con el ensamblador plano (una consulta por tabla, enlazada por id) sobre una
+base SQLite temporal con 1k, 10k y 100k catálogos.
+
+Uso (desde api/):
+    python -m benchmarks.tree_build
+    python -m benchmarks.tree_build --sizes 1000 10000
+
+La ruta con joinedload crece con el producto de los fan-outs, así que por
+defecto sólo se ejecuta hasta 1k catálogos (ver --legacy-max).
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker, joinedload
+
+from app.main import (Base, Line, Category, Subcategory, Brand, Catalog, LinePublic,
+                      CatalogSnapshot, fetch_public_rows)
+
+LINES = 10
+CATEGORIES_PER_LINE = 10
+SUBCATEGORIES_PER_CATEGORY = 5
+BRANDS_PER_SUBCATEGORY = 2
+
+
+def populate(engine, catalogs: int):
+    """Inserta un árbol sintético con `catalogs` catálogos repartidos entre las marcas."""
+    lines, categories, subcategories, brands, rows = [], [], [], [], []
+    for line_id in range(1, LINES + 1):
+        lines.append({"id": line_id, "name": f"Línea {line_id}"})
+        for c in range(CATEGORIES_PER_LINE):
+            category_id = len(categories) + 1
+            categories.append({"id": category_id, "name": f"Categoría {category_id}", "line_id": line_id})
+            for s in range(SUBCATEGORIES_PER_CATEGORY):
+                subcategory_id = len(subcategories) + 1
+                subcategories.append({"id": subcategory_id, "name": f"Subcategoría {subcategory_id}",
+                                      "category_id": category_id})
+                for b in range(BRANDS_PER_SUBCATEGORY):
+                    brand_id = len(brands) + 1
+                    brands.append({"id": brand_id, "name": f"Marca {brand_id}", "line_id": None,
+                                   "category_id": category_id if b == 0 else None,
+                                   "subcategory_id": subcategory_id})
+    for catalog_id in range(1, catalogs + 1):
+        brand = brands[catalog_id % len(brands)]
+        rows.append({"id": catalog_id, "name": f"Catálogo {catalog_id}",
+                     "file_path": f"static/catalogs/{catalog_id}.pdf",
+                     "line_id": None, "category_id": brand["category_id"],
+                     "subcategory_id": brand["subcategory_id"], "brand_id": brand["id"]})
+    with engine.begin() as conn:
+        for model, data in ((Line, lines), (Category, categories), (Subcategory, subcategories),
+                            (Brand, brands), (Catalog, rows)):
+            conn.execute(insert(model), data)
+
+
+def legacy_query(db):
+    return db.query(Line).options(
+        joinedload(Line.catalogs),
+        joinedload(Line.brands).joinedload(Brand.catalogs),
+        joinedload(Line.categories).joinedload(Category.catalogs),
+        joinedload(Line.categories).joinedload(Category.brands).joinedload(Brand.catalogs),
+        joinedload(Line.categories).joinedload(Category.subcategories).joinedload(Subcategory.catalogs),
+        joinedload(Line.categories).joinedload(Category.subcategories).joinedload(Subcategory.brands).joinedload(Brand.catalogs)
+    ).order_by(Line.id)
+
+
+def count_legacy_rows(db, engine) -> int:
+    """Filas que devuelve la consulta con joinedload antes de deduplicarlas."""
+    sql = str(legacy_query(db).statement.compile(dialect=engine.dialect))
+    return db.connection().exec_driver_sql(f"SELECT COUNT(*) FROM ({sql})").scalar()
+
+
+def build_legacy(db):
+    lines = legacy_query(db).all()
+    return [LinePublic.model_validate(line).model_dump() for line in lines]
+
+
+def build_flat(db):
+    snapshot = CatalogSnapshot()
+    snapshot.load(fetch_public_rows(db))
+    return snapshot.render()
+
+
+def timed(fn, session_factory, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        db = session_factory()
+        try:
+            started = time.perf_counter()
+            fn(db)
+            elapsed = time.perf_counter() - started
+        finally:
+            db.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(size: int, repeat: int, skip_legacy: bool):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(bind=engine)
+        populate(engine, size)
+        session_factory = sessionmaker(bind=engine)
+
+        db = session_factory()
+        try:
+            flat_rows = sum(len(rows) for rows in fetch_public_rows(db).values())
+            legacy_rows = None if skip_legacy else count_legacy_rows(db, engine)
+        finally:
+            db.close()
+
+        flat_time = timed(build_flat, session_factory, repeat)
+        legacy_time = None if skip_legacy else timed(build_legacy, session_factory, repeat)
+        engine.dispose()
+
+    legacy = "omitido" if skip_legacy else f"{legacy_rows:>12,} filas {legacy_time * 1000:>10.1f} ms"
+    print(f"{size:>8,} catálogos | joinedload: {legacy} | plano: {flat_rows:>9,} filas {flat_time * 1000:>8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3, help="repeticiones por ruta (se reporta la mejor)")
+    parser.add_argument("--legacy-max", type=int, default=1_000,
+                        help="tamaño máximo en el que se ejecuta la ruta con joinedload (0 = nunca)")
+    args = parser.parse_args()
+    for size in args.sizes:
+        run(size, args.repeat, skip_legacy=size > args.legacy_max)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Recolector de archivos huérfanos de static/catalogs y uploads/.
+
+Compara los archivos en disco con las filas de catalogs y upload_sessions e
+informa de los archivos sin fila (huérfanos) y de las filas cuyo archivo ya
+no existe (colgantes). Por defecto es un simulacro: no borra nada.
+
+Uso (desde api/):
+    python run_gc.py                          # sólo informa
+    python run_gc.py --verbose                # además lista cada huérfano y cada fila colgante
+    python run_gc.py --apply                  # borra los archivos huérfanos
+    python run_gc.py --apply --delete-dangling --min-age-minutes 10
+"""
+import argparse
+
+from app.storage_gc import run_storage_gc
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--apply", action="store_true", help="borra los huérfanos (sin esta opción sólo informa)")
+    parser.add_argument("--delete-dangling", action="store_true",
+                        help="con --apply, borra también las filas cuyo archivo no existe")
+    parser.add_argument("--min-age-minutes", type=float, default=60,
+                        help="no toca archivos más recientes (pueden ser subidas en curso)")
+    parser.add_argument("--run-entries", type=int, default=None,
+                        help="entradas del directorio que se ordenan en memoria por tramo")
+    parser.add_argument("--verbose", action="store_true", help="lista cada huérfano y cada fila colgante")
+    args = parser.parse_args()
+
+    run_storage_gc(apply=args.apply, delete_dangling=args.delete_dangling,
+                   min_age_seconds=args.min_age_minutes * 60, verbose=args.verbose, run_entries=args.run_entries)
@@ -1,12 +1,36 @@
 #!/usr/bin/env python3
 """
 Script para ejecutar las semillas de la base de datos de Catálogos.
+
+Uso (desde api/):
+    python run_seeds.py                   # datos iniciales, fila a fila
+    python run_seeds.py --bulk            # los mismos datos, por lotes
+    python run_seeds.py --synthetic       # catálogo sintético (50 × 40 × 10 × 8 × 5, ~1M filas)
+    python run_seeds.py --synthetic --lines 10 --catalogs 2 --seed 7
 """
+import argparse
+
 # Se importa la función principal desde el módulo correcto: app.seeds
-from app.seeds import run_initial_setup
+from app.seeds import run_initial_setup, run_bulk_setup, synthetic_rows
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bulk", action="store_true", help="carga por lotes con ids explícitos")
+    parser.add_argument("--synthetic", action="store_true", help="genera un catálogo sintético (implica --bulk)")
+    parser.add_argument("--lines", type=int, default=50, help="líneas")
+    parser.add_argument("--categories", type=int, default=40, help="categorías por línea")
+    parser.add_argument("--subcategories", type=int, default=10, help="subcategorías por categoría")
+    parser.add_argument("--brands", type=int, default=8, help="marcas por subcategoría")
+    parser.add_argument("--catalogs", type=int, default=5, help="catálogos por marca")
+    parser.add_argument("--seed", type=int, default=0, help="semilla del generador sintético")
+    args = parser.parse_args()
+
     print("🚀 Iniciando el proceso de configuración inicial de la base de datos...")
-    run_initial_setup()
+    if args.synthetic:
+        run_bulk_setup(synthetic_rows(args.lines, args.categories, args.subcategories, args.brands,
+                                      args.catalogs, seed=args.seed))
+    elif args.bulk:
+        run_bulk_setup()
+    else:
+        run_initial_setup()
     print("\n✅ Proceso finalizado. Ya puedes iniciar la API con 'uvicorn main:app --reload'")
-
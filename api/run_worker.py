@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Worker de la cola de sincronización (tabla sync_jobs).
+
+Ejecuta las reconstrucciones completas de catalog.json fuera de la API, de
+modo que no compiten con el tráfico. Pueden correr varios a la vez: cada
+trabajo lo reclama uno solo. Es el modo por defecto: la API sólo encola
+salvo que se arranque con SYNC_WORKER_EMBEDDED=1.
+
+Uso (desde api/):
+    python run_worker.py              # atiende la cola hasta Ctrl+C
+    python run_worker.py --once       # ejecuta los trabajos pendientes y termina
+"""
+import argparse
+import signal
+
+from app.main import SYNC_WORKER_POLL_SECONDS, ensure_schema
+from app.sync_queue import SyncJobWorker
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--once", action="store_true", help="vacía la cola y termina")
+    parser.add_argument("--poll", type=float, default=SYNC_WORKER_POLL_SECONDS,
+                        help="segundos entre revisiones de la cola")
+    args = parser.parse_args()
+
+    ensure_schema()
+    worker = SyncJobWorker(args.poll)
+    if args.once:
+        executed = 0
+        while worker.run_once():
+            executed += 1
+        print(f"✅ {executed} trabajos ejecutados.")
+    else:
+        signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+        print(f"🚀 Worker {worker.name} atendiendo la cola de sincronización (Ctrl+C para salir)...")
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            pass
+        print("👋 Worker detenido.")